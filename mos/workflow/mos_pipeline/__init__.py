@@ -0,0 +1,8 @@
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(
+    __name__, {
+        'run_pipeline': ('.run_pipeline', 'run_pipeline'),
+        'run_incremental_pipeline':
+        ('.run_incremental_pipeline', 'run_incremental_pipeline')
+    })
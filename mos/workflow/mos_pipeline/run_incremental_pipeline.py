@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import inspect
+import json
+import logging
+import os
+
+import numpy as np
+
+from workflow.utils.get_resources import (get_blank_xml_template,
+                                          get_progtemp_file, get_obstemp_file)
+
+from ifu.workflow.utils.classes import OBXML
+
+from mos.workflow.mos_pipeline.run_pipeline import _process_ob
+from mos.workflow.mos_stage1 import create_mos_field_cat
+from mos.workflow.mos_stage2.create_xml_files import (create_xml_files,
+                                                      _get_manifest_file)
+from mos.workflow.mos_stage3.add_targets_to_xmls import (
+    _get_categorical_indices, _get_output_file, _read_ob, _select_targets)
+from mos.workflow.mos_stage4.add_guide_and_calib_stars import (
+    _add_guide_and_calib_stars_to_ob, _get_output_files,
+    _remove_previous_files)
+from mos.workflow.utils import (Manifest, OBText, TargetCatalogue,
+                                TargetTextWriter, XMLStreamWriter)
+from mos.workflow.utils.manifest import get_file_hash, get_hash
+
+# The key of the MOS field list in the manifest, which cannot clash with the
+# keys of the OBs since these are the names of their XML files
+_FIELD_CAT_KEY = 'mos_field_list'
+
+
+def _get_pipeline_manifest_file(output_dir, prefix=None):
+
+    if prefix is not None:
+        basename = prefix + '_mos_pipeline_manifest.json'
+    else:
+        basename = 'mos_pipeline_manifest.json'
+
+    return os.path.join(output_dir, basename)
+
+
+def _get_tool_hash():
+
+    # Hash the code which adds the targets, guide and calib stars to the OBs,
+    # so the outputs are regenerated when it changes
+
+    object_list = [
+        _process_ob, _get_ob_hash, _select_targets,
+        _add_guide_and_calib_stars_to_ob, TargetCatalogue, TargetTextWriter,
+        OBText, XMLStreamWriter, OBXML
+    ]
+
+    filename_list = sorted(
+        set(inspect.getsourcefile(obj) for obj in object_list))
+
+    return get_hash(*[get_file_hash(filename) for filename in filename_list])
+
+
+def _get_data_dict_hash(data_dict):
+
+    # Hash the columns of the data used to create the MOS field list
+
+    value_list = []
+
+    for name in sorted(data_dict.keys()):
+        values = np.asarray(data_dict[name])
+
+        if values.dtype.kind == 'O':
+            values = values.astype(str)
+
+        value_list += [name, str(values.dtype), str(values.shape),
+                       values.tobytes()]
+
+    return get_hash(*value_list)
+
+
+def _get_field_cat_hash(field_cat_kwargs):
+
+    kwargs = dict(field_cat_kwargs)
+
+    mos_field_template = kwargs.pop('mos_field_template')
+    data_dict = kwargs.pop('data_dict')
+
+    return get_hash(get_file_hash(mos_field_template),
+                    _get_data_dict_hash(data_dict),
+                    json.dumps(kwargs, sort_keys=True))
+
+
+def _get_ob_hash(common_hash, xml_hash, catalogue_list, rows_list):
+
+    # Hash the inputs of an OB: the inputs of its XML from stage 2 and the
+    # targets selected for it from each catalogue, together with the inputs
+    # shared by all the OBs
+
+    rows_hash_list = [
+        catalogue.get_rows_hash(rows)
+        for catalogue, rows in zip(catalogue_list, rows_list)
+    ]
+
+    return get_hash(common_hash, xml_hash, *rows_hash_list)
+
+
+def run_incremental_pipeline(mos_field_list,
+                             target_cat,
+                             output_dir,
+                             xml_template,
+                             progtemp_file=None,
+                             obstemp_file=None,
+                             prefix=None,
+                             pass_datamver=False,
+                             max_radius=1.0,
+                             clean_targets=True,
+                             num_calib_stars_request=None,
+                             num_guide_stars_request=25,
+                             write_useful_tables=False,
+                             plot_mode='inline',
+                             compact_xml=False,
+                             intermediate_dir=None,
+                             field_cat_kwargs=None):
+    """
+    Create the final MOS XML files, rebuilding only those whose inputs changed.
+
+    It runs the stages 1 to 4 as run_pipeline, but it records a hash of the
+    inputs of each output in JSON manifests, and in later runs it only
+    rebuilds the outputs whose inputs have changed:
+
+    - The MOS field list is created again only if the inputs of
+      create_mos_field_cat (given in field_cat_kwargs) have changed.
+    - The XML of an OB from stage 2 is created again only if its rows of the
+      MOS field list, the XML template or the PROGTEMP and OBSTEMP files have
+      changed, as with the incremental mode of create_xml_files.
+    - The final XML of an OB is created again only if its XML from stage 2,
+      the rows of the catalogues selected as its targets or the parameters of
+      the stages 3 and 4 have changed.
+
+    The outputs of the OBs which are not in the MOS field list anymore are
+    removed. Changes in the code of the workflow also trigger a rebuild, but
+    changes in the sources of the guide and calib stars used by the IFU
+    workflow are not tracked.
+
+    Parameters
+    ----------
+    mos_field_list : str
+        A FITS file containing a list of MOS field centers.
+    target_cat :  str or list of str
+        The filename of a catalogue with targets, or a list of them.
+    output_dir : str
+        Name of the directory which will contain the output XML files.
+    xml_template : str
+        A blank XML template to be populated with the information of the OBs.
+    progtemp_file : str, optional
+        A progtemp.dat file with the definition of PROGTEMP.
+    obstemp_file : str, optional
+        A obstemp.dat file with the definition of OBSTEMP.
+    prefix : str, optional
+        Prefix to be used in the output files.
+    pass_datamver : bool, optional
+        Continue even if DATAMVER mismatch is detected.
+    max_radius : float, optional
+        The maxium radius from the field center to add targets, and the
+        maximum distance of the calib stars to the field center.
+    clean_targets : bool, optional
+        Remove template targets from the XML.
+    num_calib_stars_request : int, optional
+        Maximum number of calib stars in the output. None means no limit.
+    num_guide_stars_request : int, optional
+        Maximum number of guide stars in the output. None means no limit.
+    write_useful_tables : bool, optional
+        Write tables with the potentially useful guide and calib stars.
+    plot_mode : {'inline', 'none', 'deferred'}, optional
+        How to produce the plots of the guide and calib stars, as in
+        add_guide_and_calib_stars.
+    compact_xml : bool, optional
+        Drop the comments with the documentation of the template from the
+        output XML files.
+    intermediate_dir : str, optional
+        Name of the directory which will contain the output files of the
+        stages 2 and 3, which are kept between runs. By default, it is a
+        directory called intermediate in the output directory.
+    field_cat_kwargs : dict, optional
+        The arguments of create_mos_field_cat (mos_field_template, data_dict,
+        trimester, author and optionally report_verbosity and cc_report) used
+        to create the MOS field list. If not provided, the MOS field list must
+        exist.
+
+    Returns
+    -------
+    output_file_list : list of str
+        A list with the output XML files.
+    """
+
+    assert plot_mode in ['inline', 'none', 'deferred']
+
+    # Accept a single catalogue as well as a list of them
+
+    if isinstance(target_cat, str):
+        target_cat_list = [target_cat]
+    else:
+        target_cat_list = list(target_cat)
+
+    if intermediate_dir is None:
+        intermediate_dir = os.path.join(output_dir, 'intermediate')
+
+    if not os.path.exists(intermediate_dir):
+        logging.info('Creating the directory {}'.format(intermediate_dir))
+        os.makedirs(intermediate_dir)
+
+    manifest = Manifest(_get_pipeline_manifest_file(output_dir, prefix))
+
+    try:
+
+        # Stage 1: create the MOS field list if its inputs have changed
+
+        if field_cat_kwargs is not None:
+            field_cat_hash = _get_field_cat_hash(field_cat_kwargs)
+
+            if manifest.is_up_to_date(_FIELD_CAT_KEY, field_cat_hash):
+                logging.info(
+                    'The MOS field list is up to date: {}'.format(
+                        mos_field_list))
+            else:
+                create_mos_field_cat(output_filename=mos_field_list,
+                                     overwrite=True,
+                                     **field_cat_kwargs)
+                manifest.set(_FIELD_CAT_KEY, field_cat_hash,
+                             [mos_field_list])
+
+        # Stage 2: create the XMLs of the OBs whose rows of the MOS field list
+        # have changed, getting the hashes of their inputs from its manifest
+
+        xml_file_list = create_xml_files(mos_field_list,
+                                         intermediate_dir,
+                                         xml_template,
+                                         progtemp_file=progtemp_file,
+                                         obstemp_file=obstemp_file,
+                                         prefix=prefix,
+                                         pass_datamver=pass_datamver,
+                                         incremental=True)
+
+        xml_manifest = Manifest(_get_manifest_file(intermediate_dir, prefix))
+
+        xml_hash_dict = {
+            os.path.abspath(xml_manifest.get_output_files(key)[0]):
+            xml_manifest.get_hash(key)
+            for key in xml_manifest.keys()
+        }
+
+        # The inputs shared by all the OBs in the stages 3 and 4
+
+        parameter_dict = {
+            'max_radius': max_radius,
+            'clean_targets': clean_targets,
+            'num_calib_stars_request': num_calib_stars_request,
+            'num_guide_stars_request': num_guide_stars_request,
+            'write_useful_tables': write_useful_tables,
+            'plot_mode': plot_mode,
+            'compact_xml': compact_xml
+        }
+
+        common_hash = get_hash(_get_tool_hash(),
+                               json.dumps(parameter_dict, sort_keys=True))
+
+        # Remove the outputs of the OBs which are not in the MOS field list
+        # anymore
+
+        key_list = [
+            os.path.basename(xml_file) for xml_file in sorted(xml_file_list)
+        ]
+
+        for key in set(manifest.keys()) - set(key_list + [_FIELD_CAT_KEY]):
+            manifest.remove(key)
+
+        # Stages 3 and 4: select the targets of each OB, and add them and the
+        # guide and calib stars to the OBs whose inputs have changed
+
+        catalogue_list = [
+            TargetCatalogue(filename, max_radius=max_radius)
+            for filename in target_cat_list
+        ]
+
+        output_file_list = []
+        num_rebuilt = 0
+
+        for key, xml_file in zip(key_list, sorted(xml_file_list)):
+
+            t_xml_file = _get_output_file(xml_file, intermediate_dir)
+
+            output_files = _get_output_files(t_xml_file, output_dir,
+                                             write_useful_tables)
+
+            output_file_list.append(output_files[0])
+
+            ob_text, field_selection = _read_ob(xml_file)
+
+            rows_list = [
+                _select_targets(_get_categorical_indices(catalogue),
+                                catalogue.sky_index, field_selection,
+                                max_radius) for catalogue in catalogue_list
+            ]
+
+            ob_hash = _get_ob_hash(common_hash,
+                                   xml_hash_dict[os.path.abspath(xml_file)],
+                                   catalogue_list, rows_list)
+
+            if manifest.is_up_to_date(key, ob_hash):
+                continue
+
+            # Remove the previous outputs of the OB before rebuilding it
+
+            if key in manifest:
+                manifest.remove(key)
+
+            _remove_previous_files((t_xml_file, ) + output_files)
+
+            logging.info('Rebuilding the OB of {}'.format(xml_file))
+
+            _process_ob(xml_file,
+                        None,
+                        t_xml_file,
+                        output_files,
+                        catalogue_list,
+                        max_radius=max_radius,
+                        clean_targets=clean_targets,
+                        num_calib_stars_request=num_calib_stars_request,
+                        num_guide_stars_request=num_guide_stars_request,
+                        plot_mode=plot_mode,
+                        compact_xml=compact_xml,
+                        write_t_xml=True,
+                        rows_list=rows_list)
+
+            ob_output_file_list = [
+                filename for filename in (t_xml_file, ) + output_files
+                if (filename is not None) and os.path.exists(filename)
+            ]
+
+            manifest.set(key, ob_hash, ob_output_file_list)
+
+            num_rebuilt += 1
+
+        for catalogue in catalogue_list:
+            catalogue.close()
+
+        logging.info('{} of {} OBs are up to date'.format(
+            len(key_list) - num_rebuilt, len(key_list)))
+
+    finally:
+
+        # Record the outputs built so far, even if the run was interrupted
+
+        manifest.write()
+
+    return output_file_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="""Create the final MOS XML files from an MOS field list,
+        rebuilding only those whose inputs have changed""")
+
+    parser.add_argument('mos_field_list',
+                        help="""a FITS file containing an MOS fields""")
+
+    parser.add_argument('--catalogues',
+                        nargs='+',
+                        help="""catalogues containing targets""")
+
+    parser.add_argument('--xml_template',
+                        default=os.path.join('aux', 'BlankXMLTemplate.xml'),
+                        help="""a blank XML template to be populated with the
+                        information of the OBs""")
+
+    parser.add_argument('--progtemp_file',
+                        default=os.path.join('aux', 'progtemp.dat'),
+                        help="""a progtemp.dat file with the definition of
+                        PROGTEMP""")
+
+    parser.add_argument('--obstemp_file',
+                        default=os.path.join('aux', 'obstemp.dat'),
+                        help="""a obstemp.dat file with the definition of
+                        OBSTEMP""")
+
+    parser.add_argument('--outdir',
+                        dest='output_dir',
+                        default='output',
+                        help="""name of the directory which will contain the
+                        output XML files""")
+
+    parser.add_argument('--intermediate_dir',
+                        default=None,
+                        help="""name of the directory which will contain the
+                        output files of the stages 2 and 3; by default, a
+                        directory called intermediate in the output
+                        directory""")
+
+    parser.add_argument('--prefix',
+                        dest='prefix',
+                        default=None,
+                        help="""prefix to be used in the output files""")
+
+    parser.add_argument('--pass_datamver',
+                        dest='pass_datamver',
+                        action='store_true',
+                        help='continue even if DATAMVER mismatch is detected')
+
+    parser.add_argument('--max_radius',
+                        default=1.0,
+                        type=float,
+                        help="""add targets within these degrees of the field
+                        center""")
+
+    parser.add_argument('--keep_template_targets',
+                        action='store_true',
+                        help="""do not remove the template targets""")
+
+    parser.add_argument('--num_calib_stars_request',
+                        default=-1,
+                        type=int,
+                        help="""maximum number of calib stars in the output;
+                        -1 means no limit""")
+
+    parser.add_argument('--num_guide_stars_request',
+                        default=-1,
+                        type=int,
+                        help="""maximum number of guide stars in the output;
+                        -1 means no limit""")
+
+    parser.add_argument('--write_useful_tables',
+                        action='store_true',
+                        help="""write tables with the potentially useful guide
+                        and calib stars""")
+
+    parser.add_argument('--plot_mode',
+                        default='inline',
+                        choices=['inline', 'none', 'deferred'],
+                        help="""how to produce the plots of the guide and calib
+                        stars""")
+
+    parser.add_argument('--compact_xml',
+                        action='store_true',
+                        help="""drop the comments with the documentation of
+                        the template from the output files""")
+
+    parser.add_argument('--log_level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    if not os.path.exists(args.output_dir):
+        logging.info('Creating the output directory')
+        os.makedirs(args.output_dir)
+
+    xml_template_dir = os.path.dirname(args.xml_template)
+    if not os.path.exists(xml_template_dir):
+        logging.info('Creating the directory of the blank XML template')
+        os.makedirs(xml_template_dir)
+
+    if not os.path.exists(args.xml_template):
+        logging.info('Downloading the blank XML template')
+        get_blank_xml_template(file_path=args.xml_template)
+
+    if not os.path.exists(args.progtemp_file):
+        logging.info('Downloading the progtemp file')
+        get_progtemp_file(file_path=args.progtemp_file)
+
+    if not os.path.exists(args.obstemp_file):
+        logging.info('Downloading the obstemp file')
+        get_obstemp_file(file_path=args.obstemp_file)
+
+    if args.num_calib_stars_request != -1:
+        num_calib_stars_request = args.num_calib_stars_request
+    else:
+        num_calib_stars_request = None
+
+    if args.num_guide_stars_request != -1:
+        num_guide_stars_request = args.num_guide_stars_request
+    else:
+        num_guide_stars_request = None
+
+    run_incremental_pipeline(args.mos_field_list,
+                             args.catalogues,
+                             args.output_dir,
+                             args.xml_template,
+                             progtemp_file=args.progtemp_file,
+                             obstemp_file=args.obstemp_file,
+                             prefix=args.prefix,
+                             pass_datamver=args.pass_datamver,
+                             max_radius=args.max_radius,
+                             clean_targets=not args.keep_template_targets,
+                             num_calib_stars_request=num_calib_stars_request,
+                             num_guide_stars_request=num_guide_stars_request,
+                             write_useful_tables=args.write_useful_tables,
+                             plot_mode=args.plot_mode,
+                             compact_xml=args.compact_xml,
+                             intermediate_dir=args.intermediate_dir)
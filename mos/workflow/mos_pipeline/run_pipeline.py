@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+from workflow.utils.get_resources import (get_blank_xml_template,
+                                          get_progtemp_file, get_obstemp_file)
+
+from ifu.workflow.utils.classes import OBXML
+
+from mos.workflow.mos_stage2.create_xml_files import create_xml_files
+from mos.workflow.mos_stage3.add_targets_to_xmls import (
+    _add_targets_to_ob_xml, _get_output_file)
+from mos.workflow.mos_stage4.add_guide_and_calib_stars import (
+    _add_guide_and_calib_stars_to_ob, _get_output_files,
+    _remove_previous_files)
+from mos.workflow.utils import TargetCatalogue, XMLStreamWriter
+from mos.workflow.utils.xml_template import parse_document_from_memory
+
+
+def _read_ob_xml(xml_file, dom):
+
+    # Get the OB written by stage 2, from its document if it is available or
+    # from its file otherwise
+
+    if dom is None:
+        return OBXML(xml_file)
+
+    with parse_document_from_memory(xml_file, dom,
+                                    sys.modules[OBXML.__module__]):
+        ob_xml = OBXML(xml_file)
+
+    return ob_xml
+
+
+def _process_ob(xml_file,
+                dom,
+                t_xml_file,
+                output_files,
+                catalogue_list,
+                max_radius=1.0,
+                clean_targets=True,
+                num_calib_stars_request=None,
+                num_guide_stars_request=25,
+                plot_mode='inline',
+                compact_xml=False,
+                write_t_xml=False,
+                rows_list=None):
+
+    # Stage 3: add the targets to the document of the OB built by stage 2,
+    # without parsing the file it was written to
+
+    ob_xml = _read_ob_xml(xml_file, dom)
+
+    _add_targets_to_ob_xml(ob_xml,
+                           xml_file,
+                           catalogue_list,
+                           max_radius,
+                           clean_targets,
+                           rows_list=rows_list)
+
+    if write_t_xml:
+        XMLStreamWriter(ob_xml.fields.ownerDocument).write(t_xml_file)
+
+    # Stage 4: add the guide and calib stars to the same document, which is
+    # only written once they are in it
+
+    _add_guide_and_calib_stars_to_ob(
+        ob_xml,
+        t_xml_file,
+        *output_files,
+        num_calib_stars_request=num_calib_stars_request,
+        num_guide_stars_request=num_guide_stars_request,
+        max_radius=max_radius,
+        plot_mode=plot_mode,
+        compact_xml=compact_xml)
+
+
+def run_pipeline(mos_field_list,
+                 target_cat,
+                 output_dir,
+                 xml_template,
+                 progtemp_file=None,
+                 obstemp_file=None,
+                 prefix=None,
+                 pass_datamver=False,
+                 max_radius=1.0,
+                 clean_targets=True,
+                 num_calib_stars_request=None,
+                 num_guide_stars_request=25,
+                 write_useful_tables=False,
+                 plot_mode='inline',
+                 compact_xml=False,
+                 intermediate_dir=None,
+                 overwrite=False):
+    """
+    Create the final MOS XML files from an MOS field list and target cats.
+
+    It runs the stages 2, 3 and 4 for each OB, handing the OB from one stage
+    to the next one in memory, so only the final -tgc.xml files are written
+    to the output directory. The results are the same as running the stages
+    one after another.
+
+    Parameters
+    ----------
+    mos_field_list : str
+        A FITS file containing a list of MOS field centers.
+    target_cat :  str or list of str
+        The filename of a catalogue with targets, or a list of them.
+    output_dir : str
+        Name of the directory which will contain the output XML files.
+    xml_template : str
+        A blank XML template to be populated with the information of the OBs.
+    progtemp_file : str, optional
+        A progtemp.dat file with the definition of PROGTEMP.
+    obstemp_file : str, optional
+        A obstemp.dat file with the definition of OBSTEMP.
+    prefix : str, optional
+        Prefix to be used in the output files.
+    pass_datamver : bool, optional
+        Continue even if DATAMVER mismatch is detected.
+    max_radius : float, optional
+        The maxium radius from the field center to add targets, and the
+        maximum distance of the calib stars to the field center.
+    clean_targets : bool, optional
+        Remove template targets from the XML.
+    num_calib_stars_request : int, optional
+        Maximum number of calib stars in the output. None means no limit.
+    num_guide_stars_request : int, optional
+        Maximum number of guide stars in the output. None means no limit.
+    write_useful_tables : bool, optional
+        Write tables with the potentially useful guide and calib stars.
+    plot_mode : {'inline', 'none', 'deferred'}, optional
+        How to produce the plots of the guide and calib stars, as in
+        add_guide_and_calib_stars.
+    compact_xml : bool, optional
+        Drop the comments with the documentation of the template from the
+        output XML files.
+    intermediate_dir : str, optional
+        Name of a directory where the output files of the stages 2 and 3 are
+        also written. By default they are not kept.
+    overwrite : bool, optional
+        Overwrite the output files.
+
+    Returns
+    -------
+    output_file_list : list of str
+        A list with the output XML files.
+    """
+
+    assert plot_mode in ['inline', 'none', 'deferred']
+
+    # Accept a single catalogue as well as a list of them
+
+    if isinstance(target_cat, str):
+        target_cat_list = [target_cat]
+    else:
+        target_cat_list = list(target_cat)
+
+    output_file_dict = {}
+
+    # Open the catalogues and index their coordinates once for all the fields
+
+    catalogue_list = [
+        TargetCatalogue(filename, max_radius=max_radius)
+        for filename in target_cat_list
+    ]
+
+    def process_ob(xml_file, dom):
+
+        t_xml_file = _get_output_file(xml_file, xml_dir)
+
+        output_files = _get_output_files(t_xml_file, output_dir,
+                                         write_useful_tables)
+        output_file = output_files[0]
+
+        output_file_dict[xml_file] = output_file
+
+        # If the output file already exists, delete it or continue with the
+        # next one
+
+        if os.path.exists(output_file):
+            if overwrite:
+                _remove_previous_files(output_files)
+            else:
+                logging.info(
+                    'Skipping file {} as its output already exists: {}'.format(
+                        xml_file, output_file))
+                return
+
+        _process_ob(xml_file,
+                    dom,
+                    t_xml_file,
+                    output_files,
+                    catalogue_list,
+                    max_radius=max_radius,
+                    clean_targets=clean_targets,
+                    num_calib_stars_request=num_calib_stars_request,
+                    num_guide_stars_request=num_guide_stars_request,
+                    plot_mode=plot_mode,
+                    compact_xml=compact_xml,
+                    write_t_xml=(intermediate_dir is not None))
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            # The XML files of stage 2 are written by the IFU workflow, so
+            # they go to the intermediate directory or to a temporary one.
+            # Each OB is taken by the stages 3 and 4 as soon as it is
+            # generated, with the document built by stage 2
+
+            if intermediate_dir is not None:
+                xml_dir = intermediate_dir
+            else:
+                xml_dir = tmp_dir
+
+            create_xml_files(mos_field_list,
+                             xml_dir,
+                             xml_template,
+                             progtemp_file=progtemp_file,
+                             obstemp_file=obstemp_file,
+                             prefix=prefix,
+                             pass_datamver=pass_datamver,
+                             overwrite=overwrite,
+                             ob_callback=process_ob)
+    finally:
+        for catalogue in catalogue_list:
+            catalogue.close()
+
+    output_file_list = [
+        output_file_dict[xml_file] for xml_file in sorted(output_file_dict)
+    ]
+
+    return output_file_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Create the final MOS XML files from an MOS field list')
+
+    parser.add_argument('mos_field_list',
+                        help="""a FITS file containing an MOS fields""")
+
+    parser.add_argument('--catalogues',
+                        nargs='+',
+                        help="""catalogues containing targets""")
+
+    parser.add_argument('--xml_template',
+                        default=os.path.join('aux', 'BlankXMLTemplate.xml'),
+                        help="""a blank XML template to be populated with the
+                        information of the OBs""")
+
+    parser.add_argument('--progtemp_file',
+                        default=os.path.join('aux', 'progtemp.dat'),
+                        help="""a progtemp.dat file with the definition of
+                        PROGTEMP""")
+
+    parser.add_argument('--obstemp_file',
+                        default=os.path.join('aux', 'obstemp.dat'),
+                        help="""a obstemp.dat file with the definition of
+                        OBSTEMP""")
+
+    parser.add_argument('--outdir',
+                        dest='output_dir',
+                        default='output',
+                        help="""name of the directory which will contain the
+                        output XML files""")
+
+    parser.add_argument('--intermediate_dir',
+                        default=None,
+                        help="""name of a directory where the output files of
+                        the stages 2 and 3 are also written""")
+
+    parser.add_argument('--prefix',
+                        dest='prefix',
+                        default=None,
+                        help="""prefix to be used in the output files""")
+
+    parser.add_argument('--pass_datamver',
+                        dest='pass_datamver',
+                        action='store_true',
+                        help='continue even if DATAMVER mismatch is detected')
+
+    parser.add_argument('--max_radius',
+                        default=1.0,
+                        type=float,
+                        help="""add targets within these degrees of the field
+                        center""")
+
+    parser.add_argument('--keep_template_targets',
+                        action='store_true',
+                        help="""do not remove the template targets""")
+
+    parser.add_argument('--num_calib_stars_request',
+                        default=-1,
+                        type=int,
+                        help="""maximum number of calib stars in the output;
+                        -1 means no limit""")
+
+    parser.add_argument('--num_guide_stars_request',
+                        default=-1,
+                        type=int,
+                        help="""maximum number of guide stars in the output;
+                        -1 means no limit""")
+
+    parser.add_argument('--write_useful_tables',
+                        action='store_true',
+                        help="""write tables with the potentially useful guide
+                        and calib stars""")
+
+    parser.add_argument('--plot_mode',
+                        default='inline',
+                        choices=['inline', 'none', 'deferred'],
+                        help="""how to produce the plots of the guide and calib
+                        stars""")
+
+    parser.add_argument('--compact_xml',
+                        action='store_true',
+                        help="""drop the comments with the documentation of
+                        the template from the output files""")
+
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='overwrite the output files')
+
+    parser.add_argument('--log_level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    for directory in [args.output_dir, args.intermediate_dir]:
+        if (directory is not None) and (not os.path.exists(directory)):
+            logging.info('Creating the directory {}'.format(directory))
+            os.makedirs(directory)
+
+    xml_template_dir = os.path.dirname(args.xml_template)
+    if not os.path.exists(xml_template_dir):
+        logging.info('Creating the directory of the blank XML template')
+        os.makedirs(xml_template_dir)
+
+    if not os.path.exists(args.xml_template):
+        logging.info('Downloading the blank XML template')
+        get_blank_xml_template(file_path=args.xml_template)
+
+    if not os.path.exists(args.progtemp_file):
+        logging.info('Downloading the progtemp file')
+        get_progtemp_file(file_path=args.progtemp_file)
+
+    if not os.path.exists(args.obstemp_file):
+        logging.info('Downloading the obstemp file')
+        get_obstemp_file(file_path=args.obstemp_file)
+
+    if args.num_calib_stars_request != -1:
+        num_calib_stars_request = args.num_calib_stars_request
+    else:
+        num_calib_stars_request = None
+
+    if args.num_guide_stars_request != -1:
+        num_guide_stars_request = args.num_guide_stars_request
+    else:
+        num_guide_stars_request = None
+
+    run_pipeline(args.mos_field_list,
+                 args.catalogues,
+                 args.output_dir,
+                 args.xml_template,
+                 progtemp_file=args.progtemp_file,
+                 obstemp_file=args.obstemp_file,
+                 prefix=args.prefix,
+                 pass_datamver=args.pass_datamver,
+                 max_radius=args.max_radius,
+                 clean_targets=not args.keep_template_targets,
+                 num_calib_stars_request=num_calib_stars_request,
+                 num_guide_stars_request=num_guide_stars_request,
+                 write_useful_tables=args.write_useful_tables,
+                 plot_mode=args.plot_mode,
+                 compact_xml=args.compact_xml,
+                 intermediate_dir=args.intermediate_dir,
+                 overwrite=args.overwrite)
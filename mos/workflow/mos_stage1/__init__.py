@@ -1,6 +1,13 @@
-from .create_mos_field_template import create_mos_field_template
-from .create_mos_field_cat import create_mos_field_cat
-from ._create_mos_field_cat_example import get_data_dict as \
-    _get_data_dict_for_example
-from ._create_mos_field_cat_example import set_keywords_info as \
-    _set_keywords_info_for_example
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(
+    __name__, {
+        'create_mos_field_template':
+        ('.create_mos_field_template', 'create_mos_field_template'),
+        'create_mos_field_cat':
+        ('.create_mos_field_cat', 'create_mos_field_cat'),
+        '_get_data_dict_for_example':
+        ('._create_mos_field_cat_example', 'get_data_dict'),
+        '_set_keywords_info_for_example':
+        ('._create_mos_field_cat_example', 'set_keywords_info')
+    })
@@ -19,6 +19,8 @@
 
 from ifu.workflow.utils import populate_fits_table_template
 
+from mos.workflow.utils.metrics import span
+
 
 def create_mos_field_cat(mos_field_template,
                          data_dict,
@@ -70,11 +72,15 @@ def create_mos_field_cat(mos_field_template,
         'CCREPORT': cc_report
     }
 
-    populate_fits_table_template(mos_field_template,
-                                 data_dict,
-                                 output_filename,
-                                 primary_kwds=primary_kwds,
-                                 update_datetime=True,
-                                 overwrite=overwrite)
+    with span('populate_field_cat') as populate_span:
+        populate_fits_table_template(mos_field_template,
+                                     data_dict,
+                                     output_filename,
+                                     primary_kwds=primary_kwds,
+                                     update_datetime=True,
+                                     overwrite=overwrite)
+
+        populate_span.add('fields',
+                          len(next(iter(data_dict.values()), [])))
 
     return output_filename
@@ -35,6 +35,9 @@ import datetime as _datetime
 from ifu.workflow.utils import create_sub_template
 from ifu.workflow.utils.get_resources import get_master_cat
 
+from mos.workflow.utils.metrics import enable_metrics, span, write_metrics
+from mos.workflow.utils.profiling import StageProfiler
+
 
 def _add_column_to_fits_template(template,
                                  column,
@@ -125,24 +128,27 @@ def create_mos_field_template(catalogue_template,
 
     # Create the sub-template with the above parameters
 
-    create_sub_template(catalogue_template,
-                        output_filename,
-                        col_list,
-                        extname=extname,
-                        inherit_primary_kwds=False,
-                        inherited_kwds=inherited_kwds,
-                        new_primary_kwds=new_primary_kwds,
-                        rename_col_dict=rename_col_dict,
-                        update_datetime=update_datetime,
-                        overwrite=overwrite)
+    with span('create_sub_template'):
+        create_sub_template(catalogue_template,
+                            output_filename,
+                            col_list,
+                            extname=extname,
+                            inherit_primary_kwds=False,
+                            inherited_kwds=inherited_kwds,
+                            new_primary_kwds=new_primary_kwds,
+                            rename_col_dict=rename_col_dict,
+                            update_datetime=update_datetime,
+                            overwrite=overwrite)
 
     # Add the MAX_FIBRES column - This won't look like a SPA column,
     # but  since there is no UCD etc. then this is anyway inevitable
     column = _fits.Column(name='MAX_FIBRES', format='I', null=0, disp='I3')
-    _add_column_to_fits_template(output_filename,
-                                 column,
-                                 update_datetime=update_datetime,
-                                 checksum=True)
+
+    with span('add_column'):
+        _add_column_to_fits_template(output_filename,
+                                     column,
+                                     update_datetime=update_datetime,
+                                     checksum=True)
 
 
 if __name__ == '__main__':
@@ -172,6 +178,25 @@ if __name__ == '__main__':
                         action='store_true',
                         help='overwrite the output file')
 
+    parser.add_argument('--metrics_json',
+                        default=None,
+                        help="""write the wall time, CPU time, memory and
+                        counters of each step of the run to this JSON
+                        file""")
+
+    parser.add_argument('--profile',
+                        default=None,
+                        choices=['cprofile', 'sampling'],
+                        help="""profile the run with cProfile or by sampling
+                        its stack, writing a pstats or collapsed-stack file
+                        next to the output files and printing the functions
+                        with the largest cumulative time""")
+
+    parser.add_argument('--profile_top',
+                        default=20,
+                        type=int,
+                        help="""number of functions printed when profiling""")
+
     parser.add_argument('--log_level',
                         default='info',
                         choices=['debug', 'info', 'warning', 'error'],
@@ -185,7 +210,20 @@ if __name__ == '__main__':
         logging.info('Downloading the master catalogue template')
         get_master_cat(file_path=args.catalogue_template)
 
-    create_mos_field_template(args.catalogue_template,
-                              args.mos_field_template,
-                              update_datetime=args.update_datetime,
-                              overwrite=args.overwrite)
+    if args.metrics_json is not None:
+        enable_metrics()
+
+    profile_prefix = os.path.join(os.path.dirname(args.mos_field_template),
+                                  'create_mos_field_template')
+
+    try:
+        with StageProfiler(args.profile, profile_prefix,
+                           top=args.profile_top), \
+                span('create_mos_field_template'):
+            create_mos_field_template(args.catalogue_template,
+                                      args.mos_field_template,
+                                      update_datetime=args.update_datetime,
+                                      overwrite=args.overwrite)
+    finally:
+        if args.metrics_json is not None:
+            write_metrics(args.metrics_json)
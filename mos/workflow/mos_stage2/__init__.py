@@ -1 +1,5 @@
-from .create_xml_files import create_xml_files
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(__name__,
+                    {'create_xml_files': ('.create_xml_files',
+                                          'create_xml_files')})
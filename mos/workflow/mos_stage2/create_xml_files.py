@@ -18,15 +18,16 @@
 #
 
 import argparse
-import glob
+import inspect
+import json
 import logging
+import multiprocessing
 import os
 import re
-import xml.dom.minidom
+import sys
 from collections import OrderedDict
 
 import numpy as np
-from astropy.io import fits
 
 from workflow.utils.get_resources import (get_blank_xml_template,
                                           get_progtemp_file, get_obstemp_file)
@@ -34,6 +35,194 @@ from workflow.utils.get_resources import (get_blank_xml_template,
 from ifu.workflow.stage2.create_xml_files import _XMLFromFields
 from ifu.workflow.utils.get_progtemp_info import get_obsmode_from_progtemp
 
+from mos.workflow.utils import Manifest, XMLTemplate
+from mos.workflow.utils.manifest import get_file_hash, get_hash
+from mos.workflow.utils.metrics import (add_records, enable_metrics,
+                                        get_start_wall_time,
+                                        init_worker_metrics, pop_records, span,
+                                        write_metrics)
+from mos.workflow.utils.profiling import StageProfiler
+
+
+# The grammar of PROGTEMP: NORBI.X(+), where the optional .X sets the number of
+# repeats of the OB and the optional + means that it is chained
+_PROGTEMP_PATTERN = re.compile(r'^[0-9]{5}(\.[0-9]+)?\+?$')
+
+
+def _get_mos_mask(progtemp_column, progtemp_dict):
+
+    # Classify each distinct PROGTEMP only once and broadcast the result to
+    # all the rows with it
+
+    progtemp_array, inverse = np.unique(np.asarray(progtemp_column),
+                                        return_inverse=True)
+    inverse = inverse.ravel()
+
+    is_mos_array = np.zeros(len(progtemp_array), dtype=bool)
+
+    for i, progtemp in enumerate(progtemp_array):
+        progtemp = str(progtemp).strip()
+
+        if _PROGTEMP_PATTERN.match(progtemp) is None:
+            continue
+
+        try:
+            obsmode = get_obsmode_from_progtemp(progtemp,
+                                                progtemp_dict=progtemp_dict)
+        except Exception:
+            obsmode = None
+
+        is_mos_array[i] = (obsmode == 'MOS')
+
+    mos_mask = is_mos_array[inverse]
+
+    # Summarise the rejected rows for each PROGTEMP
+
+    rejected_dict = OrderedDict()
+
+    for i in np.where(~is_mos_array)[0]:
+        rejected_dict[str(progtemp_array[i])] = np.where(inverse == i)[0]
+
+    return mos_mask, rejected_dict
+
+
+# How do you group bundles belonging to the same field?
+_GROUP_ID = ('FIELD_NAME', 'PROGTEMP', 'OBSTEMP', 'FIELD_RA', 'FIELD_DEC')
+
+
+def _get_manifest_file(output_dir, prefix=None, suffix=''):
+
+    # The manifest of the XMLs generated with a prefix and a suffix
+
+    if prefix is not None:
+        basename = prefix + '_mos_manifest' + suffix + '.json'
+    else:
+        basename = 'mos_manifest' + suffix + '.json'
+
+    return os.path.join(output_dir, basename)
+
+
+def _get_tool_hash():
+
+    # Hash the code which generates the XMLs, so they are regenerated when it
+    # changes
+
+    return get_hash(get_file_hash(__file__),
+                    get_file_hash(inspect.getsourcefile(_XMLFromFields)))
+
+
+def _get_group_key(entry):
+
+    return json.dumps([str(entry[name]) for name in _GROUP_ID])
+
+
+def _get_group_hash(data, group_rows, common_hash):
+
+    # Hash the rows of a group together with the inputs shared by all the
+    # groups
+
+    rows = np.asarray(data[group_rows])
+
+    return get_hash(common_hash, str(rows.dtype), rows.tobytes())
+
+
+def _get_group_rows(data, names):
+
+    # Group the rows with the same values in some columns, using the columns
+    # instead of the rows, and keep the groups in the order in which they are
+    # first seen
+
+    keys = np.empty(len(data),
+                    dtype=[(name, np.asarray(data[name]).dtype)
+                           for name in names])
+
+    for name in names:
+        column = np.asarray(data[name])
+
+        if column.dtype.kind in ['S', 'U']:
+            column = np.char.rstrip(column)
+
+        keys[name] = column
+
+    if len(keys) == 0:
+        return []
+
+    _, first_index, inverse = np.unique(keys,
+                                        return_index=True,
+                                        return_inverse=True)
+    inverse = inverse.ravel()
+
+    # Rank the groups by their first row, and sort the rows by the rank of
+    # their group keeping their order within each group
+
+    group_order = np.argsort(first_index, kind='stable')
+
+    group_rank = np.empty(len(group_order), dtype=int)
+    group_rank[group_order] = np.arange(len(group_order))
+
+    row_rank = group_rank[inverse]
+
+    sorted_rows = np.argsort(row_rank, kind='stable')
+    counts = np.bincount(row_rank, minlength=len(group_order))
+
+    group_rows_list = np.split(sorted_rows, np.cumsum(counts)[:-1])
+
+    return group_rows_list
+
+
+def _get_template_parsing_modules():
+
+    # The modules of the IFU workflow which may parse the XML template while
+    # processing an OB
+
+    from ifu.workflow.utils import classes
+
+    return [sys.modules[_XMLFromFields.__module__], classes]
+
+
+# The state of each worker process of the pool used by _generate_mos_xmls
+_worker_state = {}
+
+
+def _init_worker(filename, mos_entry_list, xml_template,
+                 xml_template_prototype, progtemp_dict, obstemp_dict,
+                 output_dir, prefix, suffix, start_wall_time):
+
+    # Record the metrics of the worker if the parent process records them,
+    # so they can be returned with the results
+
+    init_worker_metrics(start_wall_time)
+
+    _worker_state['field_cat'] = _MOSFieldCat(filename)
+    _worker_state['mos_entry_list'] = mos_entry_list
+    _worker_state['xml_template'] = xml_template
+    _worker_state['xml_template_prototype'] = xml_template_prototype
+    _worker_state['progtemp_dict'] = progtemp_dict
+    _worker_state['obstemp_dict'] = obstemp_dict
+    _worker_state['output_dir'] = output_dir
+    _worker_state['prefix'] = prefix
+    _worker_state['suffix'] = suffix
+
+
+def _process_group_in_worker(group_rows):
+
+    mos_entry_list = _worker_state['mos_entry_list']
+
+    entry_group = [mos_entry_list[i] for i in group_rows]
+
+    with _worker_state['xml_template_prototype'].parse_from_memory(
+            *_get_template_parsing_modules()):
+        output_file = _worker_state['field_cat']._process_group(
+            entry_group,
+            _worker_state['xml_template'],
+            _worker_state['progtemp_dict'],
+            _worker_state['obstemp_dict'],
+            output_dir=_worker_state['output_dir'],
+            prefix=_worker_state['prefix'],
+            suffix=_worker_state['suffix'])
+
+    return output_file, pop_records()
+
 
 class _MOSFieldCat(_XMLFromFields):
     """
@@ -50,6 +239,34 @@ class _MOSFieldCat(_XMLFromFields):
     def __init__(self, filename):
         super().__init__(filename, mode='mos')
 
+        self._filename = filename
+
+    def _process_group(self,
+                       entry_group,
+                       xml_template,
+                       progtemp_dict,
+                       obstemp_dict,
+                       output_dir='',
+                       prefix='',
+                       suffix=''):
+
+        # Make the OB name be part of the xml name
+        thisprefix = entry_group[0]['FIELD_NAME'] + '_'
+        if prefix is not None:
+            thisprefix = prefix + '_' + thisprefix
+
+        with span('write_ob', field_name=entry_group[0]['FIELD_NAME']):
+            output_file = self._process_ob(entry_group,
+                                           xml_template,
+                                           progtemp_dict,
+                                           obstemp_dict,
+                                           spatial_binning=1,
+                                           output_dir=output_dir,
+                                           prefix=thisprefix,
+                                           suffix=suffix)
+
+        return output_file
+
     def _generate_mos_xmls(self,
                            mos_entry_list,
                            xml_template,
@@ -57,56 +274,82 @@ class _MOSFieldCat(_XMLFromFields):
                            obstemp_dict,
                            output_dir='',
                            prefix='',
-                           suffix=''):
+                           suffix='',
+                           xml_template_prototype=None,
+                           workers=1,
+                           group_rows_list=None,
+                           ob_callback=None):
 
-        output_file_list = []
+        # Group the MOS entries per field, working on the columns and only
+        # getting the rows of each group when it is processed
 
-        # How do you group bundles belonging to the same field?
-        group_id = ('FIELD_NAME', 'PROGTEMP', 'OBSTEMP', 'FIELD_RA',
-                    'FIELD_DEC')
+        if group_rows_list is None:
+            group_rows_list = _get_group_rows(mos_entry_list, _GROUP_ID)
 
-        # Group the MOS entries per field
+        # Proccess OB grouping
+        logging.info('Processing {} MOS fields'.format(len(group_rows_list)))
 
-        fields_dict = OrderedDict()
+        if workers == 1:
 
-        for mos_entry in mos_entry_list:
+            output_file_list = []
 
-            key = tuple(mos_entry[col] for col in group_id)
+            for group_rows in group_rows_list:
+                if xml_template_prototype is not None:
+                    xml_template_prototype.pop_last_clone()
 
-            if key not in fields_dict.keys():
-                fields_dict[key] = []
+                output_file = self._process_group(
+                    [mos_entry_list[i] for i in group_rows],
+                    xml_template,
+                    progtemp_dict,
+                    obstemp_dict,
+                    output_dir=output_dir,
+                    prefix=prefix,
+                    suffix=suffix)
 
-            fields_dict[key].append(mos_entry)
+                output_file_list.append(output_file)
 
-        # Group the targets in each field per OB
+                # Hand the document of the OB over to the caller, if it was
+                # built on a copy of the template served from memory
 
-        ob_nested_list = []
+                if ob_callback is not None:
+                    if xml_template_prototype is not None:
+                        dom = xml_template_prototype.pop_last_clone()
+                    else:
+                        dom = None
 
-        for key in fields_dict.keys():
+                    ob_callback(output_file, dom)
 
-            # Get the entries in the field
-            field_entry_list = fields_dict[key]
+        else:
 
-            ob_nested_list.append(field_entry_list)
+            assert ob_callback is None
 
-        # Proccess OB grouping
-        logging.info('Processing {} MOS fields'.format(len(fields_dict)))
+            # Send the entries, the template and the dictionaries once to each
+            # worker, so the tasks only contain the rows of each group
 
-        for entry_group in ob_nested_list:
-            # Make the OB name be part of the xml name
-            thisprefix = entry_group[0]['FIELD_NAME'] + '_'
-            if prefix is not None:
-                thisprefix = prefix + '_' + thisprefix
-            output_file = self._process_ob(entry_group,
-                                           xml_template,
-                                           progtemp_dict,
-                                           obstemp_dict,
-                                           spatial_binning=1,
-                                           output_dir=output_dir,
-                                           prefix=thisprefix,
-                                           suffix=suffix)
+            if xml_template_prototype is None:
+                xml_template_prototype = XMLTemplate(xml_template)
+
+            pool = multiprocessing.Pool(
+                processes=workers,
+                initializer=_init_worker,
+                initargs=(self._filename, mos_entry_list, xml_template,
+                          xml_template_prototype, progtemp_dict, obstemp_dict,
+                          output_dir, prefix, suffix, get_start_wall_time()))
+
+            try:
+                result_list = pool.map(_process_group_in_worker,
+                                       group_rows_list)
+            finally:
+                pool.close()
+                pool.join()
+
+            # Merge the metrics of the OBs recorded by the workers
 
-            output_file_list.append(output_file)
+            output_file_list = []
+
+            for output_file, record_list in result_list:
+                output_file_list.append(output_file)
+                add_records(record_list)
 
         return output_file_list
 
@@ -117,16 +360,22 @@ class _MOSFieldCat(_XMLFromFields):
                       output_dir='',
                       prefix='',
                       suffix='',
-                      pass_datamver=False):
+                      pass_datamver=False,
+                      workers=1,
+                      manifest_file=None,
+                      ob_callback=None):
 
-        # Get the DATAMVER of the XML template
+        # Parse the XML template only once and get its DATAMVER
 
-        xml_template_dom = xml.dom.minidom.parse(xml_template)
-        xml_datamver = xml_template_dom.childNodes[0].getAttribute('datamver')
+        with span('read_templates'):
+            xml_template_prototype = XMLTemplate(xml_template)
+            xml_datamver = xml_template_prototype.datamver
 
-        # Get the dictionaries to interpret PROGTEMP and OBSTEMP
-        progtemp_dict = self._get_progtemp_dict(progtemp_file, pass_datamver)
-        obstemp_dict = self._get_obstemp_dict(obstemp_file, pass_datamver)
+            # Get the dictionaries to interpret PROGTEMP and OBSTEMP
+            progtemp_dict = self._get_progtemp_dict(progtemp_file,
+                                                    pass_datamver)
+            obstemp_dict = self._get_obstemp_dict(obstemp_file,
+                                                  pass_datamver)
 
         # Check DATAMVER of the IFU driver cat, the XML template, PROGTEMP file
         # and OBSTEMP file are consistent
@@ -136,38 +385,114 @@ class _MOSFieldCat(_XMLFromFields):
                              format(self.datamver, xml_datamver) +
                              'Stop unless you are sure!')
 
-            if pass_datamver == False:
+            if not pass_datamver:
                 raise SystemExit(2)
 
         # Get the mos entries in case we have some fields with the wrong
         # progtemp
 
-        mos_entry_list = []
+        with span('select_fields') as select_span:
+            mos_mask, rejected_dict = _get_mos_mask(self.data['PROGTEMP'],
+                                                    progtemp_dict)
 
-        for i, entry in enumerate(self.data):
+            for progtemp, rows in rejected_dict.items():
+                row_list_str = ', '.join(str(i + 1) for i in rows[:10])
 
-            progtemp = entry['PROGTEMP']
+                if len(rows) > 10:
+                    row_list_str += ', ...'
 
-            try:
-                obsmode = get_obsmode_from_progtemp(
-                    progtemp, progtemp_dict=progtemp_dict)
-            except:
-                obsmode = None
-
-            if obsmode == 'MOS':
-                mos_entry_list.append(entry)
-            else:
-                logging.warning('unexpected PROGTEMP in row {}: {}'.format(
-                    i + 1, progtemp))
-
-        # Generate the  XMLs
-        output_file_list = self._generate_mos_xmls(mos_entry_list,
-                                                   xml_template,
-                                                   progtemp_dict,
-                                                   obstemp_dict,
-                                                   output_dir=output_dir,
-                                                   prefix=prefix,
-                                                   suffix=suffix)
+                logging.warning(
+                    'unexpected PROGTEMP in {} rows: {} (rows {})'.format(
+                        len(rows), progtemp, row_list_str))
+
+            if len(rejected_dict) > 0:
+                logging.warning(
+                    '{} of {} rows rejected due to PROGTEMP'.format(
+                        np.sum(~mos_mask), len(mos_mask)))
+
+            mos_entry_list = self.data[mos_mask]
+
+            group_rows_list = _get_group_rows(mos_entry_list, _GROUP_ID)
+
+            select_span.add('fields', len(group_rows_list))
+
+        # Leave out the fields whose inputs have not changed since their XMLs
+        # were recorded in the manifest, and remove the XMLs of the fields
+        # which are not in the catalogue anymore
+
+        if manifest_file is not None:
+            manifest = Manifest(manifest_file)
+
+            common_hash = get_hash(
+                _get_tool_hash(), xml_datamver, get_file_hash(xml_template),
+                get_file_hash(progtemp_file)
+                if progtemp_file is not None else None,
+                get_file_hash(obstemp_file)
+                if obstemp_file is not None else None)
+
+            key_list = [
+                _get_group_key(mos_entry_list[group_rows[0]])
+                for group_rows in group_rows_list
+            ]
+            hash_list = [
+                _get_group_hash(mos_entry_list, group_rows, common_hash)
+                for group_rows in group_rows_list
+            ]
+
+            for key in set(manifest.keys()) - set(key_list):
+                manifest.remove(key)
+
+            todo_index_list = []
+
+            for i, (key, group_hash) in enumerate(zip(key_list, hash_list)):
+                if manifest.is_up_to_date(key, group_hash):
+                    continue
+
+                if key in manifest:
+                    manifest.remove(key)
+
+                todo_index_list.append(i)
+
+            logging.info('{} of {} MOS fields are up to date'.format(
+                len(group_rows_list) - len(todo_index_list),
+                len(group_rows_list)))
+        else:
+            todo_index_list = list(range(len(group_rows_list)))
+
+        # Generate the  XMLs, cloning the parsed template for each OB instead
+        # of parsing it again
+
+        with span('generate_xmls', workers=workers) as generate_span, \
+                xml_template_prototype.parse_from_memory(
+                    *_get_template_parsing_modules()):
+            new_output_file_list = self._generate_mos_xmls(
+                mos_entry_list,
+                xml_template,
+                progtemp_dict,
+                obstemp_dict,
+                output_dir=output_dir,
+                prefix=prefix,
+                suffix=suffix,
+                xml_template_prototype=xml_template_prototype,
+                workers=workers,
+                group_rows_list=[group_rows_list[i] for i in todo_index_list],
+                ob_callback=ob_callback)
+
+            generate_span.add('xmls_written', len(new_output_file_list))
+
+        # Record the new XMLs in the manifest
+
+        if manifest_file is not None:
+            for i, output_file in zip(todo_index_list, new_output_file_list):
+                manifest.set(key_list[i], hash_list[i], [output_file])
+
+            manifest.write()
+
+            output_file_list = [
+                manifest.get_output_files(key)[0] for key in key_list
+            ]
+        else:
+            output_file_list = new_output_file_list
 
         return output_file_list
 
@@ -180,7 +505,10 @@ def create_xml_files(mos_field_list,
                      prefix=None,
                      suffix='',
                      pass_datamver=False,
-                     overwrite=False):
+                     overwrite=False,
+                     workers=1,
+                     incremental=False,
+                     ob_callback=None):
     """
     Create XML files with targets from an MOS field list fits file.
 
@@ -205,6 +533,23 @@ def create_xml_files(mos_field_list,
         Continue even if DATAMVER mismatch is detected.
     overwrite : bool, optional
         Overwrite the output FITS file.
+    workers : int, optional
+        Number of processes used to generate the XML files in parallel. The
+        blank XML template and the definitions of PROGTEMP and OBSTEMP are sent
+        only once to each process, and the order of the output is kept.
+    incremental : bool, optional
+        Regenerate only the XML files of the fields whose inputs have changed
+        since the previous run, and remove those of the fields which are not in
+        the field list anymore. The inputs of each field (its rows, the XML
+        template, the PROGTEMP and OBSTEMP files and the code generating the
+        XMLs) are recorded with a hash in a JSON manifest written next to the
+        output files. Without a manifest, all the XML files are regenerated.
+    ob_callback : callable, optional
+        A function called with the name of each XML file generated and its
+        document just after writing it, so the OB can be processed further
+        without parsing the file. The document is None if the OB was not
+        built on a copy of the template served from memory. It cannot be
+        combined with workers > 1.
 
     Returns
     -------
@@ -215,14 +560,23 @@ def create_xml_files(mos_field_list,
     # Check that the input IFU driver cat exists and is a file
 
     assert os.path.isfile(mos_field_list)
+    assert workers >= 1
+    assert not (overwrite and incremental)
+    assert (ob_callback is None) or (workers == 1)
 
     # Create an object with the IFU driver cat
 
     mos_field_cat = _MOSFieldCat(mos_field_list)
 
-    # Remove the previous files if overwriting has been requested
+    # Remove the previous files if overwriting has been requested, or if they
+    # are not recorded in a manifest for an incremental run
+
+    if incremental:
+        manifest_file = _get_manifest_file(output_dir, prefix, suffix)
+    else:
+        manifest_file = None
 
-    if overwrite == True:
+    if overwrite or (incremental and not os.path.exists(manifest_file)):
         mos_field_cat.remove_xmls(output_dir=output_dir,
                                   prefix=prefix,
                                   suffix=suffix)
@@ -235,7 +589,10 @@ def create_xml_files(mos_field_list,
                                                    output_dir=output_dir,
                                                    prefix=prefix,
                                                    suffix=suffix,
-                                                   pass_datamver=pass_datamver)
+                                                   pass_datamver=pass_datamver,
+                                                   workers=workers,
+                                                   manifest_file=manifest_file,
+                                                   ob_callback=ob_callback)
 
     return output_file_list
 
@@ -285,6 +642,37 @@ if __name__ == '__main__':
                         action='store_true',
                         help='overwrite the output files')
 
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help="""regenerate only the output files of the fields
+                        whose inputs have changed since the previous run, as
+                        recorded in a manifest next to the output files""")
+
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help="""number of processes used to generate the XML
+                        files in parallel""")
+
+    parser.add_argument('--metrics_json',
+                        default=None,
+                        help="""write the wall time, CPU time, memory and
+                        counters of each step of the run to this JSON
+                        file""")
+
+    parser.add_argument('--profile',
+                        default=None,
+                        choices=['cprofile', 'sampling'],
+                        help="""profile the run with cProfile or by sampling
+                        its stack, writing a pstats or collapsed-stack file
+                        next to the output files and printing the functions
+                        with the largest cumulative time""")
+
+    parser.add_argument('--profile_top',
+                        default=20,
+                        type=int,
+                        help="""number of functions printed when profiling""")
+
     parser.add_argument('--log_level',
                         default='info',
                         choices=['debug', 'info', 'warning', 'error'],
@@ -315,11 +703,24 @@ if __name__ == '__main__':
         logging.info('Downloading the obstemp file')
         get_obstemp_file(file_path=args.obstemp_file)
 
-    create_xml_files(args.mos_field_list,
-                     args.output_dir,
-                     args.xml_template,
-                     progtemp_file=args.progtemp_file,
-                     obstemp_file=args.obstemp_file,
-                     prefix=args.prefix,
-                     pass_datamver=args.pass_datamver,
-                     overwrite=args.overwrite)
+    if args.metrics_json is not None:
+        enable_metrics()
+
+    try:
+        with StageProfiler(args.profile,
+                           os.path.join(args.output_dir, 'create_xml_files'),
+                           top=args.profile_top), \
+                span('create_xml_files'):
+            create_xml_files(args.mos_field_list,
+                             args.output_dir,
+                             args.xml_template,
+                             progtemp_file=args.progtemp_file,
+                             obstemp_file=args.obstemp_file,
+                             prefix=args.prefix,
+                             pass_datamver=args.pass_datamver,
+                             overwrite=args.overwrite,
+                             workers=args.jobs,
+                             incremental=args.incremental)
+    finally:
+        if args.metrics_json is not None:
+            write_metrics(args.metrics_json)
@@ -1,7 +1,12 @@
-from ._create_mos_target_cat_example import get_data_dict as \
-    _get_data_dict_for_example
-from ._create_mos_target_cat_example import set_keywords_info as \
-    _set_keywords_info_for_example
-from ._create_mos_target_cat_example import create_mos_target_cat as \
-    create_mos_target_cat
-from .add_targets_to_xmls import add_targets
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(
+    __name__, {
+        '_get_data_dict_for_example':
+        ('._create_mos_target_cat_example', 'get_data_dict'),
+        '_set_keywords_info_for_example':
+        ('._create_mos_target_cat_example', 'set_keywords_info'),
+        'create_mos_target_cat':
+        ('._create_mos_target_cat_example', 'create_mos_target_cat'),
+        'add_targets': ('.add_targets_to_xmls', 'add_targets')
+    })
@@ -19,12 +19,19 @@
 
 import argparse
 import logging
+import multiprocessing
 import os
+import tempfile
 import numpy as np
-from astropy.table import Table
-from astropy.coordinates import SkyCoord
 
-from ifu.workflow.utils.classes import OBXML
+from mos.workflow.utils import (CategoricalIndex, OBText, SkyIndex,
+                                TargetCatalogue)
+from mos.workflow.utils import TargetBlockWriter, TargetTextWriter
+from mos.workflow.utils.metrics import (add_records, enable_metrics,
+                                        get_start_wall_time,
+                                        init_worker_metrics, pop_records, span,
+                                        write_metrics)
+from mos.workflow.utils.profiling import StageProfiler
 
 
 def clean_xml_targets(ob_xml):
@@ -35,21 +42,411 @@ def clean_xml_targets(ob_xml):
                 field.removeChild(target)
 
 
+def _get_output_file(xml_file, output_dir):
+
+    # Choose the output filename depedending on the input filename
+
+    input_basename_wo_ext = os.path.splitext(os.path.basename(xml_file))[0]
+
+    if (input_basename_wo_ext.endswith('-t')
+            or input_basename_wo_ext.endswith('-')):
+        output_basename_wo_ext = input_basename_wo_ext + 't'
+    else:
+        output_basename_wo_ext = input_basename_wo_ext + '-t'
+
+    output_file = os.path.join(output_dir, output_basename_wo_ext + '.xml')
+
+    return output_file
+
+
+def _get_field_selection(ob_xml):
+
+    # Get the information of the OB which is used to select its targets
+
+    survey_list = [
+        element.getAttribute('name')
+        for element in ob_xml.surveys.getElementsByTagName('survey')
+    ]
+
+    field = ob_xml.fields.getElementsByTagName('field')[0]
+
+    field_selection = {
+        'surveys': survey_list,
+        'obstemp': ob_xml._get_obstemp(),
+        'progtemp': ob_xml._get_progtemp(),
+        'ra': float(field.getAttribute('RA_d')),
+        'dec': float(field.getAttribute('Dec_d'))
+    }
+
+    return field_selection
+
+
+def _get_field_selection_from_text(ob_text):
+
+    # Get the same information from an OB read with OBText
+
+    field_selection = {
+        'surveys': [survey.get('name', '') for survey in ob_text.surveys],
+        'obstemp': ob_text.observation.get('obstemp', ''),
+        'progtemp': ob_text.observation.get('progtemp', ''),
+        'ra': float(ob_text.fields[0]['RA_d']),
+        'dec': float(ob_text.fields[0]['Dec_d'])
+    }
+
+    return field_selection
+
+
+def _get_ob_xml(xml_file):
+
+    # Import OBXML here, since it loads matplotlib and it is only needed for
+    # the OBs whose layout cannot be handled as text
+
+    from ifu.workflow.utils.classes import OBXML
+
+    return OBXML(xml_file)
+
+
+def _read_ob(xml_file):
+
+    # Read only the parts of the OB used to add the targets, unless its layout
+    # needs reading the whole OB
+
+    try:
+        ob_text = OBText(xml_file)
+        field_selection = _get_field_selection_from_text(ob_text)
+    except (ValueError, KeyError, IndexError) as e:
+        logging.debug('Reading the whole OB of {}: {}'.format(xml_file, e))
+        return None, _get_field_selection(_get_ob_xml(xml_file))
+
+    return ob_text, field_selection
+
+
+def _select_targets(categorical_indices, sky_index, field_selection,
+                    max_radius):
+
+    # First find rows where TARGSRVY, PROGTEMP, OBSTEMP match since these are
+    # the only potential targets, looking them up in the inverted indices of
+    # these columns instead of comparing the whole columns
+
+    # Take the targets whose TARGSRVY is in the surveys element
+
+    rows = categorical_indices['TARGSRVY'].get_rows(
+        *field_selection['surveys'])
+
+    # Filter them comparing the values of the column OBSTEMP with the obstemp
+    # attribute of the XML
+
+    rows = np.intersect1d(
+        rows,
+        categorical_indices['OBSTEMP'].get_rows(field_selection['obstemp']),
+        assume_unique=True)
+
+    # Filter them comparing the values of the column PROGTEMP with the
+    # progtemp attribute of the XML
+
+    # rows = np.intersect1d(
+    #     rows,
+    #     categorical_indices['PROGTEMP'].get_rows(field_selection['progtemp']),
+    #     assume_unique=True) TODO we should filter on this when Sergey updates
+    # progtemp
+
+    # Then find targets that are inside the fov
+    rows = sky_index.query(field_selection['ra'],
+                           field_selection['dec'],
+                           max_radius,
+                           rows=rows)
+
+    return rows
+
+
+def _get_categorical_indices(catalogue):
+
+    categorical_indices = {
+        name: catalogue.get_categorical_index(name)
+        for name in ['TARGSRVY', 'OBSTEMP']
+    }
+
+    return categorical_indices
+
+
+def _select_targets_in_chunks(catalogue, field_selection_list, max_radius,
+                              chunk_size):
+
+    # Read the catalogue in blocks of rows and match every block against all
+    # the fields, so only one block of the selection columns is in memory
+
+    rows_list = [[] for field_selection in field_selection_list]
+
+    for start, columns in catalogue.iter_chunks(chunk_size):
+
+        categorical_indices = {
+            name: CategoricalIndex(columns[name])
+            for name in ['TARGSRVY', 'OBSTEMP']
+        }
+
+        sky_index = SkyIndex(columns['GAIA_RA'],
+                             columns['GAIA_DEC'],
+                             max_radius=max_radius)
+
+        for rows, field_selection in zip(rows_list, field_selection_list):
+            rows.append(start + _select_targets(categorical_indices, sky_index,
+                                                field_selection, max_radius))
+
+    rows_list = [
+        np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=int)
+        for rows in rows_list
+    ]
+
+    return rows_list
+
+
+def _select_rows(xml_file, field_selection, catalogue_list, max_radius):
+
+    # Select the rows of the targets of an OB in every catalogue
+
+    rows_list = []
+
+    with span('select_targets') as select_span:
+        for catalogue in catalogue_list:
+            rows = _select_targets(_get_categorical_indices(catalogue),
+                                   catalogue.sky_index, field_selection,
+                                   max_radius)
+
+            logging.info('Catalogue: {} Found {} targets for '
+                         '{}'.format(catalogue.filename, len(rows), xml_file))
+
+            select_span.add('targets_matched', len(rows))
+
+            rows_list.append(rows)
+
+    return rows_list
+
+
+def _get_ob_with_targets(xml_file,
+                         catalogue_list,
+                         max_radius,
+                         clean_targets,
+                         rows_list=None):
+
+    # Read the input file and add the targets from every catalogue, returning
+    # the writer of the OB with its targets
+
+    with span('read_ob'):
+        ob_text, field_selection = _read_ob(xml_file)
+
+    if rows_list is None:
+        rows_list = _select_rows(xml_file, field_selection, catalogue_list,
+                                 max_radius)
+
+    # And finally read the full rows of the targets and add them, to the text
+    # of the OB if its templates allow it or to the whole OB otherwise
+
+    with span('read_rows'):
+        table_list = [
+            catalogue.get_rows(rows)
+            for catalogue, rows in zip(catalogue_list, rows_list)
+        ]
+
+    with span('add_tables') as add_span:
+        writer = _add_tables_to_ob(xml_file, ob_text, table_list,
+                                   clean_targets)
+
+        add_span.add('targets_written',
+                     sum(len(table) for table in table_list))
+
+    return writer
+
+
+def _add_targets_to_ob_xml(ob_xml,
+                           xml_file,
+                           catalogue_list,
+                           max_radius,
+                           clean_targets,
+                           rows_list=None):
+
+    # Add the targets from every catalogue to the document of an OB read with
+    # OBXML, as target elements, so the OB can be handed over to stage 4
+    # without writing it and parsing it again
+
+    if rows_list is None:
+        rows_list = _select_rows(xml_file, _get_field_selection(ob_xml),
+                                 catalogue_list, max_radius)
+
+    with span('read_rows'):
+        table_list = [
+            catalogue.get_rows(rows)
+            for catalogue, rows in zip(catalogue_list, rows_list)
+        ]
+
+    with span('add_tables') as add_span:
+        for table in table_list:
+            if len(table) > 0:
+                ob_xml._add_table_as_targets(table)
+
+        if clean_targets:
+            clean_xml_targets(ob_xml)
+
+        add_span.add('targets_written',
+                     sum(len(table) for table in table_list))
+
+
+def _add_tables_to_ob(xml_file, ob_text, table_list, clean_targets):
+
+    # Add the tables of targets to the OB, returning its writer
+
+    writer = None
+
+    if ob_text is not None:
+        writer = TargetTextWriter(ob_text)
+
+        try:
+            for table in table_list:
+                writer.add_table(table)
+        except ValueError as e:
+            logging.debug('Reading the whole OB of {}: {}'.format(
+                xml_file, e))
+            writer = None
+
+    if writer is None:
+        writer = TargetBlockWriter(_get_ob_xml(xml_file))
+
+        for table in table_list:
+            writer.add_table(table)
+
+    if clean_targets:
+        writer.clean_targets()
+
+    return writer
+
+
+def _add_targets_to_xml(xml_file,
+                        output_file,
+                        catalogue_list,
+                        max_radius,
+                        clean_targets,
+                        compact_xml=False,
+                        rows_list=None):
+
+    # Read the input file, add the targets from every catalogue and write it to
+    # the output file
+
+    with span('process_ob', xml_file=xml_file):
+        writer = _get_ob_with_targets(xml_file,
+                                      catalogue_list,
+                                      max_radius,
+                                      clean_targets,
+                                      rows_list=rows_list)
+
+        with span('write_ob'):
+            writer.write_xml(output_file, compact=compact_xml)
+
+    return output_file
+
+
+# The state of each worker process of the pool used by add_targets
+_worker_state = {}
+
+
+def _init_worker(target_cat_list, columns_dir_list, max_radius,
+                 clean_targets, compact_xml, start_wall_time):
+
+    # Open the catalogues once per worker, sharing the selection columns and
+    # the sky indices saved by the parent process through memory maps, and
+    # record the metrics of the worker if the parent process records them
+
+    init_worker_metrics(start_wall_time)
+
+    _worker_state['catalogue_list'] = [
+        TargetCatalogue(filename, max_radius=max_radius,
+                        columns_dir=columns_dir)
+        for filename, columns_dir in zip(target_cat_list, columns_dir_list)
+    ]
+    _worker_state['max_radius'] = max_radius
+    _worker_state['clean_targets'] = clean_targets
+    _worker_state['compact_xml'] = compact_xml
+
+
+def _add_targets_to_xml_in_worker(todo):
+
+    xml_file, output_file = todo
+
+    output_file = _add_targets_to_xml(
+        xml_file,
+        output_file,
+        _worker_state['catalogue_list'],
+        _worker_state['max_radius'],
+        _worker_state['clean_targets'],
+        compact_xml=_worker_state['compact_xml'])
+
+    return output_file, pop_records()
+
+
+def _add_targets_in_pool(todo_list, catalogue_list, max_radius, clean_targets,
+                         compact_xml, workers):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # Save the selection columns and sky indices once, so the workers can
+        # memory-map them instead of receiving a copy, unless they are already
+        # in the cache of the catalogue
+
+        columns_dir_list = []
+
+        for i, catalogue in enumerate(catalogue_list):
+            if catalogue.columns_dir is not None:
+                columns_dir_list.append(catalogue.columns_dir)
+                continue
+
+            columns_dir = os.path.join(tmp_dir, str(i))
+            os.mkdir(columns_dir)
+
+            catalogue.save_columns(columns_dir)
+
+            columns_dir_list.append(columns_dir)
+
+        target_cat_list = [catalogue.filename for catalogue in catalogue_list]
+
+        pool = multiprocessing.Pool(processes=workers,
+                                    initializer=_init_worker,
+                                    initargs=(target_cat_list,
+                                              columns_dir_list, max_radius,
+                                              clean_targets, compact_xml,
+                                              get_start_wall_time()))
+
+        try:
+            result_list = pool.map(_add_targets_to_xml_in_worker,
+                                   todo_list,
+                                   chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Merge the metrics of the OBs recorded by the workers
+
+        for output_file, record_list in result_list:
+            add_records(record_list)
+
+
 def add_targets(xml_file_list,
                 target_cat,
                 output_dir,
                 max_radius=1.0,
                 clean_targets=True,
-                overwrite=False):
+                overwrite=False,
+                chunk_size=None,
+                workers=1,
+                compact_xml=False,
+                cache_catalogues=False):
     """
-    Add guide and calib stars to XML files.
+    Add targets from one or more catalogues to XML files.
 
     Parameters
     ----------
     xml_file_list : list of str
         A list of input OB XML files.
-    target_cat :  str
-        The filename of the catalogue to be added
+    target_cat :  str or list of str
+        The filename of the catalogue to be added, or a list of catalogues
+        whose targets will be added to each XML in a single pass.
     output_dir : str
         Name of the directory which will containe the output XML files.
     max_radius : float
@@ -58,6 +455,23 @@ def add_targets(xml_file_list,
         Remove template targets from the XML.
     overwrite : bool, optional
         Overwrite the output FITS file.
+    chunk_size : int, optional
+        Read the catalogues in blocks of this number of rows, matching each
+        block against all the XML files, instead of reading the columns used
+        for the selection at once. This bounds the memory used for catalogues
+        larger than the available RAM. The output is the same in both modes.
+    workers : int, optional
+        Number of processes used to add the targets to the XML files in
+        parallel. It cannot be combined with chunk_size.
+    compact_xml : bool, optional
+        Drop the comments with the documentation of the template from the
+        output XML files.
+    cache_catalogues : bool, optional
+        Keep the columns used to select the targets, their indices and the
+        unit vectors of the coordinates of each catalogue in a cache next to
+        it, so later runs memory-map them instead of decoding the FITS file.
+        The cache is written by the first run and rebuilt when the catalogue
+        changes.
 
     Returns
     -------
@@ -65,34 +479,33 @@ def add_targets(xml_file_list,
         A list with the output XML files.
     """
 
+    assert workers >= 1
+
+    if (chunk_size is not None) and (workers > 1):
+        raise ValueError('chunk_size cannot be combined with workers > 1')
+
     output_file_list = []
 
     xml_file_list.sort()
 
-    # Load our catalogue and compute coordinates since this is common to all
-    # fields
-    catalogue = Table.read(target_cat)
-    catalogue_coords = SkyCoord(ra=catalogue['GAIA_RA'],
-                                dec=catalogue['GAIA_DEC'],
-                                unit='deg')
+    # Accept a single catalogue as well as a list of them
 
-    for xml_file in xml_file_list:
+    if isinstance(target_cat, str):
+        target_cat_list = [target_cat]
+    else:
+        target_cat_list = list(target_cat)
 
-        # Check that the input XML exists and is a file
+    # Choose the XML files to process
 
-        assert os.path.isfile(xml_file)
+    todo_list = []
 
-        # Choose the output filename depedending on the input filename
+    for xml_file in xml_file_list:
 
-        input_basename_wo_ext = os.path.splitext(os.path.basename(xml_file))[0]
+        # Check that the input XML exists and is a file
 
-        if (input_basename_wo_ext.endswith('-t')
-                or input_basename_wo_ext.endswith('-')):
-            output_basename_wo_ext = input_basename_wo_ext + 't'
-        else:
-            output_basename_wo_ext = input_basename_wo_ext + '-t'
+        assert os.path.isfile(xml_file)
 
-        output_file = os.path.join(output_dir, output_basename_wo_ext + '.xml')
+        output_file = _get_output_file(xml_file, output_dir)
 
         # Save the output filename for the result
 
@@ -111,52 +524,85 @@ def add_targets(xml_file_list,
                         xml_file, output_file))
                 continue
 
-        # Read the input file, add the guide and calib stars and write it to the
-        # output file
+        todo_list.append((xml_file, output_file))
 
-        ob_xml = OBXML(xml_file)
+    # Open our catalogues, which will only read the columns needed to select
+    # the targets, and index their coordinates since this is common to all
+    # fields
 
-        # First find rows where TARGSRVY, PROGTEMP, OBSTEMP match since these
-        # are the only potential targets
-        # Let's start creating a mask without any filter
+    with span('open_catalogues'):
+        catalogue_list = [
+            TargetCatalogue(filename,
+                            max_radius=max_radius,
+                            cache=cache_catalogues)
+            for filename in target_cat_list
+        ]
 
-        mask = np.zeros(len(catalogue), dtype=bool)
-        # Add to the mask only those targets whose TARGSRVY is in the surveys
-        # element
-        for element in ob_xml.surveys.getElementsByTagName('survey'):
-            mask += (catalogue['TARGSRVY'] == element.getAttribute('name'))
+    if (chunk_size is None) and (workers == 1):
 
-        # Filter FITS data comparing the values of the column OBSTEMP with the
-        # obstemp attribute of the XML
+        # Build the indices before the first OB, so their time is not counted
+        # as part of it
 
-        obstemp = ob_xml._get_obstemp()
-        mask *= (catalogue['OBSTEMP'] == obstemp)
+        if len(todo_list) > 0:
+            with span('index_catalogues'):
+                for catalogue in catalogue_list:
+                    _get_categorical_indices(catalogue)
+                    catalogue.sky_index
 
-        # Filter FITS data comparing the values of the column PROGTEMP with the
-        # progtemp attribute of the XML
+        for xml_file, output_file in todo_list:
+            _add_targets_to_xml(xml_file,
+                                output_file,
+                                catalogue_list,
+                                max_radius,
+                                clean_targets,
+                                compact_xml=compact_xml)
 
-        progtemp = ob_xml._get_progtemp()
-        #mask *= (catalogue['PROGTEMP'] == progtemp) TODO we should filter on
-        # this when Sergey updates progtemp
+    elif chunk_size is None:
 
-        # Then find targets that are inside the fov
-        field = ob_xml.fields.getElementsByTagName('field')[0]
-        field_ra = field.getAttribute('RA_d')
-        field_dec = field.getAttribute('Dec_d')
-        field_center_coords = SkyCoord(ra=field_ra, dec=field_dec, unit='deg')
+        with span('add_targets_in_pool', workers=workers):
+            _add_targets_in_pool(todo_list, catalogue_list, max_radius,
+                                 clean_targets, compact_xml, workers)
 
-        offset = field_center_coords.separation(catalogue_coords[mask]).deg
-        mask[mask] *= (offset <= max_radius)
-        logging.info('Catalogue: {} Found {} targets for '
-                     '{}'.format(target_cat, mask.sum(), xml_file))
+    else:
 
-        # And finally add them
-        ob_xml._add_table_as_targets(catalogue[mask])
+        # Match the catalogues in blocks against the fields of all the input
+        # files, and then add the targets to each file
 
-        if clean_targets:
-            clean_xml_targets(ob_xml)
+        with span('select_targets_in_chunks') as select_span:
+            field_selection_list = [
+                _read_ob(xml_file)[1] for xml_file, output_file in todo_list
+            ]
+
+            rows_list_list = [[] for todo in todo_list]
+
+            for catalogue in catalogue_list:
+                rows_list = _select_targets_in_chunks(catalogue,
+                                                      field_selection_list,
+                                                      max_radius, chunk_size)
+
+                for (xml_file, output_file), rows, ob_rows_list in zip(
+                        todo_list, rows_list, rows_list_list):
+
+                    logging.info('Catalogue: {} Found {} targets for '
+                                 '{}'.format(catalogue.filename, len(rows),
+                                             xml_file))
+
+                    select_span.add('targets_matched', len(rows))
 
-        ob_xml.write_xml(output_file)
+                    ob_rows_list.append(rows)
+
+        for (xml_file, output_file), ob_rows_list in zip(
+                todo_list, rows_list_list):
+            _add_targets_to_xml(xml_file,
+                                output_file,
+                                catalogue_list,
+                                max_radius,
+                                clean_targets,
+                                compact_xml=compact_xml,
+                                rows_list=ob_rows_list)
+
+    for catalogue in catalogue_list:
+        catalogue.close()
 
     return output_file_list
 
@@ -186,6 +632,19 @@ if __name__ == '__main__':
                         help="""Add targets within these degrees of the 
                         field center""")
 
+    parser.add_argument('--chunk_size',
+                        default=None,
+                        type=int,
+                        help="""read the catalogues in blocks of this number of
+                        rows, to process catalogues larger than the
+                        memory""")
+
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help="""number of processes used to add the targets to
+                        the XML files in parallel""")
+
     parser.add_argument('--overwrite',
                         action='store_true',
                         help='overwrite the output files')
@@ -194,6 +653,36 @@ if __name__ == '__main__':
                         action='store_true',
                         help="""Remove any template targets""")
 
+    parser.add_argument('--compact_xml',
+                        action='store_true',
+                        help="""drop the comments with the documentation of
+                        the template from the output files""")
+
+    parser.add_argument('--cache_catalogues',
+                        action='store_true',
+                        help="""keep the columns used to select the targets in
+                        a cache next to each catalogue, which is memory-mapped
+                        by later runs instead of decoding the FITS file""")
+
+    parser.add_argument('--metrics_json',
+                        default=None,
+                        help="""write the wall time, CPU time, memory and
+                        counters of each step of the run to this JSON
+                        file""")
+
+    parser.add_argument('--profile',
+                        default=None,
+                        choices=['cprofile', 'sampling'],
+                        help="""profile the run with cProfile or by sampling
+                        its stack, writing a pstats or collapsed-stack file
+                        next to the output files and printing the functions
+                        with the largest cumulative time""")
+
+    parser.add_argument('--profile_top',
+                        default=20,
+                        type=int,
+                        help="""number of functions printed when profiling""")
+
     parser.add_argument('--log_level',
                         default='info',
                         choices=['debug', 'info', 'warning', 'error'],
@@ -201,22 +690,36 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if (args.chunk_size is not None) and (args.jobs > 1):
+        parser.error('--chunk_size cannot be combined with --jobs > 1')
+
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
     if not os.path.exists(args.output_dir):
         logging.info('Creating the output directory')
         os.mkdir(args.output_dir)
 
-    for i, target_cat in enumerate(args.catalogues):
-        # Clean after adding the last catalogue if we were asked to
-        if (i == len(args.catalogues) - 1) and args.clean:
-            clean = True
-        else:
-            clean = False
-
-        add_targets(xml_file_list=args.xml_file,
-                    target_cat=target_cat,
-                    output_dir=args.output_dir,
-                    max_radius=args.max_radius,
-                    clean_targets=clean,
-                    overwrite=args.overwrite)
+    # Add the targets of all the catalogues in a single pass, so each XML is
+    # read and written only once
+
+    if args.metrics_json is not None:
+        enable_metrics()
+
+    try:
+        with StageProfiler(args.profile,
+                           os.path.join(args.output_dir, 'add_targets'),
+                           top=args.profile_top), \
+                span('add_targets'):
+            add_targets(xml_file_list=args.xml_file,
+                        target_cat=args.catalogues,
+                        output_dir=args.output_dir,
+                        max_radius=args.max_radius,
+                        clean_targets=args.clean,
+                        overwrite=args.overwrite,
+                        chunk_size=args.chunk_size,
+                        workers=args.jobs,
+                        compact_xml=args.compact_xml,
+                        cache_catalogues=args.cache_catalogues)
+    finally:
+        if args.metrics_json is not None:
+            write_metrics(args.metrics_json)
@@ -1 +1,9 @@
-from .add_guide_and_calib_stars import add_guide_and_calib_stars
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(
+    __name__, {
+        'add_guide_and_calib_stars':
+        ('.add_guide_and_calib_stars', 'add_guide_and_calib_stars'),
+        'render_deferred_plots':
+        ('.render_deferred_plots', 'render_deferred_plots')
+    })
@@ -18,10 +18,247 @@
 #
 
 import argparse
+import json
 import logging
 import os
+import tempfile
 
-from ifu.workflow.utils.classes import OBXML
+from mos.workflow.utils import XMLStreamWriter
+from mos.workflow.utils.metrics import enable_metrics, span, write_metrics
+from mos.workflow.utils.profiling import StageProfiler
+
+
+# The columns with the coordinates of the stars in the tables of potentially
+# useful stars, in order of preference
+
+_COORD_COLUMNS = [('GAIA_RA', 'GAIA_DEC'), ('RA', 'DEC'), ('ra', 'dec'),
+                  ('RAJ2000', 'DEJ2000'), ('RA_d', 'Dec_d')]
+
+
+def _get_targets(ob_xml):
+
+    return list(ob_xml.fields.getElementsByTagName('target'))
+
+
+def _get_chosen_stars(target_list, targuse):
+
+    # Get the positions of the stars of a type among some target elements
+
+    target_list = [
+        target for target in target_list
+        if target.getAttribute('targuse') == targuse
+    ]
+
+    stars = {
+        'targid': [target.getAttribute('targid') for target in target_list],
+        'ra': [float(target.getAttribute('targra')) for target in target_list],
+        'dec':
+        [float(target.getAttribute('targdec')) for target in target_list]
+    }
+
+    return stars
+
+
+def _read_candidate_stars(table_filename):
+
+    # Get the positions of the stars in a table of potentially useful stars,
+    # or None if they are not available
+
+    from astropy.table import Table
+
+    if (table_filename is None) or (not os.path.exists(table_filename)):
+        logging.warning('No table of candidate stars for the plots: {}'.format(
+            table_filename))
+        return None
+
+    table = Table.read(table_filename)
+
+    for ra_column, dec_column in _COORD_COLUMNS:
+        if (ra_column in table.colnames) and (dec_column in table.colnames):
+            stars = {
+                'ra': [float(value) for value in table[ra_column]],
+                'dec': [float(value) for value in table[dec_column]]
+            }
+
+            return stars
+
+    logging.warning('No coordinates found in {}'.format(table_filename))
+
+    return None
+
+
+def _write_plot_sidecar(sidecar_filename, xml_file, ob_xml, new_target_list,
+                        guide_plot_filename, guide_useful_table_filename,
+                        calib_plot_filename, calib_useful_table_filename,
+                        max_radius):
+
+    # Record the inputs of the plots, i.e. the center of the field, the radii
+    # used to select the stars and the candidate and chosen stars, so they can
+    # be rendered later with render_deferred_plots without selecting the stars
+    # again
+
+    field = ob_xml.fields.getElementsByTagName('field')[0]
+
+    plot_inputs = {
+        'xml_file': os.path.abspath(xml_file),
+        'field_center': {
+            'ra': float(field.getAttribute('RA_d')),
+            'dec': float(field.getAttribute('Dec_d'))
+        },
+        'max_radius': max_radius,
+        'guide': {
+            'plot_filename': os.path.abspath(guide_plot_filename),
+            'min_radius': 0,
+            'candidates': _read_candidate_stars(guide_useful_table_filename),
+            'chosen': _get_chosen_stars(new_target_list, 'G')
+        },
+        'calib': {
+            'plot_filename': os.path.abspath(calib_plot_filename),
+            'min_radius': 0,
+            'candidates': _read_candidate_stars(calib_useful_table_filename),
+            'chosen': _get_chosen_stars(new_target_list, 'C')
+        }
+    }
+
+    with open(sidecar_filename, 'w') as f:
+        json.dump(plot_inputs, f, sort_keys=True)
+
+
+def _get_output_files(xml_file, output_dir, write_useful_tables=False):
+
+    # Choose the output filename depedending on the input filename
+
+    input_basename_wo_ext = os.path.splitext(os.path.basename(xml_file))[0]
+
+    if (input_basename_wo_ext.endswith('-t')
+            or input_basename_wo_ext.endswith('-')):
+        output_basename_wo_ext = input_basename_wo_ext + 'gc'
+    else:
+        output_basename_wo_ext = input_basename_wo_ext + '-gc'
+
+    output_file = os.path.join(output_dir, output_basename_wo_ext + '.xml')
+    guide_plot_filename = os.path.join(
+        output_dir, output_basename_wo_ext + '-guide_stars.png')
+    calib_plot_filename = os.path.join(
+        output_dir, output_basename_wo_ext + '-calib_stars.png')
+    plot_sidecar_filename = os.path.join(
+        output_dir, output_basename_wo_ext + '-plots.json')
+
+    if write_useful_tables is True:
+        guide_useful_table_filename = os.path.join(
+            output_dir, output_basename_wo_ext + '-useful_guide_stars.fits')
+        calib_useful_table_filename = os.path.join(
+            output_dir, output_basename_wo_ext + '-useful_calib_stars.fits')
+    else:
+        guide_useful_table_filename = None
+        calib_useful_table_filename = None
+
+    return (output_file, guide_plot_filename, guide_useful_table_filename,
+            calib_plot_filename, calib_useful_table_filename,
+            plot_sidecar_filename)
+
+
+def _remove_previous_files(filename_list):
+
+    for filename in filename_list:
+        if (filename is not None) and os.path.exists(filename):
+            logging.info('Removing previous file: {}'.format(filename))
+            os.remove(filename)
+
+
+def _select_stars(ob_xml,
+                  guide_plot_filename,
+                  guide_useful_table_filename,
+                  calib_plot_filename,
+                  calib_useful_table_filename,
+                  num_calib_stars_request=None,
+                  num_guide_stars_request=25,
+                  max_radius=1.0,
+                  plot_mode='inline'):
+
+    # The plots are rendered by the same call which selects the stars, so
+    # their time is part of this span when plot_mode is 'inline'
+
+    with span('select_guide_and_calib_stars', plot_mode=plot_mode):
+        ob_xml.add_guide_and_calib_stars(
+            guide_plot_filename=guide_plot_filename,
+            guide_useful_table_filename=guide_useful_table_filename,
+            calib_plot_filename=calib_plot_filename,
+            calib_useful_table_filename=calib_useful_table_filename,
+            mos_num_guide_stars_stars_request=num_guide_stars_request,
+            num_calib_stars_request=num_calib_stars_request,
+            min_calib_cut=0,
+            max_calib_cut=max_radius)
+
+
+def _add_guide_and_calib_stars_to_ob(ob_xml,
+                                     xml_file,
+                                     output_file,
+                                     guide_plot_filename,
+                                     guide_useful_table_filename,
+                                     calib_plot_filename,
+                                     calib_useful_table_filename,
+                                     plot_sidecar_filename,
+                                     num_calib_stars_request=None,
+                                     num_guide_stars_request=25,
+                                     max_radius=1.0,
+                                     plot_mode='inline',
+                                     compact_xml=False):
+
+    select_kwargs = {
+        'num_calib_stars_request': num_calib_stars_request,
+        'num_guide_stars_request': num_guide_stars_request,
+        'max_radius': max_radius,
+        'plot_mode': plot_mode
+    }
+
+    # Add the guide and calib stars, rendering the plots now or recording
+    # their inputs to render them later
+
+    if plot_mode == 'deferred':
+
+        # The tables of potentially useful stars are the candidates of the
+        # plots, so they are written to a temporary directory if they have not
+        # been requested
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if guide_useful_table_filename is None:
+                guide_useful_table_filename = os.path.join(
+                    tmp_dir, 'guide_stars.fits')
+
+            if calib_useful_table_filename is None:
+                calib_useful_table_filename = os.path.join(
+                    tmp_dir, 'calib_stars.fits')
+
+            previous_target_set = set(_get_targets(ob_xml))
+
+            _select_stars(ob_xml, None, guide_useful_table_filename, None,
+                          calib_useful_table_filename, **select_kwargs)
+
+            new_target_list = [
+                target for target in _get_targets(ob_xml)
+                if target not in previous_target_set
+            ]
+
+            _write_plot_sidecar(plot_sidecar_filename, xml_file, ob_xml,
+                                new_target_list, guide_plot_filename,
+                                guide_useful_table_filename,
+                                calib_plot_filename,
+                                calib_useful_table_filename, max_radius)
+    else:
+        if plot_mode == 'none':
+            guide_plot_filename = None
+            calib_plot_filename = None
+
+        _select_stars(ob_xml, guide_plot_filename, guide_useful_table_filename,
+                      calib_plot_filename, calib_useful_table_filename,
+                      **select_kwargs)
+
+    # Write the OB to the output file
+
+    with span('write_ob'):
+        XMLStreamWriter(ob_xml.fields.ownerDocument,
+                        compact=compact_xml).write(output_file)
 
 
 def add_guide_and_calib_stars(xml_file_list,
@@ -30,7 +267,9 @@ def add_guide_and_calib_stars(xml_file_list,
                               num_guide_stars_request=25,
                               write_useful_tables=False,
                               overwrite=False,
-                              max_radius=1.0):
+                              max_radius=1.0,
+                              plot_mode='inline',
+                              compact_xml=False):
     """
     Add guide and calib stars to XML files.
     
@@ -49,6 +288,18 @@ def add_guide_and_calib_stars(xml_file_list,
         each OB XML file.
     overwrite : bool, optional
         Overwrite the output FITS file.
+    plot_mode : {'inline', 'none', 'deferred'}, optional
+        How to produce the diagnostic plots of the guide and calib stars:
+        'inline' renders them while adding the stars, 'none' skips them, and
+        'deferred' writes a small JSON file with the inputs of the plots of
+        each OB (the center of the field, the radii and the candidate and
+        chosen stars), which can be rendered later with render_deferred_plots
+        without selecting the stars again. The deferred plots are drawn by
+        this package and not by the IFU workflow, so they show the same stars
+        but are not the same images as the inline ones.
+    compact_xml : bool, optional
+        Drop the comments with the documentation of the template from the
+        output XML files.
 
     Returns
     -------
@@ -56,7 +307,15 @@ def add_guide_and_calib_stars(xml_file_list,
         A list with the output XML files.
     """
 
+    # Import OBXML here, since it loads matplotlib, which makes importing this
+    # module slow
+
+    from ifu.workflow.utils.classes import OBXML
+
+    assert plot_mode in ['inline', 'none', 'deferred']
+
     output_file_list = []
+    todo_list = []
 
     xml_file_list.sort()
 
@@ -66,32 +325,10 @@ def add_guide_and_calib_stars(xml_file_list,
 
         assert os.path.isfile(xml_file)
 
-        # Choose the output filename depedending on the input filename
-
-        input_basename_wo_ext = os.path.splitext(os.path.basename(xml_file))[0]
-
-        if (input_basename_wo_ext.endswith('-t')
-                or input_basename_wo_ext.endswith('-')):
-            output_basename_wo_ext = input_basename_wo_ext + 'gc'
-        else:
-            output_basename_wo_ext = input_basename_wo_ext + '-gc'
-
-        output_file = os.path.join(output_dir, output_basename_wo_ext + '.xml')
-        guide_plot_filename = os.path.join(
-            output_dir, output_basename_wo_ext + '-guide_stars.png')
-        calib_plot_filename = os.path.join(
-            output_dir, output_basename_wo_ext + '-calib_stars.png')
-
-        if write_useful_tables is True:
-            guide_useful_table_filename = os.path.join(
-                output_dir,
-                output_basename_wo_ext + '-useful_guide_stars.fits')
-            calib_useful_table_filename = os.path.join(
-                output_dir,
-                output_basename_wo_ext + '-useful_calib_stars.fits')
-        else:
-            guide_useful_table_filename = None
-            calib_useful_table_filename = None
+        (output_file, guide_plot_filename, guide_useful_table_filename,
+         calib_plot_filename, calib_useful_table_filename,
+         plot_sidecar_filename) = _get_output_files(xml_file, output_dir,
+                                                    write_useful_tables)
 
         # Save the output filename for the result
 
@@ -102,18 +339,11 @@ def add_guide_and_calib_stars(xml_file_list,
 
         if os.path.exists(output_file):
             if overwrite == True:
-                logging.info('Removing previous file: {}'.format(output_file))
-                os.remove(output_file)
-
-                for filename in [
-                        guide_plot_filename, calib_plot_filename,
-                        guide_useful_table_filename,
-                        calib_useful_table_filename
-                ]:
-                    if (filename is not None) and os.path.exists(filename):
-                        logging.info(
-                            'Removing previous file: {}'.format(filename))
-                        os.remove(filename)
+                _remove_previous_files([
+                    output_file, guide_plot_filename, calib_plot_filename,
+                    plot_sidecar_filename, guide_useful_table_filename,
+                    calib_useful_table_filename
+                ])
 
             else:
                 logging.info(
@@ -121,22 +351,36 @@ def add_guide_and_calib_stars(xml_file_list,
                         xml_file, output_file))
                 continue
 
-        # Read the input file, add the guide and calib stars and write it to the
-        # output file
-
-        ob_xml = OBXML(xml_file)
-
-        ob_xml.add_guide_and_calib_stars(
-            guide_plot_filename=guide_plot_filename,
-            guide_useful_table_filename=guide_useful_table_filename,
-            calib_plot_filename=calib_plot_filename,
-            calib_useful_table_filename=calib_useful_table_filename,
-            mos_num_guide_stars_stars_request=num_guide_stars_request,
-            num_calib_stars_request=num_calib_stars_request,
-            min_calib_cut=0,
-            max_calib_cut=max_radius)
-
-        ob_xml.write_xml(output_file)
+        todo_list.append(
+            (xml_file, output_file, guide_plot_filename,
+             guide_useful_table_filename, calib_plot_filename,
+             calib_useful_table_filename, plot_sidecar_filename))
+
+    for (xml_file, output_file, guide_plot_filename,
+         guide_useful_table_filename, calib_plot_filename,
+         calib_useful_table_filename, plot_sidecar_filename) in todo_list:
+
+        # Read the input file, add the guide and calib stars and write it to
+        # the output file
+
+        with span('process_ob', xml_file=xml_file):
+            with span('read_ob'):
+                ob_xml = OBXML(xml_file)
+
+            _add_guide_and_calib_stars_to_ob(
+                ob_xml,
+                xml_file,
+                output_file,
+                guide_plot_filename,
+                guide_useful_table_filename,
+                calib_plot_filename,
+                calib_useful_table_filename,
+                plot_sidecar_filename,
+                num_calib_stars_request=num_calib_stars_request,
+                num_guide_stars_request=num_guide_stars_request,
+                max_radius=max_radius,
+                plot_mode=plot_mode,
+                compact_xml=compact_xml)
 
     return output_file_list
 
@@ -175,10 +419,43 @@ if __name__ == '__main__':
                         position of the location in the sky of each OB XML
                         file""")
 
+    parser.add_argument('--plot_mode',
+                        default='inline',
+                        choices=['inline', 'none', 'deferred'],
+                        help="""how to produce the plots of the guide and calib
+                        stars: render them now, skip them, or record their
+                        inputs to render them later with
+                        render_deferred_plots.py, which draws its own plots
+                        instead of those of the IFU workflow""")
+
     parser.add_argument('--overwrite',
                         action='store_true',
                         help='overwrite the output files')
 
+    parser.add_argument('--compact_xml',
+                        action='store_true',
+                        help="""drop the comments with the documentation of
+                        the template from the output files""")
+
+    parser.add_argument('--metrics_json',
+                        default=None,
+                        help="""write the wall time, CPU time, memory and
+                        counters of each step of the run to this JSON
+                        file""")
+
+    parser.add_argument('--profile',
+                        default=None,
+                        choices=['cprofile', 'sampling'],
+                        help="""profile the run with cProfile or by sampling
+                        its stack, writing a pstats or collapsed-stack file
+                        next to the output files and printing the functions
+                        with the largest cumulative time""")
+
+    parser.add_argument('--profile_top',
+                        default=20,
+                        type=int,
+                        help="""number of functions printed when profiling""")
+
     parser.add_argument('--log_level',
                         default='info',
                         choices=['debug', 'info', 'warning', 'error'],
@@ -202,10 +479,25 @@ if __name__ == '__main__':
     else:
         num_guide_stars_request = None
 
-
-    add_guide_and_calib_stars(args.xml_file,
-                              args.output_dir,
-                              num_calib_stars_request=num_calib_stars_request,
-                              num_guide_stars_request=num_guide_stars_request,
-                              write_useful_tables=args.write_useful_tables,
-                              overwrite=args.overwrite)
+    if args.metrics_json is not None:
+        enable_metrics()
+
+    profile_prefix = os.path.join(args.output_dir,
+                                  'add_guide_and_calib_stars')
+
+    try:
+        with StageProfiler(args.profile, profile_prefix,
+                           top=args.profile_top), \
+                span('add_guide_and_calib_stars'):
+            add_guide_and_calib_stars(
+                args.xml_file,
+                args.output_dir,
+                num_calib_stars_request=num_calib_stars_request,
+                num_guide_stars_request=num_guide_stars_request,
+                write_useful_tables=args.write_useful_tables,
+                overwrite=args.overwrite,
+                plot_mode=args.plot_mode,
+                compact_xml=args.compact_xml)
+    finally:
+        if args.metrics_json is not None:
+            write_metrics(args.metrics_json)
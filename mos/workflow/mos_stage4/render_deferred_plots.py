@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+import matplotlib
+import numpy as np
+
+
+def _init_worker():
+
+    # Render the plots without any display
+
+    matplotlib.use('Agg')
+
+
+def _get_offsets(stars, field_center):
+
+    # Get the offsets in degrees of some stars from the center of the field,
+    # with the offset in RA scaled to the declination of the center
+
+    ra = np.asarray(stars['ra'], dtype=float)
+    dec = np.asarray(stars['dec'], dtype=float)
+
+    x = (((ra - field_center['ra'] + 180.) % 360.) - 180.) * np.cos(
+        np.radians(field_center['dec']))
+    y = dec - field_center['dec']
+
+    return x, y
+
+
+def _plot_stars(plot_filename, star_inputs, field_center, max_radius, title):
+
+    # Plot the candidate and chosen stars around the center of the field
+
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(6, 6))
+
+    if star_inputs['candidates'] is not None:
+        x, y = _get_offsets(star_inputs['candidates'], field_center)
+        ax.plot(x, y, '.', color='0.6', markersize=2, label='candidates')
+
+    x, y = _get_offsets(star_inputs['chosen'], field_center)
+    ax.plot(x, y, 'o', markerfacecolor='none', color='C3', label='chosen')
+
+    ax.plot([0], [0], '+', color='k')
+
+    theta = np.linspace(0, 2 * np.pi, 361)
+
+    for radius in [star_inputs['min_radius'], max_radius]:
+        if radius > 0:
+            ax.plot(radius * np.cos(theta), radius * np.sin(theta), '-',
+                    color='k', linewidth=0.5)
+
+    # East is to the left
+
+    ax.set_xlim(1.1 * max_radius, -1.1 * max_radius)
+    ax.set_ylim(-1.1 * max_radius, 1.1 * max_radius)
+    ax.set_aspect('equal')
+
+    ax.set_xlabel('RA offset (deg)')
+    ax.set_ylabel('Dec offset (deg)')
+    ax.set_title(title)
+    ax.legend(loc='upper right')
+
+    fig.savefig(plot_filename)
+    plt.close(fig)
+
+
+def _render_plots(sidecar_filename):
+
+    with open(sidecar_filename) as f:
+        plot_inputs = json.load(f)
+
+    logging.info('Rendering the plots of {}'.format(plot_inputs['xml_file']))
+
+    # Plot the stars recorded by stage 4, without selecting them again
+
+    ob_name = os.path.basename(plot_inputs['xml_file'])
+
+    plot_filename_list = []
+
+    for kind in ['guide', 'calib']:
+        star_inputs = plot_inputs[kind]
+
+        _plot_stars(star_inputs['plot_filename'], star_inputs,
+                    plot_inputs['field_center'], plot_inputs['max_radius'],
+                    '{} stars of {}'.format(kind.capitalize(), ob_name))
+
+        plot_filename_list.append(star_inputs['plot_filename'])
+
+    return plot_filename_list
+
+
+def render_deferred_plots(sidecar_file_list, workers=1):
+    """
+    Render the plots of the guide and calib stars deferred by stage 4.
+
+    The plots show the candidate and chosen stars around the center of each
+    field. They are drawn here rather than by the IFU workflow, which only
+    plots while selecting the stars, so they are not the same images as the
+    inline plots of stage 4.
+
+    Parameters
+    ----------
+    sidecar_file_list : list of str
+        A list of JSON files written by add_guide_and_calib_stars with
+        plot_mode='deferred'. They contain all the inputs of the plots, so
+        neither the XML files nor the catalogues of stars are read again.
+    workers : int, optional
+        Number of processes used to render the plots in parallel.
+
+    Returns
+    -------
+    plot_filename_list : list of str
+        A list with the rendered plots.
+    """
+
+    assert workers >= 1
+
+    sidecar_file_list = sorted(sidecar_file_list)
+
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker)
+
+    try:
+        result_list = pool.map(_render_plots, sidecar_file_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    plot_filename_list = [
+        plot_filename for result in result_list for plot_filename in result
+    ]
+
+    return plot_filename_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Render the deferred plots of guide and calib stars')
+
+    parser.add_argument('sidecar_file',
+                        nargs='+',
+                        help="""a JSON file with the inputs of the plots of an
+                        OB, written by add_guide_and_calib_stars.py with
+                        --plot_mode deferred""")
+
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help="""number of processes used to render the plots in
+                        parallel""")
+
+    parser.add_argument('--log_level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    render_deferred_plots(args.sidecar_file, workers=args.jobs)
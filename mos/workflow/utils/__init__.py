@@ -0,0 +1,20 @@
+from .lazy_module import set_lazy_attributes
+
+# Import the classes on first access, so the stages only load the modules
+# (and astropy) that they use
+
+set_lazy_attributes(
+    __name__, {
+        'CategoricalIndex': ('.categorical_index', 'CategoricalIndex'),
+        'Manifest': ('.manifest', 'Manifest'),
+        'MetricsRecorder': ('.metrics', 'MetricsRecorder'),
+        'OBText': ('.ob_text', 'OBText'),
+        'SamplingProfiler': ('.profiling', 'SamplingProfiler'),
+        'StageProfiler': ('.profiling', 'StageProfiler'),
+        'SkyIndex': ('.sky_index', 'SkyIndex'),
+        'TargetCatalogue': ('.target_catalogue', 'TargetCatalogue'),
+        'TargetBlockWriter': ('.target_writer', 'TargetBlockWriter'),
+        'TargetTextWriter': ('.target_writer', 'TargetTextWriter'),
+        'XMLTemplate': ('.xml_template', 'XMLTemplate'),
+        'XMLStreamWriter': ('.xml_writer', 'XMLStreamWriter')
+    })
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+
+import numpy as np
+
+
+class CategoricalIndex:
+    """
+    An inverted index from the values of a categorical column to its rows.
+
+    The column is encoded once into the codes of its distinct values, and the
+    rows are sorted by code, so the rows with a given value are a slice of the
+    sorted rows which can be found without comparing the whole column.
+
+    Parameters
+    ----------
+    column : array-like
+        The values of the column, e.g. the survey of each target.
+    """
+
+    _array_names = ['categories', 'order', 'offsets']
+
+    def __init__(self, column):
+
+        self.categories, codes = np.unique(np.asarray(column),
+                                           return_inverse=True)
+
+        codes = codes.ravel()
+
+        # Keep the rows sorted by code, so the rows of each value are a slice
+        # which starts at the corresponding offset
+        self.order = np.argsort(codes, kind='stable')
+        self.offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(codes,
+                                        minlength=len(self.categories)))))
+
+    def __len__(self):
+        return len(self.order)
+
+    def save(self, directory):
+        """
+        Save the index as a set of .npy files which can be memory-mapped.
+
+        Parameters
+        ----------
+        directory : str
+            An existing directory where the files will be saved.
+        """
+
+        for name in self._array_names:
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Load an index saved with the method save.
+
+        Parameters
+        ----------
+        directory : str
+            The directory containing the files of the index.
+        mmap_mode : {None, 'r', 'r+', 'c'}, optional
+            How to memory-map the arrays of the index (see numpy.load).
+
+        Returns
+        -------
+        categorical_index : CategoricalIndex
+            The loaded index.
+        """
+
+        categorical_index = cls.__new__(cls)
+
+        for name in cls._array_names:
+            setattr(categorical_index, name,
+                    np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode=mmap_mode))
+
+        return categorical_index
+
+    def get_rows(self, *values):
+        """
+        Get the rows which contain any of the given values.
+
+        Parameters
+        ----------
+        *values
+            The values to look up.
+
+        Returns
+        -------
+        rows : numpy.ndarray
+            The sorted indices of the rows containing any of the values.
+        """
+
+        rows_list = []
+
+        for value in set(values):
+            code = np.searchsorted(self.categories, value)
+
+            if (code < len(self.categories)
+                    and self.categories[code] == value):
+                rows_list.append(
+                    self.order[self.offsets[code]:self.offsets[code + 1]])
+
+        if len(rows_list) == 0:
+            return np.zeros(0, dtype=int)
+
+        rows = np.sort(np.concatenate(rows_list))
+
+        return rows
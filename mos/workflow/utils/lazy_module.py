@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+
+    # A package whose public names are imported from its modules on first
+    # access. A module class is used instead of a module-level __getattr__, so
+    # it also works with Python < 3.7
+
+    def __getattr__(self, name):
+
+        # This is only called for the names not found in the package
+
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        lazy_attribute_dict = self.__dict__['_lazy_attribute_dict']
+
+        if name in lazy_attribute_dict:
+            module_name, attribute_name = lazy_attribute_dict[name]
+
+            value = getattr(importlib.import_module(module_name, self.__name__),
+                            attribute_name)
+        else:
+
+            # Import the submodules too, as it happened when the package
+            # imported all of them
+
+            full_name = self.__name__ + '.' + name
+
+            try:
+                value = importlib.import_module(full_name)
+            except ImportError as e:
+                if getattr(e, 'name', None) != full_name:
+                    raise
+
+                raise AttributeError('module {} has no attribute {}'.format(
+                    self.__name__, name))
+
+        self.__dict__[name] = value
+
+        return value
+
+    def __setattr__(self, name, value):
+
+        # The import system sets each submodule as an attribute of its package,
+        # which must not hide a lazy name of the package with the same name
+        # (e.g. the create_xml_files function of the create_xml_files module)
+
+        if (isinstance(value, types.ModuleType)
+                and (name in self.__dict__['_lazy_attribute_dict'])):
+            return
+
+        super().__setattr__(name, value)
+
+    def __dir__(self):
+
+        return sorted(
+            set(super().__dir__()) | set(self._lazy_attribute_dict.keys()))
+
+
+def set_lazy_attributes(package_name, lazy_attribute_dict):
+    """
+    Make the public names of a package be imported on first access.
+
+    It is meant to be called from the __init__.py of the package instead of
+    importing its modules, so importing the package does not pay the cost of
+    importing the modules (and astropy, matplotlib, etc.) until they are used.
+
+    Parameters
+    ----------
+    package_name : str
+        The name of the package, i.e. __name__ in its __init__.py.
+    lazy_attribute_dict : dict
+        A dictionary whose keys are the names of the package, and whose values
+        are pairs with the name of the module defining them (which may be
+        relative to the package) and their name in that module.
+    """
+
+    package = sys.modules[package_name]
+
+    package._lazy_attribute_dict = lazy_attribute_dict
+    package.__all__ = sorted(name for name in lazy_attribute_dict.keys()
+                             if not name.startswith('_'))
+
+    package.__class__ = _LazyModule
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+
+def get_file_hash(filename, block_size=2**20):
+    """
+    Get the SHA-256 hash of the content of a file.
+
+    Parameters
+    ----------
+    filename : str
+        The file to be hashed.
+    block_size : int, optional
+        Size in bytes of the blocks in which the file is read.
+
+    Returns
+    -------
+    file_hash : str
+        The hexadecimal digest of the content of the file.
+    """
+
+    sha256 = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def get_hash(*values):
+    """
+    Get the SHA-256 hash of a sequence of values.
+
+    Parameters
+    ----------
+    *values : bytes or str or None
+        The values to be hashed. Strings are encoded in UTF-8, and each value
+        is prefixed with its length, so different sequences do not collide.
+
+    Returns
+    -------
+    hash : str
+        The hexadecimal digest of the values.
+    """
+
+    sha256 = hashlib.sha256()
+
+    for value in values:
+        if value is None:
+            value = b''
+        elif isinstance(value, str):
+            value = value.encode('utf-8')
+
+        sha256.update('{}:'.format(len(value)).encode('ascii'))
+        sha256.update(value)
+
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    A record of the outputs generated from some inputs.
+
+    It maps a key for each unit of work (e.g. an OB) to a hash of its inputs
+    and the list of its output files, so a later run can regenerate only the
+    outputs whose inputs have changed. The output files are recorded relative
+    to the directory of the manifest.
+
+    Parameters
+    ----------
+    filename : str
+        A JSON file with the manifest. It is read if it exists; if it cannot be
+        read, the manifest starts empty.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        self._entry_dict = OrderedDict()
+
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    manifest_dict = json.load(f,
+                                              object_pairs_hook=OrderedDict)
+
+                for key, entry in manifest_dict['entries'].items():
+                    self._entry_dict[key] = (entry['hash'],
+                                             list(entry['output_files']))
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning('Ignoring unreadable manifest {}: {}'.format(
+                    filename, e))
+                self._entry_dict = OrderedDict()
+
+    def __contains__(self, key):
+
+        return key in self._entry_dict
+
+    def keys(self):
+        """
+        Get the keys recorded in the manifest.
+
+        Returns
+        -------
+        key_list : list of str
+            The keys in the order in which they were recorded.
+        """
+
+        return list(self._entry_dict.keys())
+
+    def _get_path(self, output_file):
+
+        return os.path.join(os.path.dirname(self.filename), output_file)
+
+    def get_hash(self, key):
+        """
+        Get the hash of the inputs recorded for a key.
+
+        Parameters
+        ----------
+        key : str
+            The key of a unit of work.
+
+        Returns
+        -------
+        input_hash : str or None
+            The hash of its inputs, or None if the key is not recorded.
+        """
+
+        if key not in self._entry_dict:
+            return None
+
+        return self._entry_dict[key][0]
+
+    def get_output_files(self, key):
+        """
+        Get the output files recorded for a key.
+
+        Parameters
+        ----------
+        key : str
+            The key of a unit of work.
+
+        Returns
+        -------
+        output_file_list : list of str
+            The paths of its output files.
+        """
+
+        return [
+            self._get_path(output_file)
+            for output_file in self._entry_dict[key][1]
+        ]
+
+    def is_up_to_date(self, key, input_hash):
+        """
+        Check whether the outputs of a key are up to date.
+
+        Parameters
+        ----------
+        key : str
+            The key of a unit of work.
+        input_hash : str
+            The hash of its current inputs.
+
+        Returns
+        -------
+        up_to_date : bool
+            Whether the recorded hash matches and all its outputs exist.
+        """
+
+        if self.get_hash(key) != input_hash:
+            return False
+
+        return all(
+            os.path.exists(output_file)
+            for output_file in self.get_output_files(key))
+
+    def set(self, key, input_hash, output_file_list):
+        """
+        Record the outputs generated for a key.
+
+        Parameters
+        ----------
+        key : str
+            The key of a unit of work.
+        input_hash : str
+            The hash of its inputs.
+        output_file_list : list of str
+            The paths of its output files.
+        """
+
+        manifest_dir = os.path.dirname(os.path.abspath(self.filename))
+
+        self._entry_dict[key] = (input_hash, [
+            os.path.relpath(os.path.abspath(output_file), manifest_dir)
+            for output_file in output_file_list
+        ])
+
+    def remove(self, key):
+        """
+        Remove a key and delete its output files.
+
+        Parameters
+        ----------
+        key : str
+            The key of a unit of work.
+        """
+
+        for output_file in self.get_output_files(key):
+            if os.path.exists(output_file):
+                logging.info('Removing previous file: {}'.format(output_file))
+                os.remove(output_file)
+
+        del self._entry_dict[key]
+
+    def write(self):
+        """
+        Write the manifest to its file.
+
+        The file is replaced atomically, so an interrupted run does not leave a
+        truncated manifest behind.
+        """
+
+        manifest_dict = OrderedDict([('entries', OrderedDict())])
+
+        for key, (input_hash, output_file_list) in self._entry_dict.items():
+            manifest_dict['entries'][key] = OrderedDict([
+                ('hash', input_hash), ('output_files', output_file_list)
+            ])
+
+        tmp_filename = self.filename + '.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(manifest_dict, f, indent=2)
+
+        os.replace(tmp_filename, self.filename)
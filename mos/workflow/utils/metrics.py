@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the current process.
+
+    Returns
+    -------
+    peak_rss : int
+        The peak resident set size in bytes.
+    """
+
+    # On Linux, read it from /proc, since the maximum reported by getrusage is
+    # inherited from the parent across exec; elsewhere, getrusage reports it
+    # in kilobytes (Linux) or bytes (macOS)
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    return peak_rss
+
+
+class _NullSpan:
+
+    # The span returned while the metrics are disabled, which does nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, name, value=1):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    A timed section of a run, created by MetricsRecorder.span.
+
+    When it exits, it records its wall time, CPU time, the increase of the
+    peak memory of the process and its counters in the recorder.
+
+    Parameters
+    ----------
+    recorder : MetricsRecorder
+        The recorder of the span.
+    name : str
+        The name of the span, e.g. the step of the stage.
+    attributes : dict
+        Information identifying the span, e.g. the file being processed.
+    """
+
+    def __init__(self, recorder, name, attributes):
+
+        self.recorder = recorder
+        self.name = name
+        self.attributes = attributes
+
+        self.path = None
+        self.counters = OrderedDict()
+
+    def __enter__(self):
+
+        stack = self.recorder._stack
+
+        if stack:
+            self.path = stack[-1].path + '/' + self.name
+        else:
+            self.path = self.name
+
+        stack.append(self)
+
+        self._start_peak_rss = get_peak_rss()
+        self._start_cpu_time = time.process_time()
+        self._start_wall_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        wall_time = time.perf_counter() - self._start_wall_time
+        cpu_time = time.process_time() - self._start_cpu_time
+        peak_rss_increase = get_peak_rss() - self._start_peak_rss
+
+        self.recorder._stack.pop()
+
+        self.recorder._add_record(
+            OrderedDict([
+                ('name', self.name), ('path', self.path),
+                ('attributes', self.attributes),
+                ('start',
+                 self._start_wall_time - self.recorder._start_wall_time),
+                ('wall_time', wall_time), ('cpu_time', cpu_time),
+                ('peak_rss_increase_mb', peak_rss_increase / 2**20),
+                ('counters', self.counters), ('failed', exc_type is not None)
+            ]))
+
+        return False
+
+    def add(self, name, value=1):
+        """
+        Add a value to a counter of the span.
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter, e.g. targets_matched.
+        value : int, optional
+            The value to add.
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class MetricsRecorder:
+    """
+    A recorder of the spans of a run of the workflow.
+
+    The spans are nested following the calls, so the path of each one
+    contains the names of the spans enclosing it. The processes of a pool
+    record their spans with their own recorders, whose records are added to
+    the recorder of the parent process with add_records.
+
+    Parameters
+    ----------
+    start_wall_time : float, optional
+        The value of time.perf_counter from which the start of the spans is
+        measured. By default, the time at which the recorder is created.
+    """
+
+    def __init__(self, start_wall_time=None):
+
+        self.record_list = []
+
+        self._stack = []
+
+        if start_wall_time is None:
+            self._start_wall_time = time.perf_counter()
+        else:
+            self._start_wall_time = start_wall_time
+
+    def _add_record(self, record):
+
+        self.record_list.append(record)
+
+    def pop_records(self):
+        """
+        Get the records of the spans closed so far and forget them.
+
+        Returns
+        -------
+        record_list : list of dict
+            The records of the spans, in the order in which they were closed.
+        """
+
+        record_list = self.record_list
+        self.record_list = []
+
+        return record_list
+
+    def add_records(self, record_list):
+        """
+        Add the records of the spans of another recorder.
+
+        The records are nested in the innermost open span, e.g. the records of
+        a process of a pool are nested in the span which runs the pool, so
+        they get the same paths as if they had been recorded by this recorder.
+
+        Parameters
+        ----------
+        record_list : list of dict
+            The records of the spans, as returned by pop_records.
+        """
+
+        for record in record_list:
+            record = OrderedDict(record)
+
+            if self._stack:
+                record['path'] = self._stack[-1].path + '/' + record['path']
+
+            self._add_record(record)
+
+    def span(self, name, **attributes):
+        """
+        Create a span.
+
+        Parameters
+        ----------
+        name : str
+            The name of the span.
+        **attributes
+            Information identifying the span, e.g. the file being processed.
+
+        Returns
+        -------
+        span : Span
+            A context manager which times the code run inside it.
+        """
+
+        return Span(self, name, attributes)
+
+    def add(self, name, value=1):
+        """
+        Add a value to a counter of the innermost open span.
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter.
+        value : int, optional
+            The value to add.
+        """
+
+        if self._stack:
+            self._stack[-1].add(name, value)
+
+    def get_summary(self):
+        """
+        Get the totals of the spans with the same path.
+
+        Returns
+        -------
+        summary : dict
+            A dictionary indexed by the paths of the spans, with their number,
+            total wall time, total CPU time, largest increase of the peak
+            memory and the sum of their counters.
+        """
+
+        summary = OrderedDict()
+
+        for record in self.record_list:
+            if record['path'] not in summary:
+                summary[record['path']] = OrderedDict([
+                    ('count', 0), ('wall_time', 0.), ('cpu_time', 0.),
+                    ('peak_rss_increase_mb', 0.), ('counters', OrderedDict())
+                ])
+
+            total = summary[record['path']]
+
+            total['count'] += 1
+            total['wall_time'] += record['wall_time']
+            total['cpu_time'] += record['cpu_time']
+            total['peak_rss_increase_mb'] = max(
+                total['peak_rss_increase_mb'], record['peak_rss_increase_mb'])
+
+            for name, value in record['counters'].items():
+                total['counters'][name] = total['counters'].get(name,
+                                                                0) + value
+
+        return summary
+
+    def write(self, filename):
+        """
+        Write the spans and their summary to a JSON file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the output file.
+        """
+
+        metrics_dict = OrderedDict([('peak_rss_mb', get_peak_rss() / 2**20),
+                                    ('summary', self.get_summary()),
+                                    ('spans', self.record_list)])
+
+        with open(filename, 'w') as f:
+            json.dump(metrics_dict, f, indent=2, default=str)
+
+
+# The recorder of the metrics, or None if they are disabled
+_recorder = None
+
+
+def enable_metrics():
+    """
+    Start recording the metrics of the spans with a new recorder.
+
+    Returns
+    -------
+    recorder : MetricsRecorder
+        The new recorder.
+    """
+
+    global _recorder
+
+    _recorder = MetricsRecorder()
+
+    return _recorder
+
+
+def disable_metrics():
+    """
+    Stop recording the metrics of the spans.
+
+    Returns
+    -------
+    recorder : MetricsRecorder or None
+        The recorder used until now.
+    """
+
+    global _recorder
+
+    recorder = _recorder
+    _recorder = None
+
+    return recorder
+
+
+def init_worker_metrics(start_wall_time):
+    """
+    Set up the metrics of a process of a pool.
+
+    Parameters
+    ----------
+    start_wall_time : float or None
+        The start time of the recorder of the parent process, as returned by
+        get_start_wall_time, or None if its metrics are disabled. The times
+        of the spans are measured from it, as time.perf_counter is shared by
+        the processes of a machine.
+    """
+
+    global _recorder
+
+    if start_wall_time is None:
+        _recorder = None
+    else:
+        _recorder = MetricsRecorder(start_wall_time=start_wall_time)
+
+
+def get_start_wall_time():
+    """
+    Get the start time of the current recorder, to be passed to the processes
+    of a pool.
+
+    Returns
+    -------
+    start_wall_time : float or None
+        The start time, or None if the metrics are disabled.
+    """
+
+    if _recorder is None:
+        return None
+
+    return _recorder._start_wall_time
+
+
+def pop_records():
+    """
+    Get the records of the spans closed so far in this process and forget
+    them, e.g. to return them from a process of a pool.
+
+    Returns
+    -------
+    record_list : list of dict
+        The records of the spans, or an empty list if the metrics are
+        disabled.
+    """
+
+    if _recorder is None:
+        return []
+
+    return _recorder.pop_records()
+
+
+def add_records(record_list):
+    """
+    Add the records of the spans of another process, if the metrics are
+    enabled.
+
+    Parameters
+    ----------
+    record_list : list of dict
+        The records of the spans, as returned by pop_records.
+    """
+
+    if _recorder is not None:
+        _recorder.add_records(record_list)
+
+
+def get_recorder():
+    """
+    Get the current recorder of the metrics.
+
+    Returns
+    -------
+    recorder : MetricsRecorder or None
+        The recorder, or None if the metrics are disabled.
+    """
+
+    return _recorder
+
+
+def span(name, **attributes):
+    """
+    Time a section of code if the metrics are enabled.
+
+    While the metrics are disabled, it returns a shared object which does
+    nothing, so the cost of the instrumentation is a function call.
+
+    Parameters
+    ----------
+    name : str
+        The name of the span.
+    **attributes
+        Information identifying the span, e.g. the file being processed.
+
+    Returns
+    -------
+    span : Span
+        A context manager which times the code run inside it, and whose add
+        method counts things.
+    """
+
+    if _recorder is None:
+        return _NULL_SPAN
+
+    return _recorder.span(name, **attributes)
+
+
+def add_counter(name, value=1):
+    """
+    Add a value to a counter of the innermost open span, if any.
+
+    Parameters
+    ----------
+    name : str
+        The name of the counter.
+    value : int, optional
+        The value to add.
+    """
+
+    if _recorder is not None:
+        _recorder.add(name, value)
+
+
+def write_metrics(filename):
+    """
+    Write the metrics recorded so far to a JSON file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the output file.
+    """
+
+    assert _recorder is not None
+
+    _recorder.write(filename)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import xml.dom.minidom
+import xml.parsers.expat
+
+
+class OBText:
+    """
+    A fast reader of the parts of an OB XML used to add targets to it.
+
+    The file is scanned once with expat, keeping only the attributes of the
+    observation, the surveys, the fields and the targets of the fields, and
+    the line span of each target. The rest of the file is kept as raw lines,
+    which are written back verbatim, so building a DOM of the large and
+    comment-heavy OB is avoided.
+
+    This requires the layout written by OBXML.write_xml, where every template
+    target starts and ends its own lines; a ValueError is raised otherwise.
+
+    Parameters
+    ----------
+    filename : str
+        An OB XML file.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        self.lines = data.decode('utf-8').split('\n')
+
+        self.observation = {}
+        self.surveys = []
+        self.fields = []
+        self.targets = []
+
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+
+        self._in_field = False
+        self._target = None
+
+        try:
+            self._parser.Parse(data, True)
+        except xml.parsers.expat.ExpatError as e:
+            raise ValueError('Cannot parse {}: {}'.format(filename, e))
+        finally:
+            self._parser = None
+
+        self._check_template_lines()
+
+    def _start_element(self, name, attributes):
+
+        if name == 'observation':
+            self.observation = attributes
+        elif name == 'survey':
+            self.surveys.append(attributes)
+        elif name == 'field':
+            self.fields.append(attributes)
+            self._in_field = True
+        elif (name == 'target') and self._in_field and (self._target is None):
+            self._target = {
+                'field': len(self.fields) - 1,
+                'attributes': attributes,
+                'first_line': self._parser.CurrentLineNumber - 1
+            }
+
+    def _end_element(self, name):
+
+        if name == 'field':
+            self._in_field = False
+        elif (name == 'target') and (self._target is not None):
+            self._target['last_line'] = self._parser.CurrentLineNumber - 1
+            self.targets.append(self._target)
+            self._target = None
+
+    @staticmethod
+    def is_template(target):
+        """
+        Check whether a target is a template target.
+
+        Parameters
+        ----------
+        target : dict
+            A target of the OB, from its targets attribute.
+
+        Returns
+        -------
+        is_template : bool
+            Whether the target is a template, i.e. its targsrvy is '%%%'.
+        """
+
+        return target['attributes'].get('targsrvy') == '%%%'
+
+    def get_target_text(self, target):
+        """
+        Get the text of a target.
+
+        Parameters
+        ----------
+        target : dict
+            A target of the OB, from its targets attribute.
+
+        Returns
+        -------
+        text : str
+            The lines of the target, as in the file.
+        """
+
+        return '\n'.join(self.lines[target['first_line']:target['last_line'] +
+                                    1])
+
+    def _check_template_lines(self):
+
+        # Check that each template target is on lines of its own, so they can
+        # be removed and the targets can be added after them
+
+        previous_last_line = -1
+
+        for target in self.targets:
+            if not self.is_template(target):
+                continue
+
+            first_line = self.lines[target['first_line']]
+
+            if ((target['first_line'] <= previous_last_line)
+                    or (not first_line.lstrip().startswith('<target'))):
+                raise ValueError('Template target not at the start of line '
+                                 '{} of {}'.format(target['first_line'] + 1,
+                                                   self.filename))
+
+            try:
+                xml.dom.minidom.parseString(self.get_target_text(target))
+            except xml.parsers.expat.ExpatError:
+                raise ValueError('Template target not on lines of its own at '
+                                 'line {} of {}'.format(
+                                     target['first_line'] + 1, self.filename))
+
+            previous_last_line = target['last_line']
+
+    def get_templates(self, field_index=0):
+        """
+        Get the template targets of a field as DOM elements.
+
+        Parameters
+        ----------
+        field_index : int, optional
+            The index of the field.
+
+        Returns
+        -------
+        template_dict : dict
+            A dictionary with the targets of the templates, indexed by their
+            targuse, each one a tuple with the DOM element of the template and
+            its target from the targets attribute.
+        """
+
+        template_dict = {}
+
+        for target in self.targets:
+            if (target['field'] == field_index) and self.is_template(target):
+                element = xml.dom.minidom.parseString(
+                    self.get_target_text(target)).documentElement
+
+                template_dict[element.getAttribute('targuse')] = (element,
+                                                                  target)
+
+        return template_dict
+
+    def get_indent(self, target):
+        """
+        Get the indentation of a target.
+
+        Parameters
+        ----------
+        target : dict
+            A target of the OB, from its targets attribute.
+
+        Returns
+        -------
+        indent : str
+            The whitespace which precedes the target in its first line.
+        """
+
+        line = self.lines[target['first_line']]
+
+        return line[:len(line) - len(line.lstrip())]
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+PROFILE_MODES = ['cprofile', 'sampling']
+
+
+def _get_frame_name(code):
+
+    # Name a frame by its file and function, which is the usual label of the
+    # frames in collapsed stacks
+
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler sampling the stack of a thread at regular intervals.
+
+    The stack of the profiled thread is read from a background thread, so the
+    profiled code is not instrumented and runs at almost its normal speed.
+    The samples are aggregated as collapsed stacks, which can be turned into
+    a flame graph with tools such as flamegraph.pl or speedscope.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Time in seconds between the samples.
+    thread_id : int, optional
+        The identifier of the thread to be profiled. By default, the thread
+        which starts the profiler.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+
+        self.interval = interval
+        self.thread_id = thread_id
+
+        self.stack_counter = Counter()
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is None:
+                continue
+
+            name_list = []
+
+            while frame is not None:
+                name_list.append(_get_frame_name(frame.f_code))
+                frame = frame.f_back
+
+            self.stack_counter[tuple(reversed(name_list))] += 1
+
+    def start(self):
+        """
+        Start sampling the stack of the profiled thread.
+        """
+
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+
+        self._stop_event.clear()
+
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+
+        self._stop_event.set()
+        self._thread.join()
+
+    def get_hotspots(self, top=20):
+        """
+        Get the functions found in most samples.
+
+        Parameters
+        ----------
+        top : int, optional
+            The number of functions to be returned.
+
+        Returns
+        -------
+        hotspot_list : list of tuple
+            A list with the name of each function, the number of samples in
+            which it was running (directly or through the functions it called)
+            and the number of samples in which it was at the top of the stack,
+            sorted by the first number.
+        """
+
+        cumulative_counter = Counter()
+        self_counter = Counter()
+
+        for stack, count in self.stack_counter.items():
+            for name in set(stack):
+                cumulative_counter[name] += count
+
+            self_counter[stack[-1]] += count
+
+        return [(name, cumulative_count, self_counter[name])
+                for name, cumulative_count in cumulative_counter.most_common(
+                    top)]
+
+    def write(self, filename):
+        """
+        Write the samples as collapsed stacks.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the output file. Each line contains the functions of a
+            stack, from the outermost one and separated by semicolons, followed
+            by the number of samples of that stack.
+        """
+
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stack_counter.items()):
+                f.write('{} {}\n'.format(';'.join(stack), count))
+
+    def print_hotspots(self, top=20, stream=None):
+        """
+        Print the functions found in most samples.
+
+        Parameters
+        ----------
+        top : int, optional
+            The number of functions to be printed.
+        stream : file, optional
+            The output stream. By default, the standard output.
+        """
+
+        if stream is None:
+            stream = sys.stdout
+
+        num_samples = sum(self.stack_counter.values())
+
+        stream.write('{} samples every {} s\n\n'.format(
+            num_samples, self.interval))
+        stream.write('{:>9} {:>9}  {}\n'.format('cumul%', 'self%', 'function'))
+
+        for name, cumulative_count, self_count in self.get_hotspots(top):
+            stream.write('{:>9.1f} {:>9.1f}  {}\n'.format(
+                100 * cumulative_count / max(num_samples, 1),
+                100 * self_count / max(num_samples, 1), name))
+
+
+class StageProfiler:
+    """
+    A context manager which profiles the run of a stage.
+
+    When it exits, it writes the profile next to the outputs of the stage and
+    prints the functions with the largest cumulative time. Only the current
+    process is profiled, so the work done by the processes of a pool is seen
+    as the time spent waiting for their results.
+
+    Parameters
+    ----------
+    mode : {'cprofile', 'sampling'} or None
+        The profiler: 'cprofile' traces every function call with cProfile and
+        writes a pstats file; 'sampling' samples the stack periodically with
+        SamplingProfiler and writes a file of collapsed stacks. If None, no
+        profiling is done.
+    output_prefix : str
+        The name of the output file without its extension, e.g. the output
+        directory followed by the name of the stage.
+    top : int, optional
+        The number of functions to be printed.
+    interval : float, optional
+        Time in seconds between the samples in 'sampling' mode.
+    """
+
+    def __init__(self, mode, output_prefix, top=20, interval=0.005):
+
+        assert (mode is None) or (mode in PROFILE_MODES)
+
+        self.mode = mode
+        self.output_prefix = output_prefix
+        self.top = top
+        self.interval = interval
+
+        self.profiler = None
+        self.filename = None
+
+    def __enter__(self):
+
+        if self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == 'sampling':
+            self.profiler = SamplingProfiler(interval=self.interval)
+            self.profiler.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+
+            self.filename = self.output_prefix + '.pstats'
+            self.profiler.dump_stats(self.filename)
+
+            stats = pstats.Stats(self.profiler, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+        elif self.mode == 'sampling':
+            self.profiler.stop()
+
+            self.filename = self.output_prefix + '.collapsed'
+            self.profiler.write(self.filename)
+
+            self.profiler.print_hotspots(self.top)
+
+        if self.filename is not None:
+            logging.info('Profile written to {}'.format(self.filename))
+
+        return False
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy_healpix import HEALPix, nside_to_pixel_resolution
+
+
+def _ranges_to_indices(start, stop):
+    """
+    Concatenate the integer ranges [start[i], stop[i]) into a single array.
+    """
+
+    counts = stop - start
+    total = counts.sum()
+
+    if total == 0:
+        return np.zeros(0, dtype=int)
+
+    # Each element is the start of its range plus its position in the range
+    offsets = np.repeat(start - np.cumsum(counts) + counts, counts)
+    indices = offsets + np.arange(total)
+
+    return indices
+
+
+def _get_unit_vectors(ra, dec):
+    """
+    Get the Cartesian unit vectors of some sky positions given in degrees.
+    """
+
+    ra_rad = np.radians(ra)
+    dec_rad = np.radians(dec)
+
+    cos_dec = np.cos(dec_rad)
+
+    xyz = np.stack(
+        [cos_dec * np.cos(ra_rad), cos_dec * np.sin(ra_rad),
+         np.sin(dec_rad)],
+        axis=-1)
+
+    return xyz
+
+
+class SkyIndex:
+    """
+    A HEALPix index of a list of sky positions for repeated cone searches.
+
+    The positions are sorted by the HEALPix pixel in which they fall, so the
+    rows close to a field center can be found by looking up the few pixels
+    which overlap with the cone, instead of computing the separation to every
+    row of the catalogue.
+
+    Parameters
+    ----------
+    ra : array-like
+        The right ascension of the positions in degrees.
+    dec : array-like
+        The declination of the positions in degrees.
+    max_radius : float, optional
+        The typical radius of the cone searches in degrees, which is used to
+        choose the resolution of the HEALPix grid.
+    """
+
+    _array_names = ['ra', 'dec', 'xyz', 'order', 'sorted_pixels']
+
+    # The margin in the cosine of the separation within which the unit vectors
+    # are not precise enough to decide whether a position is inside a cone,
+    # which is several orders of magnitude above their rounding errors
+    _cos_margin = 1e-9
+
+    def __init__(self, ra, dec, max_radius=1.0):
+
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+
+        assert self.ra.shape == self.dec.shape
+
+        self.xyz = _get_unit_vectors(self.ra, self.dec)
+
+        self.nside = self._get_nside(max_radius)
+        self.healpix = HEALPix(nside=self.nside, order='nested')
+
+        pixels = self.healpix.lonlat_to_healpix(self.ra * u.deg,
+                                                self.dec * u.deg)
+
+        # Keep the rows sorted by pixel, so the rows of each pixel are a slice
+        self.order = np.argsort(pixels, kind='stable')
+        self.sorted_pixels = pixels[self.order]
+
+    def __len__(self):
+        return len(self.ra)
+
+    def save(self, directory):
+        """
+        Save the index as a set of .npy files which can be memory-mapped.
+
+        Parameters
+        ----------
+        directory : str
+            An existing directory where the files will be saved.
+        """
+
+        for name in self._array_names:
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+
+        np.save(os.path.join(directory, 'nside.npy'), self.nside)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Load an index saved with the method save.
+
+        Parameters
+        ----------
+        directory : str
+            The directory containing the files of the index.
+        mmap_mode : {None, 'r', 'r+', 'c'}, optional
+            How to memory-map the arrays of the index (see numpy.load).
+
+        Returns
+        -------
+        sky_index : SkyIndex
+            The loaded index.
+        """
+
+        sky_index = cls.__new__(cls)
+
+        for name in cls._array_names:
+            setattr(sky_index, name,
+                    np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode=mmap_mode))
+
+        sky_index.nside = int(np.load(os.path.join(directory, 'nside.npy')))
+        sky_index.healpix = HEALPix(nside=sky_index.nside, order='nested')
+
+        return sky_index
+
+    @staticmethod
+    def _get_nside(max_radius, max_nside=2**20):
+        # Use the finest grid whose pixels are still around half the search
+        # radius, so a cone search only touches a handful of pixels
+
+        nside = 1
+
+        while nside < max_nside:
+            resolution = nside_to_pixel_resolution(2 * nside).to_value(u.deg)
+
+            if resolution < max_radius / 2:
+                break
+
+            nside *= 2
+
+        return nside
+
+    def query(self, ra, dec, radius, rows=None):
+        """
+        Get the rows within a given radius of a position.
+
+        Parameters
+        ----------
+        ra : float
+            The right ascension of the center of the cone in degrees.
+        dec : float
+            The declination of the center of the cone in degrees.
+        radius : float
+            The radius of the cone in degrees.
+        rows : array-like, optional
+            If provided, only these rows (e.g. the output of a previous
+            selection) are considered.
+
+        Returns
+        -------
+        rows : numpy.ndarray
+            The sorted indices of the positions within the cone.
+        """
+
+        # Get the candidates from the pixels overlapping with the cone
+
+        pixels = self.healpix.cone_search_lonlat(ra * u.deg, dec * u.deg,
+                                                 radius * u.deg)
+
+        start = np.searchsorted(self.sorted_pixels, pixels, side='left')
+        stop = np.searchsorted(self.sorted_pixels, pixels, side='right')
+
+        # Check the separation only for the smallest set of candidates, which
+        # are either the rows in the pixels or the rows requested
+
+        if rows is not None:
+            rows = np.asarray(rows, dtype=int)
+
+            if len(rows) <= (stop - start).sum():
+                candidates = rows
+            else:
+                candidates = self.order[_ranges_to_indices(start, stop)]
+                candidates = candidates[np.isin(candidates, rows)]
+        else:
+            candidates = self.order[_ranges_to_indices(start, stop)]
+
+        if len(candidates) == 0:
+            return candidates
+
+        # Decide which candidates are inside the cone with the precomputed unit
+        # vectors, and use exactly the same separation as a brute-force search
+        # with SkyCoord only for those too close to the edge of the cone
+
+        cos_offset = np.dot(self.xyz[candidates],
+                            _get_unit_vectors(ra, dec))
+        cos_radius = np.cos(np.radians(radius))
+
+        inside_mask = cos_offset > cos_radius + self._cos_margin
+        edge_mask = np.abs(cos_offset - cos_radius) <= self._cos_margin
+
+        if np.any(edge_mask):
+            edge_candidates = candidates[edge_mask]
+
+            center_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
+            candidate_coords = SkyCoord(ra=self.ra[edge_candidates],
+                                        dec=self.dec[edge_candidates],
+                                        unit='deg')
+
+            offset = center_coords.separation(candidate_coords).deg
+
+            inside_mask[edge_mask] = offset <= radius
+
+        rows = np.sort(candidates[inside_mask])
+
+        return rows
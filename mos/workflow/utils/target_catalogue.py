@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from .categorical_index import CategoricalIndex
+from .manifest import get_hash
+from .sky_index import SkyIndex
+
+
+class TargetCatalogue:
+    """
+    A target catalogue whose rows are only read when they are needed.
+
+    The binary table of the catalogue is memory-mapped, and only the columns
+    used to select the targets of the OBs are read into memory (when they are
+    first accessed). The full rows are only read for the selected targets, so
+    the memory used by a large catalogue scales with the size of those columns
+    plus the selected rows, not with the size of the file.
+
+    Parameters
+    ----------
+    filename : str
+        A FITS file containing a target catalogue.
+    max_radius : float, optional
+        The typical radius of the cone searches in degrees, which is used to
+        choose the resolution of the sky index.
+    columns_dir : str, optional
+        A directory with columns and a sky index saved by save_columns, which
+        will be memory-mapped instead of reading them from the FITS file.
+    cache : bool, optional
+        Keep the selection columns, their indices and the unit vectors of the
+        coordinates in a cache directory next to the catalogue, which is
+        written the first time the catalogue is opened and memory-mapped
+        afterwards instead of decoding the FITS table. The cache is rebuilt if
+        it does not match the catalogue anymore (e.g. its DATASUM changed) or
+        if some of its files are missing or truncated. It is ignored when
+        columns_dir is given.
+    """
+
+    selection_columns = [
+        'TARGSRVY', 'OBSTEMP', 'PROGTEMP', 'GAIA_RA', 'GAIA_DEC'
+    ]
+
+    categorical_columns = ['TARGSRVY', 'OBSTEMP', 'PROGTEMP']
+
+    # The version of the layout of the cache, to be increased when it changes
+    _cache_version = 2
+
+    def __init__(self, filename, max_radius=1.0, columns_dir=None,
+                 cache=False):
+
+        self.filename = filename
+        self.max_radius = max_radius
+        self.columns_dir = columns_dir
+
+        self._hdulist = fits.open(filename, memmap=True)
+        self._hdu = self._hdulist[1]
+
+        self._columns = {}
+        self._categorical_indices = {}
+        self._sky_index = None
+
+        if cache and (columns_dir is None):
+            self.columns_dir = self._open_cache()
+
+    def __len__(self):
+        return self._hdu.header['NAXIS2']
+
+    def __getitem__(self, name):
+
+        if name not in self._columns:
+            column_file = self._get_column_file(name)
+
+            if (column_file is not None) and os.path.exists(column_file):
+                self._columns[name] = np.load(column_file, mmap_mode='r')
+            else:
+                self._columns[name] = self._read_column(name)
+
+        return self._columns[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_column_file(self, name):
+
+        if self.columns_dir is None:
+            return None
+
+        return os.path.join(self.columns_dir, name + '.npy')
+
+    def _get_sky_index_dir(self):
+
+        if self.columns_dir is None:
+            return None
+
+        return os.path.join(self.columns_dir, 'sky_index')
+
+    def _get_categorical_index_dir(self, name):
+
+        if self.columns_dir is None:
+            return None
+
+        return os.path.join(self.columns_dir, 'categorical_index_' + name)
+
+    def get_cache_dir(self):
+        """
+        Get the name of the cache directory of the catalogue.
+
+        Returns
+        -------
+        cache_dir : str
+            The name of the directory, which is next to the catalogue.
+        """
+
+        return self.filename + '.cache'
+
+    def _get_cache_key(self):
+
+        # Identify the content of the catalogue by the size and modification
+        # time of the file, together with the DATASUM of its table if it has
+        # checksums. The DATASUM alone is not enough, as it does not change
+        # when the rows are reordered
+
+        stat = os.stat(self.filename)
+        content_id = 'STAT {} {}'.format(stat.st_size, stat.st_mtime_ns)
+
+        header = self._hdu.header
+
+        if 'DATASUM' in header:
+            content_id += ' DATASUM ' + str(header['DATASUM'])
+
+        cache_key = {
+            'version': self._cache_version,
+            'content': content_id,
+            'columns': get_hash(repr(self._hdu.columns)),
+            'num_rows': len(self),
+            'max_radius': self.max_radius
+        }
+
+        return cache_key
+
+    @staticmethod
+    def _get_file_sizes(directory):
+
+        file_size_dict = {}
+
+        for dir_path, dir_names, file_names in os.walk(directory):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                file_size_dict[os.path.relpath(
+                    path, directory)] = os.path.getsize(path)
+
+        return file_size_dict
+
+    def _is_cache_valid(self, cache_dir, cache_key):
+
+        # Check that the cache was written for the current content of the
+        # catalogue and that none of its files are missing or truncated
+
+        try:
+            with open(os.path.join(cache_dir, 'cache.json')) as f:
+                cache_info = json.load(f)
+
+            if cache_info['key'] != cache_key:
+                return False
+
+            for path, size in cache_info['files'].items():
+                if os.path.getsize(os.path.join(cache_dir, path)) != size:
+                    return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+        return True
+
+    def _write_cache(self, cache_dir, cache_key):
+
+        # Write the cache into a temporary directory which is renamed at the
+        # end, so an interrupted run never leaves a partial cache behind
+
+        parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.',
+                                   dir=parent_dir)
+
+        try:
+            self.save_columns(tmp_dir)
+
+            cache_info = {
+                'key': cache_key,
+                'files': self._get_file_sizes(tmp_dir)
+            }
+
+            with open(os.path.join(tmp_dir, 'cache.json'), 'w') as f:
+                json.dump(cache_info, f, indent=2, sort_keys=True)
+
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+
+            os.rename(tmp_dir, cache_dir)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def _open_cache(self):
+
+        # Get the cache directory, building it if it is missing or invalid; if
+        # it cannot be written, the columns are read from the FITS file
+
+        cache_dir = self.get_cache_dir()
+        cache_key = self._get_cache_key()
+
+        if self._is_cache_valid(cache_dir, cache_key):
+            return cache_dir
+
+        if os.path.exists(cache_dir):
+            logging.info('Rebuilding the stale cache {}'.format(cache_dir))
+        else:
+            logging.info('Creating the cache {}'.format(cache_dir))
+
+        try:
+            self._write_cache(cache_dir, cache_key)
+        except OSError as e:
+            logging.warning('Unable to write the cache {}: {}'.format(
+                cache_dir, e))
+            return None
+
+        # Drop the columns and indices computed for the cache, so they are
+        # memory-mapped from it like in later runs
+
+        self._columns = {}
+        self._categorical_indices = {}
+        self._sky_index = None
+
+        return cache_dir
+
+    def _read_column(self, name, start=None, stop=None):
+
+        # Copy the column into a native array, so it does not keep the pages of
+        # the whole table mapped in memory
+
+        column = self._hdu.data[start:stop][name]
+
+        if column.dtype.kind in ['S', 'U']:
+            column = np.char.rstrip(np.array(column))
+        else:
+            column = np.array(column, dtype=column.dtype.newbyteorder('='))
+
+        return column
+
+    @property
+    def sky_index(self):
+        """
+        A SkyIndex with the coordinates of the catalogue.
+        """
+
+        if self._sky_index is None:
+            sky_index_dir = self._get_sky_index_dir()
+
+            if (sky_index_dir is not None) and os.path.isdir(sky_index_dir):
+                self._sky_index = SkyIndex.load(sky_index_dir)
+            else:
+                self._sky_index = SkyIndex(self['GAIA_RA'],
+                                           self['GAIA_DEC'],
+                                           max_radius=self.max_radius)
+
+        return self._sky_index
+
+    def get_categorical_index(self, name):
+        """
+        Get a CategoricalIndex with the rows of each value of a column.
+
+        Parameters
+        ----------
+        name : str
+            The name of a categorical column, e.g. TARGSRVY or OBSTEMP.
+
+        Returns
+        -------
+        categorical_index : CategoricalIndex
+            The inverted index of the column.
+        """
+
+        if name not in self._categorical_indices:
+            index_dir = self._get_categorical_index_dir(name)
+
+            if (index_dir is not None) and os.path.isdir(index_dir):
+                self._categorical_indices[name] = CategoricalIndex.load(
+                    index_dir)
+            else:
+                self._categorical_indices[name] = CategoricalIndex(self[name])
+
+        return self._categorical_indices[name]
+
+    def save_columns(self, columns_dir, columns=None):
+        """
+        Save the selection columns and their indices for memory-mapping.
+
+        This allows several processes to share the columns used to select the
+        targets through memory maps, by opening the catalogue with the
+        parameter columns_dir, instead of each of them reading (or receiving a
+        copy of) the columns.
+
+        Parameters
+        ----------
+        columns_dir : str
+            An existing directory where the files will be saved.
+        columns : list of str, optional
+            The columns to save. By default, the columns used to select the
+            targets.
+        """
+
+        if columns is None:
+            columns = self.selection_columns
+
+        for name in columns:
+            np.save(os.path.join(columns_dir, name + '.npy'), self[name])
+
+            if name in self.categorical_columns:
+                index_dir = os.path.join(columns_dir,
+                                         'categorical_index_' + name)
+
+                if not os.path.isdir(index_dir):
+                    os.mkdir(index_dir)
+
+                self.get_categorical_index(name).save(index_dir)
+
+        sky_index_dir = os.path.join(columns_dir, 'sky_index')
+
+        if not os.path.isdir(sky_index_dir):
+            os.mkdir(sky_index_dir)
+
+        self.sky_index.save(sky_index_dir)
+
+    def iter_chunks(self, chunk_size, columns=None):
+        """
+        Read some columns of the catalogue in blocks of rows.
+
+        The blocks are not kept in memory once they have been consumed, so the
+        memory used is bounded by the size of the blocks.
+
+        Parameters
+        ----------
+        chunk_size : int
+            The number of rows of each block.
+        columns : list of str, optional
+            The columns to read. By default, the columns used to select the
+            targets.
+
+        Yields
+        ------
+        start : int
+            The index of the first row of the block.
+        chunk : dict
+            A dictionary with the values of the requested columns in the block.
+        """
+
+        assert chunk_size > 0
+
+        if columns is None:
+            columns = self.selection_columns
+
+        # Slice the memory-mapped columns when they have been saved, instead of
+        # decoding the FITS table
+
+        column_file_dict = {
+            name: self._get_column_file(name)
+            for name in columns
+        }
+
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+
+            chunk = {}
+
+            for name in columns:
+                column_file = column_file_dict[name]
+
+                if (column_file is not None) and os.path.exists(column_file):
+                    chunk[name] = np.array(self[name][start:stop])
+                else:
+                    chunk[name] = self._read_column(name, start=start,
+                                                    stop=stop)
+
+            yield start, chunk
+
+    def get_rows(self, rows):
+        """
+        Read some rows of the catalogue.
+
+        Parameters
+        ----------
+        rows : array-like
+            The indices of the rows to read.
+
+        Returns
+        -------
+        table : astropy.table.Table
+            A table with the requested rows.
+        """
+
+        # Round-trip the requested rows through an in-memory FITS file, so they
+        # get exactly the same conversions (units, null values, masks...) as
+        # when reading the whole catalogue with Table.read
+
+        buffer = io.BytesIO()
+
+        rows = np.asarray(rows, dtype=int)
+
+        hdu = fits.BinTableHDU(data=self._hdu.data[rows],
+                               header=self._hdu.header)
+        hdu.writeto(buffer)
+
+        buffer.seek(0)
+
+        table = Table.read(buffer, format='fits')
+
+        return table
+
+    def get_rows_hash(self, rows):
+        """
+        Get a hash of the content of some rows of the catalogue.
+
+        The hash covers the raw bytes of the rows and the definition of the
+        columns, but not the rest of the header (e.g. its checksums), so it
+        only changes when the given rows or the columns change.
+
+        Parameters
+        ----------
+        rows : array-like
+            The indices of the rows.
+
+        Returns
+        -------
+        rows_hash : str
+            The hexadecimal digest of the rows.
+        """
+
+        rows = np.asarray(rows, dtype=int)
+
+        rows_hash = get_hash(repr(self._hdu.columns),
+                             np.asarray(self._hdu.data[rows]).tobytes())
+
+        return rows_hash
+
+    def close(self):
+        """
+        Close the underlying FITS file.
+        """
+
+        self._hdulist.close()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+
+from .xml_writer import XMLStreamWriter, get_attribute_names
+
+# The columns of the catalogue used for each attribute of the target elements
+
+_TARGET_COLUMNS = {
+    'cname': 'CNAME',
+    'targcat': 'TARGCAT',
+    'targclass': 'TARGCLASS',
+    'targdec': 'GAIA_DEC',
+    'targepoch': 'GAIA_EPOCH',
+    'targid': 'TARGID',
+    'targname': 'TARGNAME',
+    'targparal': 'GAIA_PARAL',
+    'targpmdec': 'GAIA_PMDEC',
+    'targpmra': 'GAIA_PMRA',
+    'targprio': 'TARGPRIO',
+    'targprog': 'TARGPROG',
+    'targra': 'GAIA_RA',
+    'targsrvy': 'TARGSRVY',
+    'targuse': 'TARGUSE'
+}
+
+_PHOTOMETRY_COLUMNS = {
+    'mag_g': 'MAG_G',
+    'mag_r': 'MAG_R',
+    'mag_i': 'MAG_I',
+    'mag_gg': 'GAIA_MAG_G',
+    'mag_bp': 'GAIA_MAG_BP',
+    'mag_rp': 'GAIA_MAG_RP',
+    'emag_g': 'MAG_G_ERR',
+    'emag_r': 'MAG_R_ERR',
+    'emag_i': 'MAG_I_ERR',
+    'emag_gg': 'GAIA_MAG_G_ERR',
+    'emag_bp': 'GAIA_MAG_BP_ERR',
+    'emag_rp': 'GAIA_MAG_RP_ERR'
+}
+
+# The attributes whose values have at least this number of decimals
+
+_COORD_ATTRIBUTES = ['targra', 'targdec']
+_COORD_MIN_DECIMALS = 5
+
+_PLACEHOLDER_PREFIX = 'mos-target-block-'
+
+
+def _escape_attribute(values):
+
+    # Escape the values of an attribute in the same way as minidom
+
+    for old, new in [('&', '&amp;'), ('<', '&lt;'), ('"', '&quot;'),
+                     ('>', '&gt;')]:
+        values = np.char.replace(values, old, new)
+
+    return values
+
+
+def _format_column(column, attribute):
+
+    # Convert all the values of a column into the strings which are written in
+    # the XML files, with empty strings for the masked values
+
+    data = np.ma.getdata(column)
+    mask = np.ma.getmaskarray(column)
+
+    if data.dtype.kind == 'S':
+        values = np.char.decode(data, 'utf-8')
+    else:
+        values = data.astype(str)
+
+    if attribute in _COORD_ATTRIBUTES:
+        dot_pos = np.char.find(values, '.')
+        num_decimals = np.where(dot_pos >= 0,
+                                np.char.str_len(values) - dot_pos - 1,
+                                np.char.str_len(values))
+
+        values = np.where(num_decimals < _COORD_MIN_DECIMALS,
+                          np.char.mod('%.{}f'.format(_COORD_MIN_DECIMALS),
+                                      data), values)
+
+    values = _escape_attribute(values)
+
+    values = np.where(mask, '', values)
+
+    return values
+
+
+def _format_elements(tag, attribute_list, value_list, indent):
+
+    # Get the lines of a list of empty elements formatted as in minidom
+
+    attribute_pattern = ' '.join(
+        '{}="{{}}"'.format(attribute) for attribute in attribute_list)
+    line_pattern = '{}<{} {}/>'.format(indent, tag, attribute_pattern)
+
+    lines = [line_pattern.format(*values) for values in zip(*value_list)]
+
+    return lines
+
+
+def _is_supported(template, table):
+
+    # Check the structure of the template and the columns of the table can be
+    # handled by the writers
+
+    for attribute in template.attributes.keys():
+        if _TARGET_COLUMNS.get(attribute) not in table.colnames:
+            return False
+
+    num_photometry = 0
+
+    for child in template.childNodes:
+        if child.nodeType == child.TEXT_NODE:
+            if child.data.strip() != '':
+                return False
+        elif child.nodeType != child.ELEMENT_NODE:
+            return False
+        elif child.tagName != 'photometry':
+            return False
+        elif child.hasChildNodes():
+            return False
+        else:
+            num_photometry += 1
+
+            for attribute in child.attributes.keys():
+                if (_PHOTOMETRY_COLUMNS.get(attribute)
+                        not in table.colnames):
+                    return False
+
+    return num_photometry <= 1
+
+
+def _format_targets(template, table):
+
+    # Get the lines of the target elements of a table, relative to the
+    # indentation of the template
+
+    target_attribute_list = get_attribute_names(template)
+    target_value_list = [
+        _format_column(table[_TARGET_COLUMNS[attribute]], attribute)
+        for attribute in target_attribute_list
+    ]
+
+    photometry_list = template.getElementsByTagName('photometry')
+
+    if len(photometry_list) == 0:
+        return _format_elements('target', target_attribute_list,
+                                target_value_list, '')
+
+    photometry = photometry_list[0]
+
+    photometry_attribute_list = get_attribute_names(photometry)
+    photometry_value_list = [
+        _format_column(table[_PHOTOMETRY_COLUMNS[attribute]], attribute)
+        for attribute in photometry_attribute_list
+    ]
+
+    target_lines = _format_elements('target', target_attribute_list,
+                                    target_value_list, '')
+    photometry_lines = _format_elements('photometry',
+                                        photometry_attribute_list,
+                                        photometry_value_list, '  ')
+
+    lines = []
+
+    for target_line, photometry_line in zip(target_lines,
+                                            photometry_lines):
+        lines.append(target_line[:-2] + '>')
+        lines.append(photometry_line)
+        lines.append('</target>')
+
+    return lines
+
+
+def _get_targuse_column(table):
+
+    targuse_column = np.ma.getdata(table['TARGUSE'])
+
+    if targuse_column.dtype.kind == 'S':
+        targuse_column = np.char.decode(targuse_column, 'utf-8')
+
+    return targuse_column
+
+
+class TargetBlockWriter:
+    """
+    A writer which adds targets to an OB XML as blocks of text.
+
+    Adding the targets of a full MOS OB one DOM element at a time, and then
+    pretty-printing them, dominates the time spent in stage 3. This writer
+    formats every attribute of the targets column-wise from the table, and
+    keeps only a placeholder in the DOM for each block of targets. The blocks
+    are written in place of the placeholders by an XMLStreamWriter, which
+    produces the same file as adding the targets with
+    OBXML._add_table_as_targets and writing it with OBXML.write_xml.
+
+    Parameters
+    ----------
+    ob_xml : OBXML
+        The OB XML to which the targets will be added.
+    """
+
+    def __init__(self, ob_xml):
+
+        self.ob_xml = ob_xml
+
+        self._field = ob_xml.fields.getElementsByTagName('field')[0]
+        self._blocks = []
+
+    def _get_templates(self):
+
+        # Get the template targets in the field indexed by their targuse
+
+        templates = {}
+
+        for target in self._field.getElementsByTagName('target'):
+            if target.getAttribute('targsrvy') == '%%%':
+                templates[target.getAttribute('targuse')] = target
+
+        return templates
+
+    def add_table(self, table):
+        """
+        Add the rows of a table as targets of the OB.
+
+        Parameters
+        ----------
+        table : astropy.table.Table
+            A table with the targets, as read from a target catalogue.
+        """
+
+        if len(table) == 0:
+            return
+
+        templates = self._get_templates()
+
+        targuse_column = _get_targuse_column(table)
+
+        targuse_list = list(np.unique(targuse_column))
+
+        if not all((targuse in templates)
+                   and _is_supported(templates[targuse], table)
+                   for targuse in targuse_list):
+            self.ob_xml._add_table_as_targets(table)
+            return
+
+        # Each target is added right after its template, so the targets of
+        # each template end up in the reverse order of the table
+
+        for targuse in targuse_list:
+            template = templates[targuse]
+
+            rows = np.where(targuse_column == targuse)[0][::-1]
+
+            lines = _format_targets(template, table[rows])
+
+            placeholder = template.ownerDocument.createComment(
+                '{}{}'.format(_PLACEHOLDER_PREFIX, len(self._blocks)))
+            self._field.insertBefore(placeholder, template.nextSibling)
+
+            self._blocks.append(lines)
+
+    def clean_targets(self):
+        """
+        Remove the template targets of the OB.
+        """
+
+        for field in self.ob_xml.fields.getElementsByTagName('field'):
+            for target in field.getElementsByTagName('target'):
+                if target.getAttribute('targsrvy') == '%%%':
+                    field.removeChild(target)
+
+    def _get_block(self, comment):
+
+        # Get the lines of the block of targets of a placeholder
+
+        if comment.data.startswith(_PLACEHOLDER_PREFIX):
+            return self._blocks[int(comment.data[len(_PLACEHOLDER_PREFIX):])]
+
+        return None
+
+    def _get_stream_writer(self, compact):
+
+        return XMLStreamWriter(self.ob_xml.fields.ownerDocument,
+                               compact=compact,
+                               comment_handler=self._get_block)
+
+    def write_xml(self, filename, compact=False):
+        """
+        Write the OB XML to a file, including the blocks of targets.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the output file.
+        compact : bool, optional
+            Drop the comments with the documentation of the template.
+        """
+
+        self._get_stream_writer(compact).write(filename)
+
+    def get_text(self, compact=False):
+        """
+        Get the text of the OB XML, including the blocks of targets.
+
+        Parameters
+        ----------
+        compact : bool, optional
+            Drop the comments with the documentation of the template.
+
+        Returns
+        -------
+        text : str
+            The text which would be written by write_xml.
+        """
+
+        return self._get_stream_writer(compact).get_text()
+
+
+class TargetTextWriter:
+    """
+    A writer which adds targets to the text of an OB XML.
+
+    It is the counterpart of TargetBlockWriter for an OB read with OBText: the
+    blocks of targets are inserted after the lines of their templates, and the
+    rest of the lines of the OB are written verbatim, so the OB is never built
+    as a DOM. For an OB with the layout written by OBXML.write_xml, the output
+    is the same as the one of TargetBlockWriter.
+
+    Parameters
+    ----------
+    ob_text : OBText
+        The OB XML to which the targets will be added.
+    """
+
+    def __init__(self, ob_text):
+
+        self.ob_text = ob_text
+
+        self._templates = ob_text.get_templates()
+
+        # The blocks of targets to be inserted after the last line of each
+        # template, and the lines to be removed
+
+        self._block_dict = {}
+        self._removed_line_set = set()
+
+    def add_table(self, table):
+        """
+        Add the rows of a table as targets of the OB.
+
+        Parameters
+        ----------
+        table : astropy.table.Table
+            A table with the targets, as read from a target catalogue.
+
+        Raises
+        ------
+        ValueError
+            If the targets need a template which is not in the OB or which
+            cannot be handled by the writer. The OB is left unchanged.
+        """
+
+        if len(table) == 0:
+            return
+
+        targuse_column = _get_targuse_column(table)
+
+        targuse_list = list(np.unique(targuse_column))
+
+        for targuse in targuse_list:
+            if targuse not in self._templates:
+                raise ValueError('No template target for TARGUSE={}'.format(
+                    targuse))
+
+            if not _is_supported(self._templates[targuse][0], table):
+                raise ValueError(
+                    'Unsupported template target for TARGUSE={}'.format(
+                        targuse))
+
+        # Each block is inserted right after its template, so the targets of
+        # each template end up in the reverse order of the table, and the
+        # blocks in the reverse order in which they are added
+
+        for targuse in targuse_list:
+            template, target = self._templates[targuse]
+
+            rows = np.where(targuse_column == targuse)[0][::-1]
+
+            indent = self.ob_text.get_indent(target)
+
+            lines = [
+                indent + line
+                for line in _format_targets(template, table[rows])
+            ]
+
+            self._block_dict.setdefault(target['last_line'], []).insert(
+                0, lines)
+
+    def clean_targets(self):
+        """
+        Remove the template targets of the OB.
+        """
+
+        for target in self.ob_text.targets:
+            if self.ob_text.is_template(target):
+                self._removed_line_set.update(
+                    range(target['first_line'], target['last_line'] + 1))
+
+    def get_text(self, compact=False):
+        """
+        Get the text of the OB XML, including the blocks of targets.
+
+        Parameters
+        ----------
+        compact : bool, optional
+            Drop the comments with the documentation of the template.
+
+        Returns
+        -------
+        text : str
+            The text which would be written by write_xml.
+        """
+
+        output_line_list = []
+
+        in_comment = False
+
+        for i, line in enumerate(self.ob_text.lines):
+
+            # Comments are on lines of their own in the layout of write_xml
+
+            if compact and (in_comment or line.lstrip().startswith('<!--')):
+                in_comment = '-->' not in line
+            elif i not in self._removed_line_set:
+                output_line_list.append(line)
+
+            for lines in self._block_dict.get(i, []):
+                output_line_list.extend(lines)
+
+        return '\n'.join(output_line_list)
+
+    def write_xml(self, filename, compact=False):
+        """
+        Write the OB XML to a file, including the blocks of targets.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the output file.
+        compact : bool, optional
+            Drop the comments with the documentation of the template.
+        """
+
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            f.write(self.get_text(compact=compact))
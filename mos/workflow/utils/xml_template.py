@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import logging
+import os
+import xml.dom.minidom
+
+
+class XMLTemplate:
+    """
+    A blank XML template which is parsed only once.
+
+    The parsed document is kept as a prototype which is never modified, and
+    each OB gets a deep copy of it, which is much cheaper than parsing the
+    large and comment-heavy template again.
+
+    Parameters
+    ----------
+    filename : str
+        A blank XML template.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        self._prototype = xml.dom.minidom.parse(filename)
+
+        self._last_clone = None
+
+    @property
+    def datamver(self):
+        """
+        The DATAMVER of the template.
+        """
+
+        return self._prototype.childNodes[0].getAttribute('datamver')
+
+    def clone(self):
+        """
+        Get a deep copy of the parsed template.
+
+        Returns
+        -------
+        dom : xml.dom.minidom.Document
+            A new document with the same content as the template.
+        """
+
+        return self._prototype.cloneNode(True)
+
+    def pop_last_clone(self):
+        """
+        Get the last copy of the template served by parse_from_memory.
+
+        The copy is forgotten, so each call only returns a document once.
+
+        Returns
+        -------
+        dom : xml.dom.minidom.Document or None
+            The document served by the last parse of the template, as modified
+            by the code which parsed it, or None if it has not been served
+            since the previous call.
+        """
+
+        dom = self._last_clone
+        self._last_clone = None
+
+        return dom
+
+    def _is_template_file(self, file):
+
+        return _is_same_file(file, self.filename)
+
+    def parse_from_memory(self, *modules):
+        """
+        Serve the parsing of the template file from the prototype.
+
+        While the context is active, the given modules get a deep copy of the
+        prototype when they call xml.dom.minidom.parse with the template file,
+        so code which receives the filename of the template (e.g. the OB
+        processing of the IFU workflow) does not parse it again for each OB.
+        Only the name through which each module reaches the function is
+        replaced, so xml.dom.minidom.parse is unchanged for the rest of the
+        code. Any other file, a file object or a call with further arguments
+        is parsed as usual. The last copy served can be obtained with
+        pop_last_clone, e.g. to use the document of an OB once it has been
+        written without parsing its file.
+
+        Parameters
+        ----------
+        *modules : module
+            The modules which parse the template, e.g. the module of the class
+            of the IFU workflow which processes the OBs. The modules which do
+            not use xml.dom.minidom are left untouched, so if none of them
+            uses it, the template is parsed as usual for each OB.
+        """
+
+        def parse(file, *args, **kwargs):
+            if (len(args) == 0) and (len(kwargs) == 0) and \
+                    self._is_template_file(file):
+                self._last_clone = self.clone()
+                return self._last_clone
+
+            return xml.dom.minidom.parse(file, *args, **kwargs)
+
+        return _patch_parse(modules, parse)
+
+
+def parse_document_from_memory(filename, dom, *modules):
+    """
+    Serve the parsing of a file from a document already in memory.
+
+    While the context is active, the first call of the given modules to
+    xml.dom.minidom.parse with the file gets the document instead of parsing
+    the file, as with XMLTemplate.parse_from_memory. Any further call is
+    parsed as usual, so the document is never shared.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file, whose content is the same as the document.
+    dom : xml.dom.minidom.Document
+        The document served instead of parsing the file.
+    *modules : module
+        The modules which parse the file, e.g. the module of OBXML.
+    """
+
+    served_list = []
+
+    def parse(file, *args, **kwargs):
+        if (len(args) == 0) and (len(kwargs) == 0) and \
+                (len(served_list) == 0) and _is_same_file(file, filename):
+            served_list.append(dom)
+            return dom
+
+        return xml.dom.minidom.parse(file, *args, **kwargs)
+
+    return _patch_parse(modules, parse)
+
+
+def _is_same_file(file, filename):
+
+    # Check whether the argument of a call to parse is a given file, accepting
+    # only paths and not file objects
+
+    if not isinstance(file, str):
+        return False
+
+    return os.path.realpath(file) == os.path.realpath(filename)
+
+
+class _ModuleProxy:
+
+    # A stand-in for a module, which overrides some of its attributes and takes
+    # the rest from the module
+
+    def __init__(self, module, **attributes):
+
+        self.__dict__['_module'] = module
+        self.__dict__.update(attributes)
+
+    def __getattr__(self, name):
+
+        return getattr(self.__dict__['_module'], name)
+
+
+def _get_parse_replacement(module, parse):
+
+    # Get the name by which a module reaches xml.dom.minidom.parse depending
+    # on how it imported it and the object replacing it, or None if the module
+    # does not use it
+
+    minidom_proxy = _ModuleProxy(xml.dom.minidom, parse=parse)
+
+    if getattr(module, 'parse', None) is xml.dom.minidom.parse:
+        return 'parse', parse
+    elif getattr(module, 'minidom', None) is xml.dom.minidom:
+        return 'minidom', minidom_proxy
+    elif getattr(module, 'xml', None) is xml:
+        xml_proxy = _ModuleProxy(xml,
+                                 dom=_ModuleProxy(xml.dom,
+                                                  minidom=minidom_proxy))
+        return 'xml', xml_proxy
+    else:
+        return None
+
+
+@contextlib.contextmanager
+def _patch_parse(modules, parse):
+
+    # Replace xml.dom.minidom.parse only for some modules, restoring their
+    # attributes when the context exits
+
+    replacement_list = []
+
+    for module in modules:
+        replacement = _get_parse_replacement(module, parse)
+
+        if replacement is not None:
+            name, value = replacement
+            replacement_list.append((module, name, getattr(module, name),
+                                     value))
+
+    if len(replacement_list) == 0:
+        logging.debug('None of the modules uses xml.dom.minidom.parse, so the '
+                      'files are parsed as usual: {}'.format(', '.join(
+                          module.__name__ for module in modules)))
+
+    try:
+        for module, name, original_value, value in replacement_list:
+            setattr(module, name, value)
+
+        yield
+    finally:
+        for module, name, original_value, value in replacement_list:
+            setattr(module, name, original_value)
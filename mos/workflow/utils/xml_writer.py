@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import sys
+import xml.dom.minidom
+
+# The types of nodes written by XMLStreamWriter itself; any element containing
+# other types of nodes is written by minidom
+
+_SUPPORTED_NODE_TYPES = (xml.dom.minidom.Node.ELEMENT_NODE,
+                         xml.dom.minidom.Node.TEXT_NODE,
+                         xml.dom.minidom.Node.COMMENT_NODE)
+
+
+def _escape(data):
+
+    # Escape the character data in the same way as minidom, skipping the
+    # replacements for the usual values which do not need them
+
+    if ('&' not in data) and ('<' not in data) and ('"' not in data) and (
+            '>' not in data):
+        return data
+
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '"', '&quot;').replace('>', '&gt;')
+
+
+def get_attribute_names(element):
+    """
+    Get the names of the attributes of an element in the order used by minidom.
+
+    Parameters
+    ----------
+    element : xml.dom.minidom.Element
+        An element.
+
+    Returns
+    -------
+    name_list : list of str
+        The names of its attributes, in insertion order since Python 3.8 and
+        sorted before it.
+    """
+
+    names = list(element.attributes.keys())
+
+    if sys.version_info < (3, 8):
+        names.sort()
+
+    return names
+
+
+class _LineSink:
+
+    # A file-like object which drops the blank lines of the text written to it
+    # and writes the rest to a file in batches
+
+    def __init__(self, f, batch_size=1000):
+
+        self._f = f
+        self._batch_size = batch_size
+
+        self._lines = []
+        self._pending = []
+
+    def add_line(self, line):
+
+        # Add a complete line, which may contain newlines itself
+
+        if self._pending:
+            self.write(line + '\n')
+        elif '\n' in line:
+            for part in line.split('\n'):
+                self._add_complete_line(part)
+        else:
+            self._add_complete_line(line)
+
+    def _add_complete_line(self, line):
+
+        if line.strip() == '':
+            return
+
+        self._lines.append(line)
+
+        if len(self._lines) >= self._batch_size:
+            self._flush_lines()
+
+    def _flush_lines(self):
+
+        if self._lines:
+            self._f.write('\n'.join(self._lines) + '\n')
+            self._lines = []
+
+    def write(self, data):
+
+        # Write an arbitrary piece of text, as minidom does
+
+        if '\n' not in data:
+            self._pending.append(data)
+            return
+
+        part_list = data.split('\n')
+
+        self._pending.append(part_list[0])
+        self._add_complete_line(''.join(self._pending))
+
+        for part in part_list[1:-1]:
+            self._add_complete_line(part)
+
+        self._pending = [part_list[-1]]
+
+    def close(self):
+
+        self._add_complete_line(''.join(self._pending))
+        self._pending = []
+
+        self._flush_lines()
+
+
+class XMLStreamWriter:
+    """
+    A writer which serialises an OB XML document as a stream of lines.
+
+    The output is the same as the one of OBXML.write_xml, i.e. the document
+    pretty-printed by minidom with an indentation of two spaces and without
+    blank lines, but the lines are written to the file in batches while the
+    document is walked, instead of building the whole pretty-printed document
+    and several copies of it in memory.
+
+    Parameters
+    ----------
+    document : xml.dom.minidom.Document
+        The document to be written, e.g. ob_xml.fields.ownerDocument.
+    compact : bool, optional
+        Drop the comments, i.e. the documentation of the template, from the
+        output.
+    comment_handler : callable, optional
+        A function which receives each comment node and returns either None,
+        to write the comment as usual, or a list of lines which are written
+        instead of it with the indentation of the comment. It is called even
+        in compact mode.
+    """
+
+    def __init__(self, document, compact=False, comment_handler=None):
+
+        self.document = document
+        self.compact = compact
+        self.comment_handler = comment_handler
+
+        self._indent = '  '
+
+    def _write_comment(self, sink, comment, indent):
+
+        if self.comment_handler is not None:
+            line_list = self.comment_handler(comment)
+
+            if line_list is not None:
+                for line in line_list:
+                    sink.add_line(indent + line)
+
+                return
+
+        if self.compact:
+            return
+
+        if '--' in comment.data:
+            raise ValueError("'--' is not allowed in a comment node")
+
+        sink.add_line('{}<!--{}-->'.format(indent, comment.data))
+
+    def _write_element(self, sink, element, indent):
+
+        child_list = element.childNodes
+
+        # Let minidom write the unusual elements, since its output depends on
+        # the version of Python for them
+
+        if any(child.nodeType not in _SUPPORTED_NODE_TYPES
+               for child in child_list):
+            element.writexml(sink, indent, self._indent, '\n')
+            return
+
+        if self.compact and (self.comment_handler is None):
+            child_list = [
+                child for child in child_list
+                if child.nodeType != child.COMMENT_NODE
+            ]
+
+        attribute_list = element.attributes.items()
+
+        if sys.version_info < (3, 8):
+            attribute_list.sort()
+
+        start = indent + '<' + element.tagName + ''.join([
+            ' ' + name + '="' + _escape(value) + '"'
+            for name, value in attribute_list
+        ])
+
+        if len(child_list) == 0:
+            sink.add_line(start + '/>')
+        elif ((len(child_list) == 1)
+              and (child_list[0].nodeType == child_list[0].TEXT_NODE)):
+            sink.add_line('{}>{}</{}>'.format(start,
+                                              _escape(child_list[0].data),
+                                              element.tagName))
+        else:
+            sink.add_line(start + '>')
+
+            child_indent = indent + self._indent
+
+            for child in child_list:
+                self._write_node(sink, child, child_indent)
+
+            sink.add_line('{}</{}>'.format(indent, element.tagName))
+
+    def _write_node(self, sink, node, indent):
+
+        if node.nodeType == node.ELEMENT_NODE:
+            self._write_element(sink, node, indent)
+        elif node.nodeType == node.TEXT_NODE:
+
+            # The text nodes made only of whitespace would be blank lines
+
+            if node.data.strip() != '':
+                sink.add_line(_escape(indent + node.data))
+
+        elif node.nodeType == node.COMMENT_NODE:
+            self._write_comment(sink, node, indent)
+        else:
+            node.writexml(sink, indent, self._indent, '\n')
+
+    def _write_lines(self, f):
+
+        sink = _LineSink(f)
+
+        sink.add_line('<?xml version="1.0" encoding="utf-8"?>')
+
+        for node in self.document.childNodes:
+            self._write_node(sink, node, '')
+
+        sink.close()
+
+    def write(self, filename):
+        """
+        Write the document to a file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the output file.
+        """
+
+        with open(filename, 'w', encoding='utf-8',
+                  errors='xmlcharrefreplace', newline='\n') as f:
+            self._write_lines(f)
+
+    def get_text(self):
+        """
+        Get the text which would be written to a file.
+
+        Returns
+        -------
+        text : str
+            The serialised document.
+        """
+
+        f = io.StringIO()
+
+        self._write_lines(f)
+
+        return f.getvalue()
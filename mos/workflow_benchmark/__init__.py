@@ -0,0 +1,16 @@
+from mos.workflow.utils.lazy_module import set_lazy_attributes
+
+set_lazy_attributes(
+    __name__, {
+        'create_field_cat': ('.generate_catalogues', 'create_field_cat'),
+        'create_target_cat': ('.generate_catalogues', 'create_target_cat'),
+        'get_field_data_dict': ('.generate_catalogues', 'get_field_data_dict'),
+        'get_target_data_dict':
+        ('.generate_catalogues', 'get_target_data_dict'),
+        'run_benchmarks': ('.run_benchmarks', 'run_benchmarks'),
+        'compare_results': ('.compare_benchmarks', 'compare_results'),
+        'measure_import_time':
+        ('.measure_import_times', 'measure_import_time'),
+        'measure_import_times':
+        ('.measure_import_times', 'measure_import_times')
+    })
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import sys
+
+
+def _read_results(filename):
+
+    # Index the results of a benchmark file by stage and scale
+
+    with open(filename) as f:
+        result_list = json.load(f)['results']
+
+    result_dict = {(result['stage'], result['num_fields'],
+                    result['num_targets']): result
+                   for result in result_list}
+
+    return result_dict
+
+
+def compare_results(reference_file,
+                    new_file,
+                    threshold=1.2,
+                    quantity_list=('wall_time', 'cpu_time', 'peak_rss_mb')):
+    """
+    Compare the results of two runs of run_benchmarks.
+
+    Parameters
+    ----------
+    reference_file : str
+        A JSON file with the reference results, e.g. from a previous commit.
+    new_file : str
+        A JSON file with the new results.
+    threshold : float, optional
+        The ratio of a new value to its reference value above which it is
+        considered a regression.
+    quantity_list : list of str, optional
+        The measured quantities to compare.
+
+    Returns
+    -------
+    comparison_list : list of dict
+        A list with the reference value, the new value, their ratio and
+        whether it is a regression, for each quantity of each stage at each
+        scale found in both files.
+    """
+
+    reference_dict = _read_results(reference_file)
+    new_dict = _read_results(new_file)
+
+    comparison_list = []
+
+    for key in sorted(set(reference_dict.keys()) & set(new_dict.keys())):
+        for quantity in quantity_list:
+            reference_value = reference_dict[key][quantity]
+            new_value = new_dict[key][quantity]
+
+            if reference_value > 0:
+                ratio = new_value / reference_value
+            else:
+                ratio = float('inf') if new_value > 0 else 1.
+
+            comparison_list.append({
+                'stage': key[0],
+                'num_fields': key[1],
+                'num_targets': key[2],
+                'quantity': quantity,
+                'reference': reference_value,
+                'new': new_value,
+                'ratio': ratio,
+                'regression': ratio > threshold
+            })
+
+    return comparison_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Compare the results of two runs of the benchmarks')
+
+    parser.add_argument('reference_file',
+                        help="""a JSON file with the reference results""")
+
+    parser.add_argument('new_file',
+                        help="""a JSON file with the new results""")
+
+    parser.add_argument('--threshold',
+                        default=1.2,
+                        type=float,
+                        help="""ratio of the new to the reference values above
+                        which they are reported as regressions""")
+
+    args = parser.parse_args()
+
+    comparison_list = compare_results(args.reference_file,
+                                      args.new_file,
+                                      threshold=args.threshold)
+
+    for comparison in comparison_list:
+        print('{stage:26} {num_fields:>6} {num_targets:>9} {quantity:12} '
+              '{reference:10.3f} {new:10.3f} {ratio:6.2f}{flag}'.format(
+                  flag=' REGRESSION' if comparison['regression'] else '',
+                  **comparison))
+
+    # Exit with an error if there are regressions, so it can be used in
+    # scripts
+
+    if any(comparison['regression'] for comparison in comparison_list):
+        sys.exit(1)
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import logging
+import os
+import pathlib
+
+import numpy as np
+from astropy.io import fits
+
+import mos.workflow
+from mos.workflow.mos_stage1 import (create_mos_field_cat,
+                                     _set_keywords_info_for_example)
+from mos.workflow.mos_stage3 import create_mos_target_cat
+
+# The area of the whole sky in square degrees
+_FULL_SKY_AREA = 4 * np.pi * np.degrees(1)**2
+
+# The PROGTEMP values of the example catalogues, which are valid MOS ones
+_PROGTEMP_LIST = ['13331', '11222.1+']
+
+
+def get_field_template():
+    """
+    Get the MOS field template distributed with the package.
+
+    Returns
+    -------
+    mos_field_template : str
+        The filename of the template.
+    """
+
+    return str(
+        pathlib.Path(mos.workflow.__path__[0]) / 'mos_stage1' / 'aux' /
+        'mos_field_template.fits')
+
+
+def get_catalogue_template():
+    """
+    Get the target catalogue template distributed with the package.
+
+    Returns
+    -------
+    catalogue_template : str
+        The filename of the template.
+    """
+
+    return str(
+        pathlib.Path(mos.workflow.__path__[0]) / 'mos_stage3' / 'aux' /
+        'GA-LRHIGHLAT_CatalogueTemplate.fits')
+
+
+def get_footprint_area(num_targets, target_density=1000.):
+    """
+    Get the area of the sky covered by a catalogue with a given density.
+
+    Parameters
+    ----------
+    num_targets : int
+        The number of targets of the catalogue.
+    target_density : float, optional
+        The density of targets in square degrees.
+
+    Returns
+    -------
+    area : float
+        The area in square degrees, which is at most the whole sky.
+    """
+
+    return min(num_targets / target_density, _FULL_SKY_AREA)
+
+
+def get_random_positions(num_positions,
+                         area,
+                         center_ra=180.,
+                         center_dec=30.,
+                         random_state=None):
+    """
+    Get positions uniformly distributed in a circular region of the sky.
+
+    Parameters
+    ----------
+    num_positions : int
+        The number of positions.
+    area : float
+        The area of the region in square degrees.
+    center_ra : float, optional
+        The right ascension of the center of the region in degrees.
+    center_dec : float, optional
+        The declination of the center of the region in degrees.
+    random_state : numpy.random.RandomState, optional
+        The generator of random numbers.
+
+    Returns
+    -------
+    ra : numpy.ndarray
+        The right ascensions of the positions in degrees.
+    dec : numpy.ndarray
+        The declinations of the positions in degrees.
+    """
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    # Draw the positions uniformly in a cap around the north pole, whose area
+    # is proportional to the range of the cosine of the polar angle
+
+    min_cos_theta = 1 - 2 * min(area / _FULL_SKY_AREA, 1)
+
+    cos_theta = random_state.uniform(min_cos_theta, 1, num_positions)
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    phi = random_state.uniform(0, 2 * np.pi, num_positions)
+
+    x = sin_theta * np.cos(phi)
+    y = sin_theta * np.sin(phi)
+    z = cos_theta
+
+    # Rotate the pole to the center of the region
+
+    tilt = np.radians(90. - center_dec)
+    x, z = x * np.cos(tilt) + z * np.sin(tilt), z * np.cos(tilt) - x * np.sin(
+        tilt)
+
+    angle = np.radians(center_ra)
+    x, y = x * np.cos(angle) - y * np.sin(angle), x * np.sin(
+        angle) + y * np.cos(angle)
+
+    ra = np.degrees(np.arctan2(y, x)) % 360.
+    dec = np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+    return ra, dec
+
+
+def _full(length, value):
+
+    # An array with a constant value, using bytes for the strings to keep the
+    # memory used by the largest catalogues low
+
+    if isinstance(value, str):
+        value = value.encode('ascii')
+        dtype = 'S{}'.format(max(len(value), 1))
+    else:
+        dtype = None
+
+    return np.full(length, value, dtype=dtype)
+
+
+def get_field_data_dict(num_fields,
+                        area,
+                        center_ra=180.,
+                        center_dec=30.,
+                        seed=0):
+    """
+    Get the data of a synthetic MOS field list.
+
+    The field centers are uniformly distributed in a circular region of the
+    sky, and their PROGTEMP is chosen at random among valid MOS values.
+
+    Parameters
+    ----------
+    num_fields : int
+        The number of fields.
+    area : float
+        The area of the region covered by the fields in square degrees.
+    center_ra : float, optional
+        The right ascension of the center of the region in degrees.
+    center_dec : float, optional
+        The declination of the center of the region in degrees.
+    seed : int, optional
+        The seed of the generator of random numbers.
+
+    Returns
+    -------
+    data_dict : dict
+        A dictionary with the columns of the MOS field list, to be used with
+        create_mos_field_cat.
+    """
+
+    random_state = np.random.RandomState(seed)
+
+    ra, dec = get_random_positions(num_fields,
+                                   area,
+                                   center_ra=center_ra,
+                                   center_dec=center_dec,
+                                   random_state=random_state)
+
+    data_dict = {}
+
+    data_dict['TARGSRVY'] = _full(num_fields, 'GA-LRHIGHLAT')
+    data_dict['FIELD_NAME'] = np.array(
+        ['F{:05d}'.format(i + 1) for i in range(num_fields)])
+    data_dict['PROGTEMP'] = random_state.choice(_PROGTEMP_LIST, num_fields)
+    data_dict['OBSTEMP'] = _full(num_fields, 'DACEB')
+    data_dict['FIELD_RA'] = ra
+    data_dict['FIELD_DEC'] = dec
+    data_dict['MAX_FIBRES'] = _full(num_fields, 1000)
+
+    return data_dict
+
+
+def get_target_data_dict(catalogue_template,
+                         num_targets,
+                         area,
+                         center_ra=180.,
+                         center_dec=30.,
+                         seed=0):
+    """
+    Get the data of a synthetic target catalogue.
+
+    The targets are uniformly distributed in a circular region of the sky, so
+    their density is the number of targets over its area. Their TARGUSE,
+    TARGPRIO, PROGTEMP and magnitudes are chosen at random, and the rest of
+    the columns of the template are filled with their null values as in the
+    example catalogue.
+
+    Parameters
+    ----------
+    catalogue_template : str
+        A FITS file containing a catalogue template.
+    num_targets : int
+        The number of targets.
+    area : float
+        The area of the region covered by the targets in square degrees.
+    center_ra : float, optional
+        The right ascension of the center of the region in degrees.
+    center_dec : float, optional
+        The declination of the center of the region in degrees.
+    seed : int, optional
+        The seed of the generator of random numbers.
+
+    Returns
+    -------
+    data_dict : dict
+        A dictionary with the columns of the target catalogue, to be used with
+        create_mos_target_cat.
+    """
+
+    # Use a different sequence of random numbers than for the fields
+
+    random_state = np.random.RandomState(seed + 1)
+
+    ra, dec = get_random_positions(num_targets,
+                                   area,
+                                   center_ra=center_ra,
+                                   center_dec=center_dec,
+                                   random_state=random_state)
+
+    data_dict = {}
+
+    data_dict['TARGSRVY'] = _full(num_targets, 'GA-LRHIGHLAT')
+    data_dict['TARGCAT'] = _full(num_targets, 'GA-LRHIGHLAT_2020A1')
+    data_dict['TARGPROG'] = np.array(['POI|EMP', 'POI|BHB'],
+                                     dtype='S')[random_state.randint(
+                                         2, size=num_targets)]
+    data_dict['TARGID'] = np.arange(num_targets)
+    data_dict['TARGNAME'] = _full(num_targets, '')
+    data_dict['TARGUSE'] = np.where(
+        random_state.uniform(size=num_targets) < 0.9, b'T', b'S')
+    data_dict['TARGCLASS'] = _full(num_targets, 'STAR')
+
+    data_dict['TARGPRIO'] = np.where(
+        random_state.uniform(size=num_targets) < 0.2, 10.0,
+        1.0).astype(np.float32)
+
+    data_dict['PROGTEMP'] = np.array(_PROGTEMP_LIST,
+                                     dtype='S')[random_state.randint(
+                                         len(_PROGTEMP_LIST),
+                                         size=num_targets)]
+    data_dict['OBSTEMP'] = _full(num_targets, 'DACEB')
+
+    data_dict['GAIA_RA'] = ra
+    data_dict['GAIA_DEC'] = dec
+    data_dict['GAIA_ID'] = _full(num_targets, '')
+    data_dict['GAIA_DR'] = _full(num_targets, '')
+    data_dict['GAIA_EPOCH'] = _full(num_targets, np.float32(2015.5))
+
+    for name in [
+            'GAIA_PMRA', 'GAIA_PMRA_ERR', 'GAIA_PMDEC', 'GAIA_PMDEC_ERR',
+            'GAIA_PARAL', 'GAIA_PARAL_ERR'
+    ]:
+        data_dict[name] = _full(num_targets, np.float32(0.0))
+
+    # Add photometry elements
+
+    data_dict['MAG_G'] = random_state.uniform(12, 20, num_targets).astype(
+        np.float32)
+    data_dict['MAG_G_ERR'] = _full(num_targets, np.float32(0.1))
+    data_dict['MAG_R'] = (data_dict['MAG_G'] - random_state.uniform(
+        0, 1, num_targets)).astype(np.float32)
+    data_dict['MAG_R_ERR'] = _full(num_targets, np.float32(0.1))
+
+    # Fill up other columns with their null or meaningless values
+
+    with fits.open(catalogue_template) as hdul:
+        for column in hdul[1].columns:
+            if column.name not in data_dict:
+                if column.null is not None:
+                    data_dict[column.name] = _full(num_targets, column.null)
+                elif 'A' in column.format:
+                    data_dict[column.name] = _full(num_targets, '')
+                elif 'E' in column.format:
+                    data_dict[column.name] = _full(num_targets,
+                                                   np.float32(0.0))
+                elif 'D' in column.format:
+                    data_dict[column.name] = _full(num_targets, 0.0)
+                elif 'I' in column.format:
+                    data_dict[column.name] = _full(num_targets, 0)
+
+    return data_dict
+
+
+def create_field_cat(output_filename,
+                     num_fields,
+                     area,
+                     center_ra=180.,
+                     center_dec=30.,
+                     seed=0,
+                     mos_field_template=None,
+                     overwrite=False):
+    """
+    Create a synthetic MOS field list with create_mos_field_cat.
+
+    Parameters
+    ----------
+    output_filename : str
+        The name of the output file.
+    num_fields : int
+        The number of fields.
+    area : float
+        The area of the region covered by the fields in square degrees.
+    center_ra : float, optional
+        The right ascension of the center of the region in degrees.
+    center_dec : float, optional
+        The declination of the center of the region in degrees.
+    seed : int, optional
+        The seed of the generator of random numbers.
+    mos_field_template : str, optional
+        A FITS file containing an MOS field template. By default, the template
+        distributed with the package.
+    overwrite : bool, optional
+        Overwrite the output file.
+
+    Returns
+    -------
+    output_filename : str
+        The name of the output file.
+    """
+
+    if mos_field_template is None:
+        mos_field_template = get_field_template()
+
+    data_dict = get_field_data_dict(num_fields,
+                                    area,
+                                    center_ra=center_ra,
+                                    center_dec=center_dec,
+                                    seed=seed)
+
+    trimester, author, report_verbosity, cc_report = \
+        _set_keywords_info_for_example()
+
+    create_mos_field_cat(mos_field_template,
+                         data_dict,
+                         output_filename,
+                         trimester,
+                         author,
+                         report_verbosity=report_verbosity,
+                         cc_report=cc_report,
+                         overwrite=overwrite)
+
+    return output_filename
+
+
+def create_target_cat(output_filename,
+                      num_targets,
+                      area,
+                      center_ra=180.,
+                      center_dec=30.,
+                      seed=0,
+                      catalogue_template=None,
+                      overwrite=False):
+    """
+    Create a synthetic target catalogue with create_mos_target_cat.
+
+    Parameters
+    ----------
+    output_filename : str
+        The name of the output file.
+    num_targets : int
+        The number of targets.
+    area : float
+        The area of the region covered by the targets in square degrees.
+    center_ra : float, optional
+        The right ascension of the center of the region in degrees.
+    center_dec : float, optional
+        The declination of the center of the region in degrees.
+    seed : int, optional
+        The seed of the generator of random numbers.
+    catalogue_template : str, optional
+        A FITS file containing a catalogue template. By default, the template
+        distributed with the package.
+    overwrite : bool, optional
+        Overwrite the output file.
+
+    Returns
+    -------
+    output_filename : str
+        The name of the output file.
+    """
+
+    if catalogue_template is None:
+        catalogue_template = get_catalogue_template()
+
+    data_dict = get_target_data_dict(catalogue_template,
+                                     num_targets,
+                                     area,
+                                     center_ra=center_ra,
+                                     center_dec=center_dec,
+                                     seed=seed)
+
+    trimester, author, report_verbosity, cc_report = \
+        _set_keywords_info_for_example()
+
+    create_mos_target_cat(catalogue_template,
+                          data_dict,
+                          output_filename,
+                          trimester,
+                          author,
+                          report_verbosity=report_verbosity,
+                          cc_report=cc_report,
+                          overwrite=overwrite)
+
+    return output_filename
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Create a synthetic MOS field list and target catalogue')
+
+    parser.add_argument('--num_fields',
+                        default=100,
+                        type=int,
+                        help="""number of fields of the MOS field list""")
+
+    parser.add_argument('--num_targets',
+                        default=100000,
+                        type=int,
+                        help="""number of rows of the target catalogue""")
+
+    parser.add_argument('--target_density',
+                        default=1000.,
+                        type=float,
+                        help="""density of targets per square degree, which
+                        sets the area covered by the fields and the
+                        targets""")
+
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        help="""seed of the generator of random numbers""")
+
+    parser.add_argument('--outdir',
+                        dest='output_dir',
+                        default='benchmark',
+                        help="""name of the directory which will contain the
+                        output files""")
+
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='overwrite the output files')
+
+    parser.add_argument('--log_level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    if not os.path.exists(args.output_dir):
+        logging.info('Creating the output directory')
+        os.makedirs(args.output_dir)
+
+    area = get_footprint_area(args.num_targets, args.target_density)
+
+    create_field_cat(os.path.join(args.output_dir,
+                                  'fields-{}.fits'.format(args.num_fields)),
+                     args.num_fields,
+                     area,
+                     seed=args.seed,
+                     overwrite=args.overwrite)
+
+    create_target_cat(os.path.join(args.output_dir,
+                                   'targets-{}.fits'.format(args.num_targets)),
+                      args.num_targets,
+                      area,
+                      seed=args.seed,
+                      overwrite=args.overwrite)
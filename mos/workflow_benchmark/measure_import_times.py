@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# The packages whose import time is measured by default
+
+DEFAULT_MODULES = [
+    'mos.workflow', 'mos.workflow.utils', 'mos.workflow.mos_stage1',
+    'mos.workflow.mos_stage2', 'mos.workflow.mos_stage3',
+    'mos.workflow.mos_stage4', 'mos.workflow.mos_pipeline'
+]
+
+# The dependencies which are slow to import, and should only be imported when
+# a stage is actually run
+
+HEAVY_MODULES = ['numpy', 'astropy', 'astropy_healpix', 'matplotlib', 'ifu']
+
+_IMPORT_CODE = """
+import json
+import sys
+import time
+
+start_time = time.perf_counter()
+import {}
+import_time = time.perf_counter() - start_time
+
+print(json.dumps({{'import_time': import_time,
+                  'modules': sorted(sys.modules.keys())}}))
+"""
+
+
+def measure_import_time(module_name, repeat=5):
+    """
+    Measure the time needed to import a module in a new Python interpreter.
+
+    Parameters
+    ----------
+    module_name : str
+        The name of the module, e.g. mos.workflow.mos_stage3.
+    repeat : int, optional
+        The number of measurements. The result is the fastest one, so it does
+        not include the time to read the files into the cache of the disk.
+
+    Returns
+    -------
+    result : dict
+        A dictionary with the name of the module, its import time in seconds
+        and the list of the heavy modules which were imported with it.
+    """
+
+    assert repeat >= 1
+
+    # Run the interpreter with the same path as this one, so it finds the
+    # same packages
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+
+    import_time_list = []
+
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             _IMPORT_CODE.format(module_name)], env=env)
+
+        measurement = json.loads(output.decode('utf-8').splitlines()[-1])
+
+        import_time_list.append(measurement['import_time'])
+
+    heavy_module_list = [
+        name for name in HEAVY_MODULES if name in measurement['modules']
+    ]
+
+    result = {
+        'module': module_name,
+        'import_time': min(import_time_list),
+        'heavy_modules': heavy_module_list
+    }
+
+    return result
+
+
+def measure_import_times(module_list=DEFAULT_MODULES, repeat=5):
+    """
+    Measure the time needed to import several modules.
+
+    Parameters
+    ----------
+    module_list : list of str, optional
+        The names of the modules, each one imported in a new interpreter.
+    repeat : int, optional
+        The number of measurements of each module.
+
+    Returns
+    -------
+    result_list : list of dict
+        A list with the result of measure_import_time for each module.
+    """
+
+    return [
+        measure_import_time(module_name, repeat=repeat)
+        for module_name in module_list
+    ]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="""Measure the import time of the packages of the MOS
+        workflow""")
+
+    parser.add_argument('modules',
+                        nargs='*',
+                        default=DEFAULT_MODULES,
+                        help="""names of the modules; by default, the packages
+                        of the stages""")
+
+    parser.add_argument('--repeat',
+                        default=5,
+                        type=int,
+                        help="""number of measurements of each module; the
+                        fastest one is reported""")
+
+    parser.add_argument('--output',
+                        dest='output_file',
+                        default=None,
+                        help="""name of a JSON file for the results""")
+
+    args = parser.parse_args()
+
+    result_list = measure_import_times(args.modules, repeat=args.repeat)
+
+    for result in result_list:
+        print('{:30} {:8.1f} ms  {}'.format(
+            result['module'], 1000 * result['import_time'],
+            ' '.join(result['heavy_modules'])))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump({'results': result_list}, f, indent=2)
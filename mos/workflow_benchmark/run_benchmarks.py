@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2020 Cambridge Astronomical Survey Unit
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import astropy
+import numpy as np
+
+from workflow.utils.get_resources import (get_blank_xml_template,
+                                          get_progtemp_file, get_obstemp_file)
+
+from mos.workflow.mos_stage2 import create_xml_files
+from mos.workflow.mos_stage3 import add_targets
+from mos.workflow.mos_stage4 import add_guide_and_calib_stars
+from mos.workflow_benchmark.generate_catalogues import (create_field_cat,
+                                                        create_target_cat,
+                                                        get_footprint_area)
+
+# The scales of the benchmarks as pairs of numbers of fields and targets: the
+# default ones run in minutes, while the full ones reach the size of the
+# catalogues of a whole trimester (the largest target catalogue takes about
+# 13 GB of disk)
+
+DEFAULT_SCALES = [(10, 1000), (100, 10000), (1000, 100000)]
+
+FULL_SCALES = [(10, 1000), (100, 10000), (1000, 100000), (10000, 1000000),
+               (10000, 10000000)]
+
+
+def _get_peak_rss():
+
+    # The peak resident set size of the process in bytes. On Linux, it is read
+    # from /proc, since the maximum reported by getrusage is inherited from
+    # the parent across exec; elsewhere, getrusage reports it in kilobytes
+    # (Linux) or bytes (macOS)
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    return peak_rss
+
+
+def _measure(function, args, kwargs):
+
+    # Run a function measuring its wall time, CPU time and the peak memory of
+    # the process, which runs only this function
+
+    peak_rss_before = _get_peak_rss()
+
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+
+    output_file_list = function(*args, **kwargs)
+
+    wall_time = time.perf_counter() - start_wall_time
+    cpu_time = time.process_time() - start_cpu_time
+
+    peak_rss = _get_peak_rss()
+
+    measurement = {
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'peak_rss_mb': peak_rss / 2**20,
+        'rss_increase_mb': (peak_rss - peak_rss_before) / 2**20,
+        'num_outputs': len(output_file_list)
+    }
+
+    return output_file_list, measurement
+
+
+def _measure_in_new_process(function, args, kwargs):
+
+    # Spawn a new process for each measurement, so its peak memory is not
+    # inherited from previous runs or from the parent process
+
+    context = multiprocessing.get_context('spawn')
+
+    pool = context.Pool(1)
+
+    try:
+        output_file_list, measurement = pool.apply(_measure,
+                                                   (function, args, kwargs))
+    finally:
+        pool.close()
+        pool.join()
+
+    return output_file_list, measurement
+
+
+def _get_git_commit():
+
+    # The commit of the package, if it is in a git repository
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return commit
+
+
+def _get_metadata():
+
+    metadata = {
+        'date': datetime.datetime.now().isoformat(),
+        'git_commit': _get_git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'astropy': astropy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count()
+    }
+
+    return metadata
+
+
+def _write_results(output_file, metadata, result_list):
+
+    result_dict = {'metadata': metadata, 'results': result_list}
+
+    with open(output_file, 'w') as f:
+        json.dump(result_dict, f, indent=2)
+
+
+def run_benchmarks(scale_list,
+                   work_dir,
+                   xml_template,
+                   output_file,
+                   progtemp_file=None,
+                   obstemp_file=None,
+                   target_density=1000.,
+                   seed=0,
+                   last_stage=4,
+                   plot_mode='inline',
+                   repeat=1):
+    """
+    Time and memory-profile the stages 2 to 4 with synthetic catalogues.
+
+    For each scale, a MOS field list and a target catalogue are created (or
+    reused from a previous run) in the work directory, and create_xml_files,
+    add_targets and add_guide_and_calib_stars are run on them one after
+    another. Each stage runs in a new process, so its peak memory is measured
+    on its own.
+
+    Parameters
+    ----------
+    scale_list : list of tuple
+        The scales of the benchmarks, as pairs with the number of fields and
+        the number of targets.
+    work_dir : str
+        Name of the directory which will contain the catalogues and the output
+        files of the stages.
+    xml_template : str
+        A blank XML template to be populated with the information of the OBs.
+    output_file : str
+        The name of the JSON file where the results are written. It is updated
+        after each scale.
+    progtemp_file : str, optional
+        A progtemp.dat file with the definition of PROGTEMP.
+    obstemp_file : str, optional
+        A obstemp.dat file with the definition of OBSTEMP.
+    target_density : float, optional
+        The density of targets per square degree. The fields and the targets
+        cover the same area, which is set by the number of targets.
+    seed : int, optional
+        The seed of the generator of random numbers.
+    last_stage : {2, 3, 4}, optional
+        The last stage to be run.
+    plot_mode : {'inline', 'none', 'deferred'}, optional
+        How to produce the plots of the guide and calib stars, as in
+        add_guide_and_calib_stars.
+    repeat : int, optional
+        The number of times each stage is run. The results are those of the
+        fastest run.
+
+    Returns
+    -------
+    result_list : list of dict
+        A list with the wall time, CPU time and peak memory of each stage at
+        each scale.
+    """
+
+    assert last_stage in [2, 3, 4]
+    assert repeat >= 1
+
+    metadata = _get_metadata()
+    metadata['target_density'] = target_density
+    metadata['seed'] = seed
+
+    result_list = []
+
+    for num_fields, num_targets in scale_list:
+
+        area = get_footprint_area(num_targets, target_density)
+
+        # Create the catalogues, unless they exist from a previous run
+
+        field_cat = os.path.join(
+            work_dir, 'fields-{}-{}-{}-{}.fits'.format(num_fields, num_targets,
+                                                       target_density, seed))
+        target_cat = os.path.join(
+            work_dir, 'targets-{}-{}-{}.fits'.format(num_targets,
+                                                     target_density, seed))
+
+        if not os.path.exists(field_cat):
+            logging.info('Creating {}'.format(field_cat))
+            create_field_cat(field_cat, num_fields, area, seed=seed)
+
+        if not os.path.exists(target_cat):
+            logging.info('Creating {}'.format(target_cat))
+            create_target_cat(target_cat, num_targets, area, seed=seed)
+
+        # Prepare the output directories of the stages
+
+        scale_dir = os.path.join(work_dir,
+                                 '{}x{}'.format(num_fields, num_targets))
+
+        stage_dir_list = [
+            os.path.join(scale_dir, 'stage{}'.format(stage))
+            for stage in [2, 3, 4]
+        ]
+
+        for stage_dir in stage_dir_list:
+            if not os.path.exists(stage_dir):
+                os.makedirs(stage_dir)
+
+        # Run the stages, each one taking the output files of the previous one
+
+        output_file_list = None
+
+        for stage in range(2, last_stage + 1):
+
+            if stage == 2:
+                function = create_xml_files
+                args = [field_cat, stage_dir_list[0], xml_template]
+                kwargs = {
+                    'progtemp_file': progtemp_file,
+                    'obstemp_file': obstemp_file,
+                    'overwrite': True
+                }
+            elif stage == 3:
+                function = add_targets
+                args = [output_file_list, target_cat, stage_dir_list[1]]
+                kwargs = {'overwrite': True}
+            else:
+                function = add_guide_and_calib_stars
+                args = [output_file_list, stage_dir_list[2]]
+                kwargs = {'overwrite': True, 'plot_mode': plot_mode}
+
+            measurement_list = []
+
+            for i in range(repeat):
+                output_file_list, measurement = _measure_in_new_process(
+                    function, args, kwargs)
+
+                measurement_list.append(measurement)
+
+            measurement = min(measurement_list,
+                              key=lambda measurement: measurement['wall_time'])
+
+            result = {
+                'stage': function.__name__,
+                'num_fields': num_fields,
+                'num_targets': num_targets
+            }
+            result.update(measurement)
+
+            logging.info(
+                '{stage} with {num_fields} fields and {num_targets} targets: '
+                '{wall_time:.2f} s, {cpu_time:.2f} s of CPU, '
+                '{peak_rss_mb:.1f} MB of peak memory'.format(**result))
+
+            result_list.append(result)
+
+        _write_results(output_file, metadata, result_list)
+
+    return result_list
+
+
+def _parse_scale(value):
+
+    try:
+        num_fields, num_targets = [int(float(x)) for x in value.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid scale {}: expected FIELDS:TARGETS'.format(value))
+
+    return num_fields, num_targets
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="""Time and memory-profile the stages 2 to 4 of the MOS
+        workflow with synthetic catalogues""")
+
+    parser.add_argument('--scales',
+                        nargs='+',
+                        type=_parse_scale,
+                        default=None,
+                        help="""scales of the benchmarks as FIELDS:TARGETS,
+                        e.g. 100:1e4; by default {}""".format(' '.join(
+                            '{}:{}'.format(*scale)
+                            for scale in DEFAULT_SCALES)))
+
+    parser.add_argument('--full',
+                        action='store_true',
+                        help="""use the scales up to 10000 fields and 1e7
+                        targets""")
+
+    parser.add_argument('--target_density',
+                        default=1000.,
+                        type=float,
+                        help="""density of targets per square degree""")
+
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        help="""seed of the generator of random numbers""")
+
+    parser.add_argument('--last_stage',
+                        default=4,
+                        type=int,
+                        choices=[2, 3, 4],
+                        help="""last stage to be run""")
+
+    parser.add_argument('--plot_mode',
+                        default='inline',
+                        choices=['inline', 'none', 'deferred'],
+                        help="""how to produce the plots of the guide and calib
+                        stars""")
+
+    parser.add_argument('--repeat',
+                        default=1,
+                        type=int,
+                        help="""number of runs of each stage; the fastest one
+                        is reported""")
+
+    parser.add_argument('--xml_template',
+                        default=os.path.join('aux', 'BlankXMLTemplate.xml'),
+                        help="""a blank XML template to be populated with the
+                        information of the OBs""")
+
+    parser.add_argument('--progtemp_file',
+                        default=os.path.join('aux', 'progtemp.dat'),
+                        help="""a progtemp.dat file with the definition of
+                        PROGTEMP""")
+
+    parser.add_argument('--obstemp_file',
+                        default=os.path.join('aux', 'obstemp.dat'),
+                        help="""a obstemp.dat file with the definition of
+                        OBSTEMP""")
+
+    parser.add_argument('--workdir',
+                        dest='work_dir',
+                        default='benchmark',
+                        help="""name of the directory which will contain the
+                        catalogues and the output files of the stages""")
+
+    parser.add_argument('--output',
+                        dest='output_file',
+                        default='benchmark_results.json',
+                        help="""name of the JSON file with the results""")
+
+    parser.add_argument('--log_level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    if args.scales is not None:
+        scale_list = args.scales
+    elif args.full:
+        scale_list = FULL_SCALES
+    else:
+        scale_list = DEFAULT_SCALES
+
+    if not os.path.exists(args.work_dir):
+        logging.info('Creating the work directory')
+        os.makedirs(args.work_dir)
+
+    xml_template_dir = os.path.dirname(args.xml_template)
+    if not os.path.exists(xml_template_dir):
+        logging.info('Creating the directory of the blank XML template')
+        os.makedirs(xml_template_dir)
+
+    if not os.path.exists(args.xml_template):
+        logging.info('Downloading the blank XML template')
+        get_blank_xml_template(file_path=args.xml_template)
+
+    if not os.path.exists(args.progtemp_file):
+        logging.info('Downloading the progtemp file')
+        get_progtemp_file(file_path=args.progtemp_file)
+
+    if not os.path.exists(args.obstemp_file):
+        logging.info('Downloading the obstemp file')
+        get_obstemp_file(file_path=args.obstemp_file)
+
+    run_benchmarks(scale_list,
+                   args.work_dir,
+                   args.xml_template,
+                   args.output_file,
+                   progtemp_file=args.progtemp_file,
+                   obstemp_file=args.obstemp_file,
+                   target_density=args.target_density,
+                   seed=args.seed,
+                   last_stage=args.last_stage,
+                   plot_mode=args.plot_mode,
+                   repeat=args.repeat)
@@ -0,0 +1,87 @@
+import json
+
+import numpy as np
+from astropy.table import Table
+
+import mos.workflow_benchmark
+from mos.workflow_benchmark.measure_import_times import DEFAULT_MODULES
+
+
+def test_create_catalogues(tmpdir):
+    field_cat = str(tmpdir.join('fields.fits'))
+    target_cat = str(tmpdir.join('targets.fits'))
+
+    mos.workflow_benchmark.create_field_cat(field_cat, 20, 50.)
+    mos.workflow_benchmark.create_target_cat(target_cat, 5000, 50.)
+
+    field_table = Table.read(field_cat)
+    target_table = Table.read(target_cat)
+
+    assert len(field_table) == 20
+    assert len(target_table) == 5000
+
+    # The targets are within the circle of 50 square degrees around the center
+    # of the region, i.e. within a radius of about 4 degrees
+
+    assert np.all(np.abs(target_table['GAIA_DEC'] - 30.) < 4.1)
+    assert np.all(np.abs(field_table['FIELD_DEC'] - 30.) < 4.1)
+
+
+def test_run_benchmarks(blank_xml_template, progtemp_file, obstemp_file,
+                        tmpdir):
+    output_file = str(tmpdir.join('results.json'))
+
+    result_list = mos.workflow_benchmark.run_benchmarks(
+        [(5, 1000)],
+        str(tmpdir),
+        blank_xml_template,
+        output_file,
+        progtemp_file=progtemp_file,
+        obstemp_file=obstemp_file,
+        last_stage=3)
+
+    assert [result['stage'] for result in result_list
+            ] == ['create_xml_files', 'add_targets']
+
+    for result in result_list:
+        assert result['num_outputs'] == 5
+        assert result['wall_time'] > 0
+        assert result['peak_rss_mb'] > 0
+
+    with open(output_file) as f:
+        assert json.load(f)['results'] == result_list
+
+    # The results are the same as themselves, and a slower run is reported
+
+    comparison_list = mos.workflow_benchmark.compare_results(
+        output_file, output_file)
+
+    assert not any(comparison['regression'] for comparison in comparison_list)
+
+    for result in result_list:
+        result['wall_time'] *= 2
+
+    slower_file = str(tmpdir.join('slower_results.json'))
+
+    with open(slower_file, 'w') as f:
+        json.dump({'results': result_list}, f)
+
+    comparison_list = mos.workflow_benchmark.compare_results(
+        output_file, slower_file)
+
+    assert all(comparison['regression'] == (comparison['quantity'] ==
+                                            'wall_time')
+               for comparison in comparison_list)
+
+
+def test_import_times():
+    result_list = mos.workflow_benchmark.measure_import_times(repeat=1)
+
+    assert [result['module'] for result in result_list] == DEFAULT_MODULES
+
+    # Importing the packages does not import their dependencies until a stage
+    # is used
+
+    for result in result_list:
+        assert result['import_time'] > 0
+        assert result['heavy_modules'] == []
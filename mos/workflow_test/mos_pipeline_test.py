@@ -0,0 +1,128 @@
+import os.path
+import sys
+import xml.dom.minidom
+
+import mos.workflow.mos_pipeline
+from mos.workflow_test.mos_workflow_fixtures import diff_xml_file_lists
+
+
+def test_diff_tgc_xml_files(pkg_mos_field_cat, pkg_mos_target_cat,
+                            blank_xml_template, progtemp_file, obstemp_file,
+                            pkg_mos_t_xml_files, pkg_mos_tgc_xml_files,
+                            tmpdir):
+    output_dir = tmpdir.mkdir('output')
+    intermediate_dir = tmpdir.mkdir('intermediate')
+
+    xml_filename_list = mos.workflow.mos_pipeline.run_pipeline(
+        pkg_mos_field_cat,
+        pkg_mos_target_cat,
+        str(output_dir),
+        blank_xml_template,
+        progtemp_file=progtemp_file,
+        obstemp_file=obstemp_file,
+        intermediate_dir=str(intermediate_dir))
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_tgc_xml_files)
+
+    # Only the final files are written to the output directory
+
+    assert len(output_dir.listdir()) == len(pkg_mos_tgc_xml_files)
+
+    # The intermediate files are the same as those of the stage 3
+
+    t_xml_filename_list = [
+        str(filename) for filename in intermediate_dir.listdir('*-t.xml')
+    ]
+
+    diff_xml_file_lists(t_xml_filename_list, pkg_mos_t_xml_files)
+
+
+def test_pipeline_reads_each_ob_once(pkg_mos_field_cat, pkg_mos_target_cat,
+                                     blank_xml_template, progtemp_file,
+                                     obstemp_file, pkg_mos_tgc_xml_files,
+                                     monkeypatch, tmpdir):
+    run_pipeline_module = sys.modules[
+        mos.workflow.mos_pipeline.run_pipeline.__module__]
+
+    ob_xml_class = run_pipeline_module.OBXML
+    xml_file_list = []
+
+    def read_ob_xml(xml_file):
+        xml_file_list.append(xml_file)
+        return ob_xml_class(xml_file)
+
+    def parse_string(*args, **kwargs):
+        raise AssertionError('the OB must not be parsed again')
+
+    intermediate_dir = tmpdir.mkdir('intermediate')
+    parse = xml.dom.minidom.parse
+    parsed_file_list = []
+
+    def parse_file(file, *args, **kwargs):
+        if isinstance(file, str) and os.path.dirname(
+                os.path.abspath(file)) == str(intermediate_dir):
+            parsed_file_list.append(file)
+        return parse(file, *args, **kwargs)
+
+    monkeypatch.setattr(run_pipeline_module, 'OBXML', read_ob_xml)
+    monkeypatch.setattr(xml.dom.minidom, 'parseString', parse_string)
+    monkeypatch.setattr(xml.dom.minidom, 'parse', parse_file)
+
+    output_dir = tmpdir.mkdir('output')
+
+    xml_filename_list = mos.workflow.mos_pipeline.run_pipeline(
+        pkg_mos_field_cat,
+        pkg_mos_target_cat,
+        str(output_dir),
+        blank_xml_template,
+        progtemp_file=progtemp_file,
+        obstemp_file=obstemp_file,
+        intermediate_dir=str(intermediate_dir))
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_tgc_xml_files)
+
+    # The document built by stage 2 is handed over to stage 3, which does not
+    # parse the file written by stage 2, and then to stage 4
+
+    assert len(xml_file_list) == len(pkg_mos_tgc_xml_files)
+    assert len(set(xml_file_list)) == len(xml_file_list)
+    assert parsed_file_list == []
+
+
+def test_diff_tgc_xml_files_incremental(pkg_mos_field_cat, pkg_mos_target_cat,
+                                        blank_xml_template, progtemp_file,
+                                        obstemp_file, pkg_mos_tgc_xml_files,
+                                        tmpdir):
+    output_dir = tmpdir.mkdir('output')
+
+    kwargs = {'progtemp_file': progtemp_file, 'obstemp_file': obstemp_file}
+
+    xml_filename_list = mos.workflow.mos_pipeline.run_incremental_pipeline(
+        pkg_mos_field_cat, pkg_mos_target_cat, str(output_dir),
+        blank_xml_template, **kwargs)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_tgc_xml_files)
+
+    mtime_list = [os.path.getmtime(filename) for filename in xml_filename_list]
+
+    # The inputs have not changed, so the XML files are not created again
+
+    assert mos.workflow.mos_pipeline.run_incremental_pipeline(
+        pkg_mos_field_cat, pkg_mos_target_cat, str(output_dir),
+        blank_xml_template, **kwargs) == xml_filename_list
+
+    assert [os.path.getmtime(filename)
+            for filename in xml_filename_list] == mtime_list
+
+    # A parameter of the stage 4 has changed, so they are created again
+
+    mos.workflow.mos_pipeline.run_incremental_pipeline(
+        pkg_mos_field_cat,
+        pkg_mos_target_cat,
+        str(output_dir),
+        blank_xml_template,
+        num_guide_stars_request=10,
+        **kwargs)
+
+    assert [os.path.getmtime(filename)
+            for filename in xml_filename_list] != mtime_list
@@ -1,7 +1,16 @@
 import pytest
+import glob
 import os.path
+import shutil
 import subprocess
+import xml.dom.minidom
+import numpy as np
+from astropy.io import fits
 import mos.workflow.mos_stage2
+from mos.workflow.mos_stage2.create_xml_files import (_MOSFieldCat,
+                                                      _get_group_rows,
+                                                      _get_mos_mask)
+from mos.workflow_test.mos_workflow_fixtures import diff_xml_file_lists
 
 
 @pytest.fixture(scope='module')
@@ -31,3 +40,203 @@ def test_diff_xml_files(mos_xml_files, pkg_mos_xml_files):
         returncode = subprocess.call(['diff', '-q', ref_file, copy_file])
 
         assert returncode == 0
+
+
+def test_diff_xml_files_in_pool(pkg_mos_field_cat, blank_xml_template,
+                                progtemp_file, obstemp_file, pkg_mos_xml_files,
+                                tmpdir):
+    xml_filename_list = mos.workflow.mos_stage2.create_xml_files(
+        pkg_mos_field_cat,
+        str(tmpdir),
+        blank_xml_template,
+        progtemp_file=progtemp_file,
+        obstemp_file=obstemp_file,
+        workers=2)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_xml_files)
+
+
+def test_diff_xml_files_incremental(pkg_mos_field_cat, blank_xml_template,
+                                    progtemp_file, obstemp_file,
+                                    pkg_mos_xml_files, tmpdir):
+    kwargs = {
+        'progtemp_file': progtemp_file,
+        'obstemp_file': obstemp_file,
+        'incremental': True
+    }
+
+    xml_filename_list = mos.workflow.mos_stage2.create_xml_files(
+        pkg_mos_field_cat, str(tmpdir), blank_xml_template, **kwargs)
+
+    mtime_list = [os.path.getmtime(filename) for filename in xml_filename_list]
+
+    # The XML files are up to date, so they are not generated again
+
+    assert mos.workflow.mos_stage2.create_xml_files(
+        pkg_mos_field_cat, str(tmpdir), blank_xml_template,
+        **kwargs) == xml_filename_list
+
+    assert [os.path.getmtime(filename)
+            for filename in xml_filename_list] == mtime_list
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_xml_files)
+
+
+def _write_field_cat(field_cat, output_file, rows, max_fibres_dict=None):
+
+    # Copy some rows of a field catalogue, changing MAX_FIBRES of some fields
+
+    with fits.open(field_cat) as hdu_list:
+        data = hdu_list[1].data[rows]
+
+        if max_fibres_dict is None:
+            max_fibres_dict = {}
+
+        for field_name, max_fibres in max_fibres_dict.items():
+            data['MAX_FIBRES'][data['FIELD_NAME'] == field_name] = max_fibres
+
+        fits.HDUList([
+            hdu_list[0].copy(),
+            fits.BinTableHDU(data, header=hdu_list[1].header)
+        ]).writeto(output_file, overwrite=True)
+
+
+def _create_xml_files_incremental(field_cat, output_dir, xml_template,
+                                  progtemp_file, obstemp_file):
+
+    # Run stage 2 incrementally after setting the modification time of the
+    # previous XML files to zero, and return the names of the files written
+
+    for filename in glob.glob(os.path.join(output_dir, '*.xml')):
+        os.utime(filename, (0, 0))
+
+    xml_filename_list = mos.workflow.mos_stage2.create_xml_files(
+        field_cat,
+        output_dir,
+        xml_template,
+        progtemp_file=progtemp_file,
+        obstemp_file=obstemp_file,
+        incremental=True)
+
+    written_list = sorted(
+        os.path.basename(filename) for filename in xml_filename_list
+        if os.path.getmtime(filename) != 0)
+
+    return xml_filename_list, written_list
+
+
+def test_diff_xml_files_incremental_changed_row(pkg_mos_field_cat,
+                                                blank_xml_template,
+                                                progtemp_file, obstemp_file,
+                                                tmpdir):
+    field_cat = str(tmpdir.join('field_cat.fits'))
+    output_dir = str(tmpdir.mkdir('output'))
+
+    _write_field_cat(pkg_mos_field_cat, field_cat, [0, 1])
+
+    xml_filename_list, written_list = _create_xml_files_incremental(
+        field_cat, output_dir, blank_xml_template, progtemp_file,
+        obstemp_file)
+
+    assert written_list == ['Eggs_mos_01.xml', 'Spam_mos_01.xml']
+
+    # Only the OB of the field whose row has changed is generated again
+
+    _write_field_cat(pkg_mos_field_cat,
+                     field_cat, [0, 1],
+                     max_fibres_dict={'Spam': 500})
+
+    xml_filename_list, written_list = _create_xml_files_incremental(
+        field_cat, output_dir, blank_xml_template, progtemp_file,
+        obstemp_file)
+
+    assert written_list == ['Spam_mos_01.xml']
+
+    dom = xml.dom.minidom.parse(os.path.join(output_dir, 'Spam_mos_01.xml'))
+    survey = dom.getElementsByTagName('survey')[0]
+
+    assert survey.getAttribute('max_fibres') == '500'
+
+
+def test_diff_xml_files_incremental_removed_group(pkg_mos_field_cat,
+                                                  blank_xml_template,
+                                                  progtemp_file, obstemp_file,
+                                                  tmpdir):
+    field_cat = str(tmpdir.join('field_cat.fits'))
+    output_dir = str(tmpdir.mkdir('output'))
+
+    _write_field_cat(pkg_mos_field_cat, field_cat, [0, 1])
+
+    _create_xml_files_incremental(field_cat, output_dir, blank_xml_template,
+                                  progtemp_file, obstemp_file)
+
+    # The OB of a field removed from the catalogue is deleted, and the other
+    # one is kept as it is
+
+    _write_field_cat(pkg_mos_field_cat, field_cat, [0])
+
+    xml_filename_list, written_list = _create_xml_files_incremental(
+        field_cat, output_dir, blank_xml_template, progtemp_file,
+        obstemp_file)
+
+    assert written_list == []
+    assert [os.path.basename(filename)
+            for filename in xml_filename_list] == ['Spam_mos_01.xml']
+    assert not os.path.exists(os.path.join(output_dir, 'Eggs_mos_01.xml'))
+
+
+def test_diff_xml_files_incremental_changed_template(pkg_mos_field_cat,
+                                                     blank_xml_template,
+                                                     progtemp_file,
+                                                     obstemp_file,
+                                                     pkg_mos_xml_files,
+                                                     tmpdir):
+    xml_template = str(tmpdir.join('template.xml'))
+    output_dir = str(tmpdir.mkdir('output'))
+
+    shutil.copy(blank_xml_template, xml_template)
+
+    _create_xml_files_incremental(pkg_mos_field_cat, output_dir, xml_template,
+                                  progtemp_file, obstemp_file)
+
+    # A change of the template regenerates all the OBs
+
+    with open(xml_template, 'a') as f:
+        f.write('\n')
+
+    xml_filename_list, written_list = _create_xml_files_incremental(
+        pkg_mos_field_cat, output_dir, xml_template, progtemp_file,
+        obstemp_file)
+
+    assert written_list == ['Eggs_mos_01.xml', 'Spam_mos_01.xml']
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_xml_files)
+
+
+def test_get_mos_mask(pkg_mos_field_cat, progtemp_file):
+    progtemp_dict = _MOSFieldCat(pkg_mos_field_cat)._get_progtemp_dict(
+        progtemp_file, False)
+
+    progtemp_column = np.array(['13331', 'bad', '11222.1+', '13331', 'bad'])
+
+    mos_mask, rejected_dict = _get_mos_mask(progtemp_column, progtemp_dict)
+
+    assert np.array_equal(mos_mask, [True, False, True, True, False])
+    assert list(rejected_dict.keys()) == ['bad']
+    assert np.array_equal(rejected_dict['bad'], [1, 4])
+
+
+def test_get_group_rows():
+    data = np.array([('Spam', '13331', 100.), ('Eggs', '13331', 200.),
+                     ('Spam', '13331', 100.), ('Spam', '11222.1+', 100.),
+                     ('Eggs', '13331', 200.)],
+                    dtype=[('FIELD_NAME', 'U4'), ('PROGTEMP', 'U8'),
+                           ('FIELD_RA', float)])
+
+    group_rows_list = _get_group_rows(data,
+                                      ('FIELD_NAME', 'PROGTEMP', 'FIELD_RA'))
+
+    # The groups keep the order in which they are first seen
+
+    assert [list(group_rows)
+            for group_rows in group_rows_list] == [[0, 2], [1, 4], [3]]
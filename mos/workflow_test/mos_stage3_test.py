@@ -1,8 +1,15 @@
 import pytest
+import shutil
 import subprocess
 import os.path
 
+from astropy.io import fits
+from astropy.table import Table
+from ifu.workflow.utils.classes import OBXML
+
 import mos.workflow.mos_stage3
+import mos.workflow.utils
+from mos.workflow_test.mos_workflow_fixtures import diff_xml_file_lists
 
 
 @pytest.fixture(scope='module')
@@ -68,3 +75,198 @@ def test_diff_t_xml_files(mos_t_xml_files, pkg_mos_t_xml_files):
         returncode = subprocess.call(['diff', '-q', ref_file, copy_file])
 
         assert returncode == 0
+
+
+@pytest.fixture(scope='module')
+def mos_t_xml_files_single_pass(pkg_mos_xml_files, mos_target_cat,
+                                tmpdir_factory):
+    output_dir = str(tmpdir_factory.mktemp('output'))
+
+    xml_filename_list = mos.workflow.mos_stage3.add_targets(pkg_mos_xml_files,
+                                                            [mos_target_cat],
+                                                            output_dir,
+                                                            clean_targets=True)
+
+    return xml_filename_list
+
+
+def test_diff_t_xml_files_single_pass(mos_t_xml_files_single_pass,
+                                      pkg_mos_t_xml_files):
+    diff_xml_file_lists(mos_t_xml_files_single_pass, pkg_mos_t_xml_files)
+
+
+def test_diff_t_xml_files_split_catalogue(pkg_mos_xml_files, mos_target_cat,
+                                          pkg_mos_t_xml_files, tmpdir):
+
+    # Split the catalogue in two files, which are passed together and give the
+    # same output as the whole catalogue
+
+    target_cat_list = []
+
+    with fits.open(mos_target_cat) as hdu_list:
+        num_rows = len(hdu_list[1].data)
+
+        for i, rows in enumerate([slice(None, num_rows // 2),
+                                  slice(num_rows // 2, None)]):
+            target_cat = str(tmpdir.join('targets_{}.fits'.format(i)))
+
+            fits.HDUList([
+                hdu_list[0].copy(),
+                fits.BinTableHDU(hdu_list[1].data[rows],
+                                 header=hdu_list[1].header)
+            ]).writeto(target_cat)
+
+            target_cat_list.append(target_cat)
+
+    output_dir = tmpdir.mkdir('output')
+
+    xml_filename_list = mos.workflow.mos_stage3.add_targets(pkg_mos_xml_files,
+                                                            target_cat_list,
+                                                            str(output_dir),
+                                                            clean_targets=True)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_t_xml_files)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_diff_t_xml_files_in_chunks(pkg_mos_xml_files, mos_target_cat,
+                                    pkg_mos_t_xml_files, tmpdir, chunk_size):
+    xml_filename_list = mos.workflow.mos_stage3.add_targets(
+        pkg_mos_xml_files,
+        mos_target_cat,
+        str(tmpdir),
+        clean_targets=True,
+        chunk_size=chunk_size)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_t_xml_files)
+
+
+def test_add_targets_chunks_in_pool(pkg_mos_xml_files, mos_target_cat,
+                                    tmpdir):
+    with pytest.raises(ValueError):
+        mos.workflow.mos_stage3.add_targets(pkg_mos_xml_files,
+                                            mos_target_cat,
+                                            str(tmpdir),
+                                            chunk_size=7,
+                                            workers=2)
+
+
+def test_diff_t_xml_files_in_pool(pkg_mos_xml_files, mos_target_cat,
+                                  pkg_mos_t_xml_files, tmpdir):
+    xml_filename_list = mos.workflow.mos_stage3.add_targets(pkg_mos_xml_files,
+                                                            mos_target_cat,
+                                                            str(tmpdir),
+                                                            clean_targets=True,
+                                                            workers=2)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_t_xml_files)
+
+
+def test_add_targets_in_pool_metrics(pkg_mos_xml_files, mos_target_cat,
+                                     tmpdir):
+    metrics = mos.workflow.utils.metrics
+
+    metrics.enable_metrics()
+
+    try:
+        mos.workflow.mos_stage3.add_targets(pkg_mos_xml_files,
+                                            mos_target_cat,
+                                            str(tmpdir),
+                                            clean_targets=True,
+                                            workers=2)
+
+        summary = metrics.get_recorder().get_summary()
+    finally:
+        metrics.disable_metrics()
+
+    # The spans of each OB are recorded by the workers and merged
+
+    for path in ['add_targets_in_pool/process_ob',
+                 'add_targets_in_pool/process_ob/write_ob']:
+        assert summary[path]['count'] == len(pkg_mos_xml_files)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_diff_t_xml_files_cached(pkg_mos_xml_files, mos_target_cat,
+                                 pkg_mos_t_xml_files, tmpdir, workers):
+
+    # Use a copy of the catalogue, so its cache is built in each case and is
+    # not seen by the other tests
+
+    target_cat = str(tmpdir.join(os.path.basename(mos_target_cat)))
+
+    shutil.copy(mos_target_cat, target_cat)
+
+    # The first run writes the cache of the catalogue and the second one reads
+    # it, with the same output
+
+    for i in range(2):
+        assert os.path.isdir(target_cat + '.cache') == (i > 0)
+
+        output_dir = tmpdir.mkdir(str(i))
+
+        xml_filename_list = mos.workflow.mos_stage3.add_targets(
+            pkg_mos_xml_files,
+            target_cat,
+            str(output_dir),
+            clean_targets=True,
+            workers=workers,
+            cache_catalogues=True)
+
+        assert os.path.isdir(target_cat + '.cache')
+
+        diff_xml_file_lists(xml_filename_list, pkg_mos_t_xml_files)
+
+
+def test_target_block_writer(pkg_mos_xml_files, mos_target_cat, tmpdir):
+    table = Table.read(mos_target_cat)
+
+    for xml_file in pkg_mos_xml_files:
+        ref_file = str(tmpdir.join('ref.xml'))
+        copy_file = str(tmpdir.join('copy.xml'))
+
+        ob_xml = OBXML(xml_file)
+        ob_xml._add_table_as_targets(table[:10])
+        ob_xml._add_table_as_targets(table[10:])
+        ob_xml.write_xml(ref_file)
+
+        ob_xml = OBXML(xml_file)
+        writer = mos.workflow.utils.TargetBlockWriter(ob_xml)
+        writer.add_table(table[:10])
+        writer.add_table(table[10:])
+        writer.write_xml(copy_file)
+
+        returncode = subprocess.call(['diff', '-q', ref_file, copy_file])
+
+        assert returncode == 0
+
+
+@pytest.mark.parametrize('clean_targets,compact', [(False, False),
+                                                   (True, False),
+                                                   (True, True)])
+def test_target_text_writer(pkg_mos_xml_files, mos_target_cat, tmpdir,
+                            clean_targets, compact):
+    table = Table.read(mos_target_cat)
+
+    for xml_file in pkg_mos_xml_files:
+        ref_file = str(tmpdir.join('ref.xml'))
+        copy_file = str(tmpdir.join('copy.xml'))
+
+        writer_list = [
+            mos.workflow.utils.TargetBlockWriter(OBXML(xml_file)),
+            mos.workflow.utils.TargetTextWriter(
+                mos.workflow.utils.OBText(xml_file))
+        ]
+
+        for writer, filename in zip(writer_list, [ref_file, copy_file]):
+            writer.add_table(table[:10])
+            writer.add_table(table[10:])
+
+            if clean_targets:
+                writer.clean_targets()
+
+            writer.write_xml(filename, compact=compact)
+
+        returncode = subprocess.call(['diff', '-q', ref_file, copy_file])
+
+        assert returncode == 0
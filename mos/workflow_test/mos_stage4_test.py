@@ -1,7 +1,11 @@
+import glob
+import json
 import pytest
 import subprocess
 import os.path
+import xml.dom.minidom
 import mos.workflow.mos_stage4
+from mos.workflow_test.mos_workflow_fixtures import diff_xml_file_lists
 
 
 @pytest.fixture(scope='module')
@@ -26,3 +30,92 @@ def test_diff_tgc_xml_files(mos_tgc_xml_files, pkg_mos_tgc_xml_files):
         returncode = subprocess.call(['diff', '-q', ref_file, copy_file])
 
         assert returncode == 0
+
+
+@pytest.mark.parametrize('plot_mode', ['none', 'deferred'])
+def test_diff_tgc_xml_files_plot_mode(pkg_mos_t_xml_files,
+                                      pkg_mos_tgc_xml_files, tmpdir,
+                                      plot_mode):
+    output_dir = str(tmpdir)
+
+    xml_filename_list = mos.workflow.mos_stage4.add_guide_and_calib_stars(
+        pkg_mos_t_xml_files, output_dir, plot_mode=plot_mode)
+
+    diff_xml_file_lists(xml_filename_list, pkg_mos_tgc_xml_files)
+
+    assert len(glob.glob(os.path.join(output_dir, '*.png'))) == 0
+
+    sidecar_file_list = glob.glob(os.path.join(output_dir, '*-plots.json'))
+
+    if plot_mode == 'deferred':
+        assert len(sidecar_file_list) == len(xml_filename_list)
+
+        # The sidecars contain the stars chosen by stage 4
+
+        for sidecar_file in sidecar_file_list:
+            with open(sidecar_file) as f:
+                plot_inputs = json.load(f)
+
+            tgc_xml_file = [
+                filename for filename in xml_filename_list
+                if sidecar_file == filename[:-len('.xml')] + '-plots.json'
+            ][0]
+
+            target_list = xml.dom.minidom.parse(
+                tgc_xml_file).getElementsByTagName('target')
+
+            for kind, targuse in [('guide', 'G'), ('calib', 'C')]:
+                assert plot_inputs[kind]['chosen']['targid'] == [
+                    target.getAttribute('targid') for target in target_list
+                    if target.getAttribute('targuse') == targuse
+                ]
+
+        plot_filename_list = mos.workflow.mos_stage4.render_deferred_plots(
+            sidecar_file_list, workers=2)
+
+        assert len(plot_filename_list) == 2 * len(xml_filename_list)
+
+        for plot_filename in plot_filename_list:
+            assert os.path.exists(plot_filename)
+    else:
+        assert len(sidecar_file_list) == 0
+
+
+def test_render_deferred_plots(tmpdir):
+    stars = {'ra': [100.2, 99.5], 'dec': [50.5, 49.8]}
+
+    plot_inputs = {
+        'xml_file': str(tmpdir.join('Spam_mos_01-t.xml')),
+        'field_center': {
+            'ra': 100.,
+            'dec': 50.
+        },
+        'max_radius': 1.
+    }
+
+    for kind in ['guide', 'calib']:
+        plot_inputs[kind] = {
+            'plot_filename': str(tmpdir.join(kind + '.png')),
+            'min_radius': 0,
+            'candidates': stars if kind == 'guide' else None,
+            'chosen': dict(stars, targid=['a', 'b'])
+        }
+
+    sidecar_file = str(tmpdir.join('Spam_mos_01-tgc-plots.json'))
+
+    with open(sidecar_file, 'w') as f:
+        json.dump(plot_inputs, f)
+
+    # The plots are rendered from the sidecar alone, as the XML file does not
+    # exist
+
+    plot_filename_list = mos.workflow.mos_stage4.render_deferred_plots(
+        [sidecar_file])
+
+    assert plot_filename_list == [
+        plot_inputs['guide']['plot_filename'],
+        plot_inputs['calib']['plot_filename']
+    ]
+
+    for plot_filename in plot_filename_list:
+        assert os.path.getsize(plot_filename) > 0
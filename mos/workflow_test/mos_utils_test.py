@@ -0,0 +1,491 @@
+import json
+import multiprocessing
+import os
+import pstats
+import shutil
+import types
+import xml.dom.minidom
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+
+import mos.workflow.utils
+
+
+@pytest.fixture(scope='module')
+def random_positions():
+    rng = np.random.RandomState(0)
+
+    num_positions = 20000
+
+    ra = rng.uniform(0., 360., num_positions)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., num_positions)))
+
+    return ra, dec
+
+
+@pytest.mark.parametrize('field_ra,field_dec,radius',
+                         [(100., 50., 1.), (0.2, -30., 1.), (359.9, 10., 2.),
+                          (45., 89.5, 1.5), (200., -89.9, 3.)])
+def test_sky_index_query(random_positions, field_ra, field_dec, radius):
+    ra, dec = random_positions
+
+    sky_index = mos.workflow.utils.SkyIndex(ra, dec, max_radius=radius)
+
+    rows = sky_index.query(field_ra, field_dec, radius)
+
+    # Compare with a brute-force search
+
+    field_center_coords = SkyCoord(ra=field_ra, dec=field_dec, unit='deg')
+    offset = field_center_coords.separation(SkyCoord(ra=ra, dec=dec,
+                                                     unit='deg')).deg
+
+    expected_rows = np.where(offset <= radius)[0]
+
+    assert len(expected_rows) > 0
+    assert np.array_equal(rows, expected_rows)
+
+
+def _assert_tables_equal(table, ref_table):
+    assert table.colnames == ref_table.colnames
+    assert table.meta == ref_table.meta
+
+    for name in ref_table.colnames:
+        assert table[name].__class__ is ref_table[name].__class__
+        assert table[name].dtype == ref_table[name].dtype
+        assert table[name].unit == ref_table[name].unit
+        assert np.array_equal(np.asarray(table[name]),
+                              np.asarray(ref_table[name]))
+        assert np.array_equal(np.ma.getmaskarray(table[name]),
+                              np.ma.getmaskarray(ref_table[name]))
+
+
+def test_target_catalogue(pkg_mos_target_cat):
+    ref_table = Table.read(pkg_mos_target_cat)
+
+    with mos.workflow.utils.TargetCatalogue(pkg_mos_target_cat) as catalogue:
+        assert len(catalogue) == len(ref_table)
+
+        for name in ['TARGSRVY', 'OBSTEMP', 'PROGTEMP', 'GAIA_RA', 'GAIA_DEC']:
+            assert np.all(catalogue[name] == ref_table[name])
+
+        rows = np.array([0, 3, 4, 17])
+
+        _assert_tables_equal(catalogue.get_rows(rows), ref_table[rows])
+
+
+def test_target_catalogue_save_columns(pkg_mos_target_cat, tmpdir):
+    columns_dir = str(tmpdir)
+
+    with mos.workflow.utils.TargetCatalogue(pkg_mos_target_cat) as catalogue:
+        catalogue.save_columns(columns_dir)
+
+        with mos.workflow.utils.TargetCatalogue(
+                pkg_mos_target_cat, columns_dir=columns_dir) as copy:
+            for name in catalogue.selection_columns:
+                assert isinstance(copy[name], np.memmap)
+                assert np.array_equal(copy[name], catalogue[name])
+
+            assert np.array_equal(copy.sky_index.query(100., 50., 1.),
+                                  catalogue.sky_index.query(100., 50., 1.))
+
+
+def test_target_catalogue_cache(pkg_mos_target_cat, tmpdir):
+    target_cat = str(tmpdir.join('targets.fits'))
+    shutil.copy(pkg_mos_target_cat, target_cat)
+
+    ref_table = Table.read(target_cat)
+
+    def check_catalogue():
+        with mos.workflow.utils.TargetCatalogue(target_cat,
+                                                cache=True) as catalogue:
+            assert catalogue.columns_dir == catalogue.get_cache_dir()
+
+            for name in catalogue.selection_columns:
+                assert isinstance(catalogue[name], np.memmap)
+                assert np.all(ref_table[name] == catalogue[name])
+
+            assert isinstance(catalogue.sky_index.xyz, np.memmap)
+            assert np.array_equal(
+                catalogue.get_categorical_index('TARGSRVY').get_rows(
+                    ref_table['TARGSRVY'][0]),
+                np.where(ref_table['TARGSRVY'] == ref_table['TARGSRVY'][0])[0])
+
+            return catalogue.get_cache_dir()
+
+    # The first opening writes the cache, and the next one reuses it
+
+    cache_dir = check_catalogue()
+    cache_info_file = os.path.join(cache_dir, 'cache.json')
+    mtime = os.path.getmtime(cache_info_file)
+
+    check_catalogue()
+
+    assert os.path.getmtime(cache_info_file) == mtime
+
+    # A truncated file is detected and the cache rebuilt
+
+    column_file = os.path.join(cache_dir, 'GAIA_RA.npy')
+
+    with open(column_file, 'r+b') as f:
+        f.truncate(os.path.getsize(column_file) // 2)
+
+    check_catalogue()
+
+    # So is a change of the catalogue
+
+    ref_table['GAIA_RA'][0] += 1.
+    ref_table.write(target_cat, overwrite=True)
+
+    check_catalogue()
+
+    # And a permutation of its rows, which does not change its DATASUM
+
+    def write_with_checksum():
+        hdu_list = fits.HDUList(
+            [fits.PrimaryHDU(),
+             fits.table_to_hdu(ref_table)])
+        hdu_list.writeto(target_cat, overwrite=True, checksum=True)
+
+    write_with_checksum()
+    check_catalogue()
+
+    datasum = fits.getval(target_cat, 'DATASUM', ext=1)
+
+    ref_table = ref_table[[4, 1, 2, 3, 0] + list(range(5, len(ref_table)))]
+    write_with_checksum()
+
+    assert fits.getval(target_cat, 'DATASUM', ext=1) == datasum
+
+    check_catalogue()
+
+
+def test_categorical_index():
+    column = np.array(['B', 'A', 'C', 'A', 'B', 'A'])
+
+    categorical_index = mos.workflow.utils.CategoricalIndex(column)
+
+    assert np.array_equal(categorical_index.get_rows('A'), [1, 3, 5])
+    assert np.array_equal(categorical_index.get_rows('A', 'C'), [1, 2, 3, 5])
+    assert np.array_equal(categorical_index.get_rows('A', 'A'), [1, 3, 5])
+    assert len(categorical_index.get_rows('D')) == 0
+    assert len(categorical_index.get_rows()) == 0
+
+
+def test_sky_index_query_rows(random_positions):
+    ra, dec = random_positions
+
+    sky_index = mos.workflow.utils.SkyIndex(ra, dec)
+
+    all_rows = sky_index.query(100., 50., 1.)
+
+    for rows in [np.arange(0, len(ra), 2), all_rows[::3]]:
+        assert np.array_equal(sky_index.query(100., 50., 1., rows=rows),
+                              np.intersect1d(all_rows, rows))
+
+
+def _get_parsing_modules():
+
+    # Modules which import xml.dom.minidom.parse in the three usual ways
+
+    module_list = []
+
+    for name, code in [('full', 'import xml.dom.minidom'),
+                       ('minidom', 'from xml.dom import minidom'),
+                       ('parse', 'from xml.dom.minidom import parse')]:
+        module = types.ModuleType('_parsing_module_' + name)
+        exec(code, module.__dict__)
+        module_list.append(module)
+
+    full_module, minidom_module, parse_module = module_list
+
+    parse_list = [
+        lambda file: full_module.xml.dom.minidom.parse(file),
+        lambda file: minidom_module.minidom.parse(file),
+        lambda file: parse_module.parse(file)
+    ]
+
+    return module_list, parse_list
+
+
+def test_xml_template(pkg_mos_xml_files):
+    xml_file = pkg_mos_xml_files[0]
+    other_xml_file = pkg_mos_xml_files[1]
+
+    xml_template = mos.workflow.utils.XMLTemplate(xml_file)
+
+    assert xml_template.datamver == xml.dom.minidom.parse(
+        xml_file).childNodes[0].getAttribute('datamver')
+
+    module_list, parse_list = _get_parsing_modules()
+
+    for parse in parse_list:
+        with xml_template.parse_from_memory(*module_list):
+            dom = parse(xml_file)
+            other_dom = parse(other_xml_file)
+
+            # Each parse gets its own copy of the template
+
+            assert parse(xml_file) is not dom
+            assert parse(os.path.relpath(xml_file)) is not dom
+
+            # Only the given modules are served from memory, and file objects
+            # are parsed as usual
+
+            assert xml.dom.minidom.parse.__module__ == 'xml.dom.minidom'
+
+            with open(xml_file) as f:
+                file_dom = parse(f)
+
+        assert dom.toprettyxml() == xml.dom.minidom.parse(
+            xml_file).toprettyxml()
+        assert other_dom.toprettyxml() == xml.dom.minidom.parse(
+            other_xml_file).toprettyxml()
+        assert file_dom.toprettyxml() == dom.toprettyxml()
+
+        # Modifying a copy does not affect the template
+
+        dom.childNodes[0].setAttribute('datamver', '0.00')
+
+        assert xml_template.clone().toprettyxml() == xml.dom.minidom.parse(
+            xml_file).toprettyxml()
+
+    # The modules are restored when the context exits
+
+    assert module_list[0].xml is xml
+    assert module_list[1].minidom is xml.dom.minidom
+    assert module_list[2].parse is xml.dom.minidom.parse
+
+    # A module which does not use xml.dom.minidom keeps parsing as usual
+
+    empty_module = types.ModuleType('_empty')
+
+    with xml_template.parse_from_memory(empty_module):
+        assert xml.dom.minidom.parse(xml_file).toprettyxml() == \
+            xml_template.clone().toprettyxml()
+
+    assert len(vars(empty_module)) == len(vars(types.ModuleType('_other')))
+
+
+def test_parse_document_from_memory(pkg_mos_xml_files):
+    xml_file = pkg_mos_xml_files[0]
+
+    dom = xml.dom.minidom.parse(xml_file)
+
+    module_list, parse_list = _get_parsing_modules()
+
+    for parse in parse_list:
+        with mos.workflow.utils.xml_template.parse_document_from_memory(
+                xml_file, dom, *module_list):
+
+            # The document is served once, and the file is parsed as usual
+            # afterwards
+
+            assert parse(xml_file) is dom
+
+            other_dom = parse(xml_file)
+
+            assert other_dom is not dom
+            assert other_dom.toprettyxml() == dom.toprettyxml()
+
+    # The template also keeps the last copy it has served
+
+    xml_template = mos.workflow.utils.XMLTemplate(xml_file)
+
+    with xml_template.parse_from_memory(*module_list):
+        dom = parse_list[0](xml_file)
+
+    assert xml_template.pop_last_clone() is dom
+    assert xml_template.pop_last_clone() is None
+
+
+def test_manifest(tmpdir):
+    manifest_file = str(tmpdir.join('manifest.json'))
+    output_file = str(tmpdir.join('output.xml'))
+
+    with open(output_file, 'w') as f:
+        f.write('spam')
+
+    input_hash = mos.workflow.utils.manifest.get_hash('spam', None, b'eggs')
+
+    manifest = mos.workflow.utils.Manifest(manifest_file)
+    manifest.set('Spam', input_hash, [output_file])
+    manifest.write()
+
+    manifest = mos.workflow.utils.Manifest(manifest_file)
+
+    assert manifest.keys() == ['Spam']
+    assert manifest.is_up_to_date('Spam', input_hash)
+    assert not manifest.is_up_to_date('Spam', 'ham')
+    assert not manifest.is_up_to_date('Eggs', input_hash)
+
+    # Removing a key deletes its outputs
+
+    manifest.remove('Spam')
+
+    assert not os.path.exists(output_file)
+    assert 'Spam' not in manifest
+
+    # An unreadable manifest is ignored
+
+    with open(manifest_file, 'w') as f:
+        f.write('{')
+
+    assert mos.workflow.utils.Manifest(manifest_file).keys() == []
+
+
+def test_metrics(tmpdir):
+    metrics = mos.workflow.utils.metrics
+    metrics_file = str(tmpdir.join('metrics.json'))
+
+    # Nothing is recorded while the metrics are disabled
+
+    assert metrics.get_recorder() is None
+
+    with metrics.span('spam') as spam_span:
+        spam_span.add('eggs')
+
+    metrics.enable_metrics()
+
+    try:
+        for i in range(2):
+            with metrics.span('spam', i=i):
+                with metrics.span('eggs') as eggs_span:
+                    eggs_span.add('ham', 3)
+                    metrics.add_counter('ham')
+
+        metrics.write_metrics(metrics_file)
+    finally:
+        metrics.disable_metrics()
+
+    with open(metrics_file) as f:
+        metrics_dict = json.load(f)
+
+    assert [span['path'] for span in metrics_dict['spans']
+            ] == ['spam/eggs', 'spam', 'spam/eggs', 'spam']
+    assert metrics_dict['spans'][1]['attributes'] == {'i': 0}
+    assert metrics_dict['summary']['spam']['count'] == 2
+    assert metrics_dict['summary']['spam/eggs']['counters'] == {'ham': 8}
+
+    for span in metrics_dict['spans']:
+        assert span['wall_time'] >= 0
+        assert span['cpu_time'] >= 0
+        assert span['peak_rss_increase_mb'] >= 0
+
+
+def _record_in_worker(i):
+    metrics = mos.workflow.utils.metrics
+
+    with metrics.span('eggs', i=i) as eggs_span:
+        eggs_span.add('ham', i)
+
+    return i, metrics.pop_records()
+
+
+def test_metrics_in_pool():
+    metrics = mos.workflow.utils.metrics
+
+    metrics.enable_metrics()
+
+    try:
+        with metrics.span('spam'):
+            pool = multiprocessing.Pool(
+                processes=2,
+                initializer=metrics.init_worker_metrics,
+                initargs=(metrics.get_start_wall_time(), ))
+
+            try:
+                result_list = pool.map(_record_in_worker, range(4))
+            finally:
+                pool.close()
+                pool.join()
+
+            for i, record_list in result_list:
+                metrics.add_records(record_list)
+
+        summary = metrics.get_recorder().get_summary()
+    finally:
+        metrics.disable_metrics()
+
+    # The spans of the workers are nested in the span which runs the pool
+
+    assert list(summary.keys()) == ['spam/eggs', 'spam']
+    assert summary['spam/eggs']['count'] == 4
+    assert summary['spam/eggs']['counters'] == {'ham': 6}
+
+    # Nothing is recorded by the workers while the metrics are disabled
+
+    metrics.init_worker_metrics(metrics.get_start_wall_time())
+
+    assert _record_in_worker(1) == (1, [])
+
+
+def _spin(num_iterations):
+    return sum(sum(range(100)) for i in range(num_iterations))
+
+
+@pytest.mark.parametrize('mode,extension', [('cprofile', '.pstats'),
+                                            ('sampling', '.collapsed')])
+def test_stage_profiler(mode, extension, tmpdir, capsys):
+    output_prefix = str(tmpdir.join('spam'))
+
+    with mos.workflow.utils.StageProfiler(mode, output_prefix, top=5,
+                                          interval=0.001) as profiler:
+        _spin(100000)
+
+    assert profiler.filename == output_prefix + extension
+    assert os.path.isfile(profiler.filename)
+    assert 'function' in capsys.readouterr().out
+
+    # The outer frames of the test runner come first in the printed functions,
+    # so look for the profiled function in the output file
+
+    if mode == 'cprofile':
+        stats = pstats.Stats(profiler.filename)
+
+        assert any(function[2] == '_spin' for function in stats.stats)
+    else:
+        with open(profiler.filename) as f:
+            line_list = f.readlines()
+
+        assert any('_spin' in line for line in line_list)
+
+        for line in line_list:
+            stack, count = line.rsplit(' ', 1)
+            assert int(count) > 0
+
+
+def test_stage_profiler_disabled(tmpdir):
+    with mos.workflow.utils.StageProfiler(None, str(
+            tmpdir.join('spam'))) as profiler:
+        _spin(10)
+
+    assert profiler.filename is None
+    assert tmpdir.listdir() == []
+
+
+def test_xml_stream_writer(pkg_mos_xml_files, tmpdir):
+    output_file = str(tmpdir.join('output.xml'))
+
+    for xml_file in pkg_mos_xml_files:
+        dom = xml.dom.minidom.parse(xml_file)
+
+        writer = mos.workflow.utils.XMLStreamWriter(dom)
+        writer.write(output_file)
+
+        with open(xml_file) as f, open(output_file) as g:
+            assert f.read() == g.read()
+
+        # The compact mode drops the comments only
+
+        compact_writer = mos.workflow.utils.XMLStreamWriter(dom, compact=True)
+        compact_writer.write(output_file)
+
+        compact_dom = xml.dom.minidom.parse(output_file)
+
+        assert '<!--' not in compact_dom.toxml()
+        assert len(compact_dom.getElementsByTagName('*')) == len(
+            dom.getElementsByTagName('*'))
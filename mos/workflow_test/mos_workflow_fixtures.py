@@ -2,6 +2,7 @@ import os.path
 import pathlib
 import pytest
 import glob
+import subprocess
 
 import mos.workflow
 
@@ -97,3 +98,24 @@ def pkg_mos_tgc_xml_files():
         assert os.path.exists(xml_filename)
 
     return xml_filename_list
+
+
+def diff_xml_file_lists(xml_filename_list, ref_xml_filename_list):
+
+    # Check that each reference XML file has a file with the same name and
+    # content in a list
+
+    assert len(xml_filename_list) == len(ref_xml_filename_list)
+
+    for ref_file in ref_xml_filename_list:
+        copy_file_list = [
+            filename for filename in xml_filename_list
+            if os.path.basename(filename) == os.path.basename(ref_file)
+        ]
+
+        assert len(copy_file_list) == 1
+
+        returncode = subprocess.call(['diff', '-q', ref_file,
+                                      copy_file_list[0]])
+
+        assert returncode == 0